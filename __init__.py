@@ -14,17 +14,23 @@
 from __future__ import division, unicode_literals, print_function, absolute_import
     
 from lyse.dataframe_utilities import get_series_from_shot as _get_singleshot, dict_diff
+from lyse.dataframe_utilities import flat_dict_to_flat_series as _flat_dict_to_flat_series
+from lyse.dataframe_utilities import set_dataframe_index as _set_dataframe_index
+from lyse.dataframe_transport import arrow_available as _arrow_available, decode_dataframe as _decode_dataframe
+from lyse.shared_dataframe import shared_memory_available as _shared_memory_available
 import os
 import socket
 import pickle as pickle
 import inspect
 import sys
 import threading
+from contextlib import contextmanager
 
 import labscript_utils.h5_lock, h5py
 from labscript_utils.labconfig import LabConfig
 import pandas
-from numpy import array, ndarray
+from numpy import array, ndarray, empty, s_, memmap
+from multiprocessing.pool import ThreadPool
 import types
 
 __version__ = '2.6.0'
@@ -72,6 +78,20 @@ plots = {}
 delay_event = threading.Event()
 # a flag to determine whether we should wait for the delay event
 _delay_flag = False
+# The routines the running routine has declared it depends on with depends_on(), or
+# None if it has not declared any:
+_depends_on = None
+# The most shots the running routine has declared it can analyse at once with
+# analyse_in_batches(), or None if it has not:
+_max_batch_size = None
+# The result groups the running routine has read from shot files, so that lyse can
+# tell if they have changed since it last ran. '*' means all of them, and None
+# means it has read data from other shots:
+_results_read = set()
+
+# How long to wait for lyse to return a shot's data to data(filepath) before reading
+# the shot file instead:
+_SERIES_TIMEOUT = 1
 
 # get port that lyse is using for communication
 try:
@@ -85,6 +105,10 @@ if len(sys.argv) > 1:
 else:
     path = None
 
+# The shots being analysed. Only routines that call analyse_in_batches() are given
+# more than one at a time, otherwise this is [path]:
+paths = [path] if path is not None else []
+
 
 class _RoutineStorage(object):
     """An empty object that analysis routines can store data in. It will
@@ -98,33 +122,230 @@ class _RoutineStorage(object):
 
 routine_storage = _RoutineStorage()
 
+# The most recent dataframe returned by data() for each (host, port), along with
+# the (id, version) of lyse's data it was produced from, so that only changes since
+# then need to be requested next time:
+_dataframe_cache = {}
+
+# The (id, version) of lyse's data as of the running routine's latest call to
+# data(), and as of the last run of the routine that succeeded, by (host, port):
+_data_versions = {}
+_last_run_data_versions = {}
+# Whether the latest call to data(since_last_run=True) returned all rows, rather
+# than only those added or changed since the last successful run:
+data_reset = True
+
 
-def data(filepath=None, host='localhost', port=_lyse_port, timeout=5):
+def _apply_dataframe_update(df, rows):
+    """Return a copy of df with rows, a dataframe indexed by row number as
+    returned in an update from lyse, replacing or appending to its rows"""
+    if not len(rows) and rows.columns.equals(df.columns):
+        return df
+    unchanged = df.index.difference(rows.index)
+    df = pandas.concat([df.loc[unchanged], rows])
+    return df.sort_index(axis=0).sort_index(axis=1)
+
+
+def _dataframe_transport(host):
+    """The format and compression in which to request dataframes from lyse. Within
+    lyse, the dataframe is shared with analysis routines in shared memory, unless
+    disabled with the labconfig option [lyse] shared_memory_dataframes = False.
+    Otherwise pickling is fastest for the mostly numeric dataframes lyse produces,
+    so it is used on the local machine. From other machines, if pyarrow is
+    available, the dataframe is requested in the Arrow format with lz4 compression,
+    which is around half the size."""
+    local = host in ('localhost', '127.0.0.1', '::1', socket.gethostname())
+    if local and spinning_top and _shared_memory_available():
+        try:
+            use_shared_memory = _labconfig.getboolean('lyse', 'shared_memory_dataframes')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            use_shared_memory = True
+        if use_shared_memory:
+            return 'shm', None
+    if local or not _arrow_available():
+        return None, None
+    return 'arrow', 'lz4'
+
+
+def _get_dataframe_update(host, port, timeout, since, use_shared_memory=True):
+    """Request from lyse the changes to its dataframe since the version since, and
+    return the update with its dataframes decoded, along with whether they are in
+    shared memory. Returns None if lyse does not support incremental updates."""
+    format, compression = _dataframe_transport(host)
+    if format == 'shm' and not use_shared_memory:
+        format = None
+    request = {'request': 'get dataframe', 'since': since,
+               'format': format, 'compression': compression}
+    update = zmq_get(port, host, request, timeout)
+    if not isinstance(update, dict):
+        return None, False
+    shared = update['dataframe'] is not None and format is not None and update['dataframe'][0] == 'shm'
+    if format is not None:
+        try:
+            for key in ['dataframe', 'rows']:
+                if update[key] is not None:
+                    update[key] = _decode_dataframe(update[key])
+        except OSError:
+            if not shared:
+                raise
+            # The shared memory has been freed already, as lyse has published newer
+            # versions of the dataframe since. Fall back to a copy:
+            return _get_dataframe_update(host, port, timeout, since, use_shared_memory=False)
+    _data_versions[host, port] = (update['id'], update['version'])
+    if not spinning_top:
+        # No runs to speak of, the last run is the last call:
+        _last_run_data_versions[host, port] = (update['id'], update['version'])
+    return update, shared
+
+
+def _get_dataframe(host, port, timeout):
+    cached_since, cached_df = _dataframe_cache.get((host, port), (None, None))
+    update, shared = _get_dataframe_update(host, port, timeout, cached_since)
+    if update is None:
+        # A version of lyse that does not support incremental updates:
+        return zmq_get(port, host, 'get dataframe', timeout)
+    if update['rows'] is not None:
+        df = _apply_dataframe_update(cached_df, update['rows'])
+    else:
+        df = update['dataframe']
+    _dataframe_cache[host, port] = (update['id'], update['version']), df
+    if shared:
+        # The numeric columns are read-only views of shared memory, which must not
+        # be copied. Only adding columns or changing the index of the dataframe
+        # could affect the cache, which a shallow copy prevents:
+        return df.copy(deep=False)
+    # Copy so that modifications by the caller do not affect the cache:
+    return df.copy()
+
+
+def _get_dataframe_since_last_run(host, port, timeout):
+    """Return the rows of lyse's dataframe added or changed since the last
+    successful run of the routine, and whether all rows were returned instead"""
+    global data_reset
+    update, shared = _get_dataframe_update(host, port, timeout, _last_run_data_versions.get((host, port)))
+    if update is None:
+        raise RuntimeError('This version of lyse does not support data(since_last_run=True)')
+    if update['rows'] is not None:
+        data_reset = False
+        return update['rows']
+    data_reset = True
+    if shared:
+        # Don't let changes to the index affect the shared dataframe:
+        return update['dataframe'].copy(deep=False)
+    return update['dataframe']
+
+
+def data(filepath=None, host='localhost', port=_lyse_port, timeout=5, since_last_run=False):
+    """Return the data for a single shot as a Series if filepath is given, otherwise
+    lyse's dataframe of all shots. If since_last_run is True, only the rows added or
+    changed since the routine last ran successfully are returned, so that multishot
+    routines can keep running totals in routine_storage rather than recomputing from
+    every shot. If the routine has not run successfully before, or shots have been
+    removed from lyse since, all rows are returned, and lyse.data_reset is set to
+    True, in which case such totals should be started afresh."""
     if filepath is not None:
+        _results_read.add('*')
+        if spinning_top:
+            # Running within lyse, which has already read the shot file. Get the
+            # shot's data from lyse rather than reading the file again. This is
+            # only worthwhile if lyse answers promptly, otherwise read the file:
+            try:
+                series = zmq_get(port, host, {'request': 'get series', 'path': filepath},
+                                 min(timeout, _SERIES_TIMEOUT))
+            except Exception:
+                series = None
+            if isinstance(series, pandas.Series):
+                if filepath in _updated_data:
+                    # Results saved by this routine in the current run are not in
+                    # lyse's copy yet:
+                    flat_dict = {
+                        key if isinstance(key, tuple) else (key,): value
+                        for key, value in series.items()
+                    }
+                    flat_dict.update(_updated_data[filepath])
+                    series = _flat_dict_to_flat_series(flat_dict)
+                return series
         return _get_singleshot(filepath)
     else:
-        df = zmq_get(port, host, 'get dataframe', timeout)
+        _results_read.add(None)
+        if since_last_run:
+            df = _get_dataframe_since_last_run(host, port, timeout)
+        else:
+            df = _get_dataframe(host, port, timeout)
         try:
-            padding = ('',)*(df.columns.nlevels - 1)
-            try:
-                integer_indexing = _labconfig.getboolean('lyse', 'integer_indexing')
-            except (LabConfig.NoOptionError, LabConfig.NoSectionError):
-                integer_indexing = False
-            if integer_indexing:
-                df.set_index(['sequence_index', 'run number', 'run repeat'], inplace=True, drop=False)
-            else:
-                df.set_index([('sequence',) + padding,('run time',) + padding], inplace=True, drop=False)
-                df.index.names = ['sequence', 'run time']
-        except KeyError:
-            # Empty DataFrame or index column not found, so fall back to RangeIndex instead
-            pass
-        df.sort_index(inplace=True)
-        return df
+            integer_indexing = _labconfig.getboolean('lyse', 'integer_indexing')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            integer_indexing = False
+        return _set_dataframe_index(df, integer_indexing)
         
+def _memmap_dataset(dataset, filepath):
+    """Return a read-only numpy memmap of an HDF5 dataset's data in the file at the
+    given path, or None if its storage does not allow it. This requires the data to
+    be stored contiguously, uncompressed and unfiltered, with a fixed-size dtype,
+    and to have been allocated in the file."""
+    if dataset.chunks is not None or dataset.compression is not None:
+        return None
+    if dataset.dtype.hasobject or not dataset.shape:
+        return None
+    if getattr(dataset, 'is_virtual', False) or getattr(dataset, 'external', None):
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return memmap(filepath, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+
+
+def _roi_selection(roi, shape):
+    """Return a region of interest, a slice or tuple of slices, as a tuple of
+    slices with one per axis of a dataset of the given shape, along with the shape
+    of the data it selects"""
+    if roi is None:
+        roi = ()
+    elif isinstance(roi, slice):
+        roi = (roi,)
+    roi = tuple(roi)
+    if len(roi) > len(shape):
+        raise ValueError('roi has %d axes, but the image has %d' % (len(roi), len(shape)))
+    roi += (slice(None),) * (len(shape) - len(roi))
+    for axis_slice in roi:
+        # HDF5 selections can only step forwards:
+        if axis_slice.step is not None and axis_slice.step < 1:
+            raise ValueError('roi slices must have a step of at least 1, not %r' % axis_slice)
+    selected_shape = tuple(len(range(*axis_slice.indices(n))) for axis_slice, n in zip(roi, shape))
+    return roi, selected_shape
+
+
+def _bin(data, binning, first_axis=0):
+    """Sum blocks of adjacent pixels of an image, or stack of images whose image
+    axes start at first_axis. binning is the block size along each image axis,
+    or an integer to use the same size along the first two. Pixels at the far
+    edges that do not fill a block are dropped."""
+    if binning is None:
+        return data
+    if isinstance(binning, int):
+        binning = (binning,) * min(2, data.ndim - first_axis)
+    if len(binning) > data.ndim - first_axis:
+        raise ValueError('binning has %d axes, but the image has %d' % (len(binning), data.ndim - first_axis))
+    selection = [slice(None)] * first_axis
+    shape = list(data.shape[:first_axis])
+    for axis, block_size in enumerate(binning, first_axis):
+        n_blocks = data.shape[axis] // block_size
+        selection.append(slice(0, n_blocks * block_size))
+        shape.extend([n_blocks, block_size])
+    shape.extend(data.shape[first_axis + len(binning):])
+    blocks = data[tuple(selection)].reshape(shape)
+    return blocks.sum(axis=tuple(first_axis + 2 * i + 1 for i in range(len(binning))))
+
+
 def globals_diff(run1, run2, group=None):
     return dict_diff(run1.get_globals(group), run2.get_globals(group))
  
 class Run(object):
+    # The shot file, if held open by open() or by using the Run as a context
+    # manager, and how many times it has been opened without being closed:
+    _held_h5_file = None
+    _open_count = 0
+
     def __init__(self,h5_path,no_write=False):
         self.no_write = no_write
         self.h5_path = h5_path
@@ -155,15 +376,64 @@ class Run(object):
             # 'the moment.\n')
             self.no_write = True
             
+    def open(self):
+        """Open the shot file and hold it open until close() is called, so that
+        calls to other methods in the meantime all use the one file handle and
+        lock, rather than each opening the file. Writes are flushed when it is
+        closed. The Run may also be used as a context manager to the same effect:
+
+            with Run(path) as run:
+                x, y = run.get_trace('probe')
+                run.save_result('peak', y.max())
+
+        Calls may be nested, the file is closed once close() has been called as
+        many times as open()."""
+        if self._held_h5_file is None:
+            self._held_h5_file = h5py.File(self.h5_path, 'r' if self.no_write else 'a')
+        self._open_count += 1
+        return self
+
+    def close(self):
+        """Close the shot file held open by open()"""
+        if not self._open_count:
+            return
+        self._open_count -= 1
+        if not self._open_count:
+            h5_file, self._held_h5_file = self._held_h5_file, None
+            h5_file.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def _h5_file(self, mode=None):
+        """The shot file, open for the duration of the block. The file held open
+        by open() if any, otherwise it is opened just for the block, with the
+        given mode, or h5py's default if None."""
+        if self._held_h5_file is None:
+            args = (mode,) if mode is not None else ()
+            with h5py.File(self.h5_path, *args) as h5_file:
+                yield h5_file
+        else:
+            if mode == 'a' and self._held_h5_file.mode == 'r':
+                # Held open read-only, but set_group() has since made the Run
+                # writable. Reopen for writing:
+                self._held_h5_file.close()
+                self._held_h5_file = h5py.File(self.h5_path, 'a')
+            yield self._held_h5_file
+
     def set_group(self, groupname):
         self.group = groupname
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file('a') as h5_file:
             if not self.group in h5_file['results']:
                  h5_file['results'].create_group(self.group)
         self.no_write = False
 
     def trace_names(self):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             try:
                 return list(h5_file['data']['traces'].keys())
             except KeyError:
@@ -171,30 +441,49 @@ class Run(object):
                 
     def get_attrs(self, group):
         """Returns all attributes of the specified group as a dictionary."""
-        with h5py.File(self.h5_path) as h5_file:
+        if group.strip('/').startswith('results'):
+            _results_read.add(group.strip('/').partition('/')[2].partition('/')[0] or '*')
+        with self._h5_file() as h5_file:
             if not group in h5_file:
                 raise Exception('The group \'%s\' does not exist'%group)
             return get_attributes(h5_file[group])
 
-    def get_trace(self,name):
-        with h5py.File(self.h5_path) as h5_file:
+    def get_trace(self,name,mmap=False):
+        """Return the times and values of a trace as float arrays. If mmap is True
+        and the trace is stored contiguously and uncompressed as floats, they are
+        read-only views of the file mapped into memory, rather than copies. See
+        get_image()."""
+        with self._h5_file() as h5_file:
             if not name in h5_file['data']['traces']:
                 raise Exception('The trace \'%s\' doesn not exist'%name)
             trace = h5_file['data']['traces'][name]
+            if mmap:
+                mapped = _memmap_dataset(trace, self.h5_path)
+                if mapped is not None and all(mapped.dtype[field] == float for field in ['t', 'values']):
+                    return mapped['t'], mapped['values']
             return array(trace['t'],dtype=float),array(trace['values'],dtype=float)         
 
-    def get_result_array(self,group,name):
-        with h5py.File(self.h5_path) as h5_file:
+    def get_result_array(self,group,name,mmap=False):
+        """Return a result array saved by save_result_array(). If mmap is True and
+        the array is stored contiguously and uncompressed, it is a read-only view of
+        the file mapped into memory, rather than a copy. See get_image()."""
+        _results_read.add(group)
+        with self._h5_file() as h5_file:
             if not group in h5_file['results']:
                 raise Exception('The result group \'%s\' doesn not exist'%group)
             if not name in h5_file['results'][group]:
                 raise Exception('The result array \'%s\' doesn not exist'%name)
+            if mmap:
+                mapped = _memmap_dataset(h5_file['results'][group][name], self.h5_path)
+                if mapped is not None:
+                    return mapped
             return array(h5_file['results'][group][name])
             
     def get_result(self, group, name):
         """Return 'result' in 'results/group' that was saved by 
         the save_result() method."""
-        with h5py.File(self.h5_path) as h5_file:
+        _results_read.add(group)
+        with self._h5_file() as h5_file:
             if not group in h5_file['results']:
                 raise Exception('The result group \'%s\' does not exist'%group)
             if not name in h5_file['results'][group].attrs.keys():
@@ -214,30 +503,39 @@ class Run(object):
         in the 'results' group and overwrite an existing result.
         Note that the result is saved as an attribute of 'results/group' and
         overwriting attributes causes h5 file size bloat."""
+        self._save_results({name: value}, group=group, overwrite=overwrite)
+
+    def _save_results(self, results, group=None, overwrite=True):
+        """Save a dict of results to the h5 file as attributes of the given group,
+        with one opening of the file and one call to set_attributes()"""
         if self.no_write:
             raise Exception('This run is read-only. '
                             'You can\'t save results to runs through a '
                             'Sequence object. Per-run analysis should be done '
                             'in single-shot analysis routines, in which a '
                             'single Run object is used')
-        with h5py.File(self.h5_path,'a') as h5_file:
+        with self._h5_file('a') as h5_file:
             if not group:
                 # Save to analysis results group by default
                 group = 'results/' + self.group
             elif not group in h5_file:
                 # Create the group if it doesn't exist
                 h5_file.create_group(group) 
-            if name in h5_file[group].attrs and not overwrite:
-                raise Exception('Attribute %s exists in group %s. ' \
-                                'Use overwrite=True to overwrite.' % (name, group))                   
-            set_attributes(h5_file[group], {name: value})
+            if not overwrite:
+                for name in results:
+                    if name in h5_file[group].attrs:
+                        raise Exception('Attribute %s exists in group %s. ' \
+                                        'Use overwrite=True to overwrite.' % (name, group))
+            set_attributes(h5_file[group], results)
             
         if spinning_top:
             if self.h5_path not in _updated_data:
                 _updated_data[self.h5_path] = {}
             if group.startswith('results'):
                 toplevel = group.replace('results/', '', 1)
-                _updated_data[self.h5_path][toplevel, name] = value
+                _updated_data[self.h5_path].update(
+                    ((toplevel, name), value) for name, value in results.items()
+                )
 
     def save_result_array(self, name, data, group=None, 
                           overwrite=True, keep_attrs=False, **kwargs):
@@ -250,7 +548,7 @@ class Run(object):
                             'Sequence object. Per-run analysis should be done '
                             'in single-shot analysis routines, in which a '
                             'single Run object is used')
-        with h5py.File(self.h5_path, 'a') as h5_file:
+        with self._h5_file('a') as h5_file:
             attrs = {}
             if not group:
                 # Save dataset to results group by default
@@ -284,61 +582,118 @@ class Run(object):
         return results
         
     def save_results(self, *args, **kwargs):
-        """Iteratively call save_result() on multiple results.
+        """Save multiple results, with one opening of the file.
         Assumes arguments are ordered such that each result to be saved is
         preceeded by the name of the attribute to save it under.
-        Keywords arguments are passed to each call of save_result()."""
+        Keywords arguments are as for save_result()."""
         names = args[::2]
         values = args[1::2]
+        results = {}
+        messages = []
         for name, value in zip(names, values):
-            print('saving %s =' % name, value)
-            self.save_result(name, value, **kwargs)
+            messages.append('saving %s = %s' % (name, value))
+            results[name] = value
+        if messages:
+            print('\n'.join(messages))
+        self._save_results(results, **kwargs)
             
     def save_results_dict(self, results_dict, uncertainties=False, **kwargs):
-        for name, value in results_dict.items():
-            if not uncertainties:
-                self.save_result(name, value, **kwargs)
-            else:
-                self.save_result(name, value[0], **kwargs)
-                self.save_result('u_' + name, value[1], **kwargs)
+        """Save a dict of results, with one opening of the file. If uncertainties
+        is True, each value is a (value, uncertainty) tuple, and the uncertainty
+        is saved as 'u_' + name. Keywords arguments are as for save_result()."""
+        if not uncertainties:
+            results = dict(results_dict)
+        else:
+            results = {}
+            for name, value in results_dict.items():
+                results[name] = value[0]
+                results['u_' + name] = value[1]
+        self._save_results(results, **kwargs)
 
     def save_result_arrays(self, *args, **kwargs):
-        """Iteratively call save_result_array() on multiple data sets. 
-        Assumes arguments are ordered such that each dataset to be saved is 
+        """Call save_result_array() on multiple data sets, with one opening of
+        the file. Assumes arguments are ordered such that each dataset to be saved is
         preceeded by the name to save it as. 
         All keyword arguments are passed to each call of save_result_array()."""
         names = args[::2]
         values = args[1::2]
-        for name, value in zip(names, values):
-            self.save_result_array(name, value, **kwargs)
+        with self:
+            for name, value in zip(names, values):
+                self.save_result_array(name, value, **kwargs)
     
-    def get_image(self,orientation,label,image):
-        with h5py.File(self.h5_path) as h5_file:
-            if not 'images' in h5_file:
-                raise Exception('File does not contain any images')
-            if not orientation in h5_file['images']:
-                raise Exception('File does not contain any images with orientation \'%s\''%orientation)
-            if not label in h5_file['images'][orientation]:
-                raise Exception('File does not contain any images with label \'%s\''%label)
-            if not image in h5_file['images'][orientation][label]:
-                raise Exception('Image \'%s\' not found in file'%image)
-            return array(h5_file['images'][orientation][label][image])
+    def _get_image_dataset(self, h5_file, orientation, label, image):
+        if not 'images' in h5_file:
+            raise Exception('File does not contain any images')
+        if not orientation in h5_file['images']:
+            raise Exception('File does not contain any images with orientation \'%s\''%orientation)
+        if not label in h5_file['images'][orientation]:
+            raise Exception('File does not contain any images with label \'%s\''%label)
+        if not image in h5_file['images'][orientation][label]:
+            raise Exception('Image \'%s\' not found in file'%image)
+        return h5_file['images'][orientation][label][image]
+
+    def get_image(self,orientation,label,image,mmap=False,roi=None,binning=None):
+        """Return an image as an array. If mmap is True and the image is stored
+        contiguously and uncompressed, the array is a read-only numpy memmap of the
+        file, so that the image is read from disk only as it is accessed, and not
+        copied into memory allocated for it. Otherwise, or if mmap is False, it is a
+        copy. A memmap reflects the file as it is when accessed, not when this was
+        called, so it should not be used after the dataset is deleted or
+        overwritten, and on Windows it prevents the file being deleted while it
+        exists.
+
+        roi is a slice or tuple of slices, such as (slice(100, 200), slice(50,
+        150)), selecting a region of interest of the image. Only that region is
+        read from the file. binning is an integer or tuple of integers, the
+        number of adjacent pixels to sum along each axis, such that binning=2
+        sums each 2x2 block of pixels. Pixels at the far edges that do not fill
+        a block are dropped. A binned image is always a copy."""
+        with self._h5_file() as h5_file:
+            dataset = self._get_image_dataset(h5_file, orientation, label, image)
+            selection, _ = _roi_selection(roi, dataset.shape)
+            if mmap and binning is None:
+                mapped = _memmap_dataset(dataset, self.h5_path)
+                if mapped is not None:
+                    return mapped[selection]
+            if roi is None:
+                return _bin(array(dataset), binning)
+            return _bin(dataset[selection], binning)
     
-    def get_images(self,orientation,label, *images):
-        results = []
-        for image in images:
-            results.append(self.get_image(orientation,label,image))
-        return results
+    def get_images(self,orientation,label, *images, **kwargs):
+        """Return the given images, read with one opening of the file. If they all
+        have the same shape and dtype, they are read into a single array of shape
+        (n_images,) + the shape of each, which can be unpacked into separate
+        images. Otherwise a list of arrays is returned. Keyword arguments roi and
+        binning are as for get_image(), and apply to each image."""
+        roi = kwargs.pop('roi', None)
+        binning = kwargs.pop('binning', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % ', '.join(kwargs))
+        if not images:
+            return []
+        with self._h5_file() as h5_file:
+            datasets = [self._get_image_dataset(h5_file, orientation, label, image) for image in images]
+            selections = [_roi_selection(roi, dataset.shape) for dataset in datasets]
+            shapes = set(shape for _, shape in selections)
+            dtypes = set(dataset.dtype for dataset in datasets)
+            if len(shapes) > 1 or len(dtypes) > 1:
+                return [_bin(dataset[selection], binning) for dataset, (selection, _) in zip(datasets, selections)]
+            stack = empty((len(images),) + shapes.pop(), dtype=dtypes.pop())
+            if stack.size:
+                for i, (dataset, (selection, _)) in enumerate(zip(datasets, selections)):
+                    # Read straight into the stack, only the region of interest:
+                    dataset.read_direct(stack, source_sel=selection, dest_sel=s_[i])
+        return _bin(stack, binning, first_axis=1)
         
     def get_all_image_labels(self):
         images_list = {}
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             for orientation in h5_file['/images'].keys():
                 images_list[orientation] = list(h5_file['/images'][orientation].keys())               
         return images_list                
     
     def get_image_attributes(self, orientation):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             if not 'images' in h5_file:
                 raise Exception('File does not contain any images')
             if not orientation in h5_file['images']:
@@ -347,18 +702,18 @@ class Run(object):
 
     def get_globals(self,group=None):
         if not group:
-            with h5py.File(self.h5_path) as h5_file:
+            with self._h5_file() as h5_file:
                 return dict(h5_file['globals'].attrs)
         else:
             try:
-                with h5py.File(self.h5_path) as h5_file:
+                with self._h5_file() as h5_file:
                     return dict(h5_file['globals'][group].attrs)
             except KeyError:
                 return {}
 
     def get_globals_raw(self, group=None):
         globals_dict = {}
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             if group == None:
                 for obj in h5_file['globals'].values():
                     temp_dict = dict(obj.attrs)
@@ -399,7 +754,7 @@ class Run(object):
                 for key, val in temp_dict.items():
                     if val:
                         expansion_dict[key] = val
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             h5_file['globals'].visititems(append_expansion)
         return expansion_dict
                    
@@ -410,12 +765,12 @@ class Run(object):
                 temp_dict = dict(obj.attrs)
                 for key, val in temp_dict.items():
                     units_dict[key] = val
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             h5_file['globals'].visititems(append_units)
         return units_dict
 
     def globals_groups(self):
-        with h5py.File(self.h5_path) as h5_file:
+        with self._h5_file() as h5_file:
             try:
                 return list(h5_file['globals'].keys())
             except KeyError:
@@ -435,7 +790,9 @@ class Sequence(Run):
             if not 'results' in h5_file:
                  h5_file.create_group('results')
                  
-        self.runs = {path: Run(path,no_write=True) for path in run_paths}
+        # In the order given, which is that of the dataframe if one was passed in:
+        self.run_paths = list(run_paths)
+        self.runs = {path: Run(path,no_write=True) for path in self.run_paths}
         
         # The group were the results will be stored in the h5 file will
         # be the name of the python script which is instantiating this
@@ -458,20 +815,95 @@ class Sequence(Run):
             'the moment.\n')
             self.no_write = True
         
+    # How many threads to read shot files with. Opening each file involves a round
+    # trip to the lock server, and the file system may be on the network, so
+    # several files are best opened at once:
+    read_threads = 8
+
+    def _map_runs(self, function, progress=None):
+        """Call function(i, path) for the ith shot in each thread of a pool, and
+        progress(n_done, n_total), if given, in this thread as each completes.
+        Returns the results in the order of the shots."""
+        n_total = len(self.run_paths)
+        results = [None] * n_total
+        if not n_total:
+            return results
+        pool = ThreadPool(min(self.read_threads, n_total))
+        try:
+            def call(i):
+                return i, function(i, self.run_paths[i])
+            for n_done, (i, result) in enumerate(pool.imap_unordered(call, range(n_total))):
+                results[i] = result
+                if progress is not None:
+                    progress(n_done + 1, n_total)
+        finally:
+            pool.terminate()
+        return results
+
+    def _stack_dataset(self, name, progress=None):
+        """Read the dataset at the given path in every shot file into one array
+        of shape (n_shots,) + the dataset's shape, in the order of the shots. The
+        dataset must have the same shape and dtype in every shot file."""
+        if not self.run_paths:
+            raise ValueError('Sequence has no shots')
+        with h5py.File(self.run_paths[0], 'r') as h5_file:
+            if not name in h5_file:
+                raise Exception('The dataset \'%s\' does not exist in %s' % (name, self.run_paths[0]))
+            dataset = h5_file[name]
+            shape, dtype = dataset.shape, dataset.dtype
+        stack = empty((len(self.run_paths),) + shape, dtype=dtype)
+        def read(i, path):
+            with h5py.File(path, 'r') as h5_file:
+                if not name in h5_file:
+                    raise Exception('The dataset \'%s\' does not exist in %s' % (name, path))
+                dataset = h5_file[name]
+                if dataset.shape != shape or dataset.dtype != dtype:
+                    raise ValueError(
+                        'The dataset \'%s\' in %s has shape %s and dtype %s, but %s in %s'
+                        % (name, path, dataset.shape, dataset.dtype, shape, dtype)
+                    )
+                if dataset.size:
+                    # Read straight into the stack without an intermediate copy:
+                    dataset.read_direct(stack, dest_sel=s_[i])
+        self._map_runs(read, progress)
+        return stack
+
     def get_trace(self,*args):
-        return {path:run.get_trace(*args) for path,run in self.runs.items()}
+        return dict(zip(self.run_paths, self._map_runs(lambda i, path: self.runs[path].get_trace(*args))))
         
     def get_result_array(self,*args):
-        return {path:run.get_result_array(*args) for path,run in self.runs.items()}
+        return dict(zip(self.run_paths, self._map_runs(lambda i, path: self.runs[path].get_result_array(*args))))
          
-    def get_traces(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')
+    def get_traces(self, *names, **kwargs):
+        """Return [t1, values1, t2, values2, ...] for the traces with the given
+        names, each an array of shape (n_shots, n_points) in the order of the
+        shots. A callable progress(n_done, n_total) may be passed as a keyword
+        argument, and is called as each shot is read."""
+        progress = kwargs.pop('progress', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % ', '.join(kwargs))
+        traces = []
+        for name in names:
+            stack = self._stack_dataset('data/traces/' + name, progress)
+            traces.append(stack['t'].astype(float))
+            traces.append(stack['values'].astype(float))
+        return traces
              
-    def get_result_arrays(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')
+    def get_result_arrays(self, group, *names, **kwargs):
+        """Return a list of the result arrays with the given names in the given
+        group, each stacked into an array of shape (n_shots,) + the array's shape
+        in the order of the shots. A callable progress(n_done, n_total) may be
+        passed as a keyword argument, and is called as each shot is read."""
+        progress = kwargs.pop('progress', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' % ', '.join(kwargs))
+        return [self._stack_dataset('results/%s/%s' % (group, name), progress) for name in names]
      
-    def get_image(self,*args):
-        raise NotImplementedError('If you want to use this feature please ask me to implement it! -Chris')     
+    def get_image(self, orientation, label, image, progress=None):
+        """Return the given image from every shot, as an array of shape
+        (n_shots,) + the image's shape, in the order of the shots. progress, if
+        given, is called as progress(n_done, n_total) as each shot is read."""
+        return self._stack_dataset('images/%s/%s/%s' % (orientation, label, image), progress)
 
 
 def figure_to_clipboard(figure=None, **kwargs):
@@ -520,3 +952,47 @@ def delay_results_return():
             """
         sys.stderr.write(dedent(msg))
     _delay_flag = True
+
+def depends_on(*routines):
+    """Declare which other single-shot routines the calling routine uses the results
+    of, so that lyse can run it at the same time as the routines it does not depend
+    on. Routines are given by filename or filepath, or by the name of the results
+    group they save to, which is the filename without the .py extension.
+    depends_on() with no arguments declares that the routine depends on no other
+    routines.
+
+    Routines that do not call depends_on() are assumed to depend on all routines
+    above them in the routine box, and run after all of them, as do all routines
+    when nothing is declared. Routines only ever run after routines above them, so
+    any named routines that are below the calling routine are ignored. lyse takes
+    into account what was declared when the routine last ran, so a declaration
+    takes effect from the next shot."""
+    global _depends_on
+    if not spinning_top:
+        msg = """Warning: lyse.depends_on has no effect on scripts not run with
+            the lyse GUI.
+            """
+        sys.stderr.write(dedent(msg))
+    _depends_on = [os.path.basename(routine).split('.py')[0] for routine in routines]
+
+def analyse_in_batches(max_shots=100):
+    """Declare that the calling single-shot routine can analyse more than one shot
+    per run. When shots are waiting to be analysed by the routine, lyse then runs it
+    once on up to max_shots of them, which are given in lyse.paths in the order they
+    were received, with lyse.path being the last of them. This saves the overhead of
+    running the routine once per shot, and lets it process the shots together, for
+    example as a stack of images with numpy. Results saved with Run.save_result()
+    are sent back to lyse for each shot as usual, but if the routine raises an
+    exception, analysis of all the shots in the batch is considered to have failed.
+
+    Routines should therefore loop over lyse.paths rather than using lyse.path.
+    Like depends_on(), the declaration takes effect from the next run."""
+    global _max_batch_size
+    if not spinning_top:
+        msg = """Warning: lyse.analyse_in_batches has no effect on scripts not run
+            with the lyse GUI.
+            """
+        sys.stderr.write(dedent(msg))
+    if max_shots < 1:
+        raise ValueError('max_shots must be at least 1')
+    _max_batch_size = int(max_shots)
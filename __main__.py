@@ -26,6 +26,8 @@ import time
 import traceback
 import pprint
 import ast
+import itertools
+import multiprocessing
 
 # 3rd party imports:
 splash.update_text('importing numpy')
@@ -42,21 +44,25 @@ check_version('qtutils', '2.2.2', '3.0.0')
 splash.update_text('importing labscript suite modules')
 check_version('labscript_utils', '2.12.4', '3')
 
-from labscript_utils.ls_zprocess import ZMQServer, ProcessTree
+from labscript_utils.ls_zprocess import ProcessTree
 import zprocess
 from labscript_utils.labconfig import LabConfig, config_prefix
 from labscript_utils.setup_logging import setup_logging
 from labscript_utils.qtwidgets.headerview_with_widgets import HorizontalHeaderViewWithWidgets
 from labscript_utils.qtwidgets.outputbox import OutputBox
-import labscript_utils.shared_drive as shared_drive
 
-from lyse.dataframe_utilities import (concat_with_padding,
-                                      get_dataframe_from_shot,
-                                      replace_with_padding)
+from lyse.dataframe_utilities import (ColumnStore,
+                                      dataframe_to_flat_dicts,
+                                      flat_dict_to_flat_series)
+from lyse.shot_cache import ShotReader
+from lyse.multishot_scheduler import MultishotScheduler
+from lyse.routine_chain import run_routines, ReplicaPool
+from lyse import memoization
+from lyse.server import WebServer
 
 from qtutils.qt import QtCore, QtGui, QtWidgets
 from qtutils.qt.QtCore import pyqtSignal as Signal
-from qtutils import inmain_decorator, inmain, UiLoader, DisconnectContextManager
+from qtutils import inmain_decorator, inmain, inmain_later, UiLoader, DisconnectContextManager
 from qtutils.auto_scroll_to_end import set_auto_scroll_to_end
 import qtutils.icons
 
@@ -178,38 +184,6 @@ def get_screen_geometry():
     return geoms
 
 
-class WebServer(ZMQServer):
-
-    def handler(self, request_data):
-        logger.info('WebServer request: %s' % str(request_data))
-        if request_data == 'hello':
-            return 'hello'
-        elif request_data == 'get dataframe':
-            # infer_objects() picks fixed datatypes for columns that are compatible with
-            # fixed datatypes, dramatically speeding up pickling. It is called here
-            # rather than when updating the dataframe as calling it during updating may
-            # call it needlessly often, whereas it only needs to be called prior to
-            # sending the dataframe to a client requesting it, as we're doing now.
-            app.filebox.shots_model.infer_objects()
-            return app.filebox.shots_model.dataframe
-        elif isinstance(request_data, dict):
-            if 'filepath' in request_data:
-                h5_filepath = shared_drive.path_to_local(request_data['filepath'])
-                if isinstance(h5_filepath, bytes):
-                    h5_filepath = h5_filepath.decode('utf8')
-                if not isinstance(h5_filepath, str):
-                    raise AssertionError(str(type(h5_filepath)) + ' is not str or bytes')
-                app.filebox.incoming_queue.put(h5_filepath)
-                return 'added successfully'
-        elif isinstance(request_data, str):
-            # Just assume it's a filepath:
-            app.filebox.incoming_queue.put(shared_drive.path_to_local(request_data))
-            return "Experiment added successfully\n"
-
-        return ("error: operation not supported. Recognised requests are:\n "
-                "'get dataframe'\n 'hello'\n {'filepath': <some_h5_filepath>}")
-
-
 class LyseMainWindow(QtWidgets.QMainWindow):
     # A signal to show that the window is shown and painted.
     firstPaint = Signal()
@@ -253,9 +227,11 @@ class LyseMainWindow(QtWidgets.QMainWindow):
 
 class AnalysisRoutine(object):
 
-    def __init__(self, filepath, model, output_box_port, checked=QtCore.Qt.Checked):
+    def __init__(self, filepath, model, output_box_port, checked=QtCore.Qt.Checked, n_replicas=1):
         self.filepath = filepath
         self.shortname = os.path.basename(self.filepath)
+        # The name of the group in shot files the routine saves results to:
+        self.results_group = self.shortname.split('.py')[0]
         self.model = model
         self.output_box_port = output_box_port
         
@@ -266,8 +242,21 @@ class AnalysisRoutine(object):
         
         self.error = False
         self.done = False
-        
-        self.to_worker, self.from_worker, self.worker = self.start_worker()
+
+        # Information about the worker sent with the results of each run:
+        self.worker_info = {}
+
+        # The routine runs in one or more worker processes ('replicas'), each of
+        # which can analyse a different shot at the same time. Only replica 0 shows
+        # plots. Worker handles, and what each replica is doing, by replica number:
+        self.workers = {}
+        self.replica_status = {}
+        # Which replicas are free, and the shots waiting for one:
+        self.replicas = ReplicaPool(self.run_batch, lambda: self.max_batch_size)
+        # Workers that have been told to quit but may not have exited yet. Their
+        # replica numbers may be reused by new workers in the meantime:
+        self.stopping_workers = []
+        self.set_n_replicas(n_replicas)
         
         # Make a row to put into the model:
         active_item =  QtGui.QStandardItem()
@@ -281,7 +270,7 @@ class AnalysisRoutine(object):
             
         self.exiting = False
         
-    def start_worker(self):
+    def start_worker(self, replica=0):
         # Start a worker process for this analysis routine:
         worker_path = os.path.join(LYSE_DIR, 'analysis_subprocess.py')
 
@@ -292,45 +281,133 @@ class AnalysisRoutine(object):
         )
         
         to_worker, from_worker, worker = child_handles
-        # Tell the worker what script it with be executing:
-        to_worker.put(self.filepath)
+        # Tell the worker what script it with be executing, and whether it should
+        # show plots:
+        to_worker.put([self.filepath, {'show_plots': replica == 0}])
         return to_worker, from_worker, worker
-        
-    def do_analysis(self, filepath):
-        self.to_worker.put(['analyse', filepath])
-        signal, data = self.from_worker.get()
-        if signal == 'error':
-            return False, data
-        elif signal == 'done':
-            return True, data
-        else:
+
+    def set_n_replicas(self, n_replicas):
+        """Set how many worker processes the routine runs in. New workers are
+        started immediately, surplus ones are stopped once they finish any analysis
+        they are running."""
+        with self.replicas.condition:
+            new_replicas = []
+            for replica in range(n_replicas):
+                if replica in self.workers and self.workers[replica][2] not in self.stopping_workers:
+                    # Still running:
+                    continue
+                # Either never started, or a surplus replica that is exiting:
+                self.workers[replica] = self.start_worker(replica)
+                self.replica_status[replica] = ('idle', None)
+                new_replicas.append(replica)
+            idle_surplus = self.replicas.set_n_replicas(n_replicas, new_replicas)
+        for replica in idle_surplus:
+            self.end_replica(replica)
+
+    def release_replica(self, replica):
+        if not self.replicas.release(replica):
+            inmain_later(self.end_replica, replica)
+
+    @property
+    def n_replicas(self):
+        """The number of worker processes the routine runs in"""
+        return self.replicas.n_replicas
+
+    @property
+    def max_batch_size(self):
+        """How many shots the routine may be given at once, as declared with
+        lyse.analyse_in_batches() when it last ran"""
+        return self.worker_info.get('max_batch_size') or 1
+
+    def do_analysis(self, filepath, shot_number=0):
+        """Run the routine on a shot, and return (success, updated_data). shot_number
+        is the order in which the shot was sent for analysis, and of the shots
+        waiting for a free worker, the earliest is analysed first. If the routine
+        analyses shots in batches, the shots waiting are analysed along with it, and
+        the results for each returned to the threads waiting on them."""
+        return self.replicas.run(filepath, shot_number)
+
+    def run_batch(self, replica, filepaths):
+        """Run the routine in the given replica on a list of shots, and return a
+        list of (success, updated_data) for each. A single shot is sent to the
+        worker on its own, more than one as a list."""
+        to_worker, from_worker, _ = self.workers[replica]
+        self.set_status('working', replica, filepaths)
+        try:
+            to_worker.put(['analyse', filepaths[0] if len(filepaths) == 1 else filepaths])
+            message = from_worker.get()
+        finally:
+            self.release_replica(replica)
+        signal, data = message[:2]
+        if len(message) > 2:
+            self.worker_info = message[2]
+        if signal not in ('done', 'error'):
             raise ValueError('invalid signal %s'%str(signal))
+        success = signal == 'done'
+        self.set_status(signal, replica, filepaths)
+        if len(filepaths) == 1:
+            return [(success, data)]
+        # Split the results by shot. Results saved to files other than the shots in
+        # the batch go with the last shot:
+        updated_data = dict((filepath, {}) for filepath in filepaths)
+        for file in data:
+            shot = file if file in updated_data else filepaths[-1]
+            updated_data[shot][file] = data[file]
+        return [(success, updated_data[filepath]) for filepath in filepaths]
+
+    def busy(self):
+        """Whether any replica is running analysis"""
+        return any(status == 'working' for status, _ in self.replica_status.values())
         
     @inmain_decorator()
-    def set_status(self, status):
+    def set_status(self, status, replica=None, filepaths=None):
+        """Set the status of a replica (if given) and the shots it is analysing,
+        and update the status shown for the routine. The icon shows that the
+        routine is working if any replica is, otherwise the result of the last
+        analysis. If status is None, the status shown is only refreshed."""
+        if replica is not None and replica in self.replica_status:
+            self.replica_status[replica] = (status, filepaths)
         index = self.get_row_index()
         if index is None:
             # Yelp, we've just been deleted. Nothing to do here.
             return
         status_item = self.model.item(index, self.COL_STATUS)
         if status == 'done':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/tick'))
             self.done = True
             self.error = False
-        elif status == 'working':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/hourglass'))
-            self.done = False
-            self.error = False
         elif status == 'error':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/exclamation'))
             self.error = True
             self.done = False
-        elif status == 'clear':
-            status_item.setData(None, QtCore.Qt.DecorationRole)
+        elif status == 'clear' or status == 'working':
             self.done = False
             self.error = False
-        else:
+        elif status is not None:
             raise ValueError(status)
+        if self.busy():
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/hourglass'))
+        elif self.done:
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/tick'))
+        elif self.error:
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/exclamation'))
+        else:
+            status_item.setData(None, QtCore.Qt.DecorationRole)
+        if len(self.replica_status) > 1:
+            n_busy = len([s for s, _ in self.replica_status.values() if s == 'working'])
+            status_item.setText('%d/%d' % (n_busy, len(self.replica_status)))
+        else:
+            status_item.setText('')
+        tooltip_lines = []
+        for replica, (replica_status, replica_filepaths) in sorted(self.replica_status.items()):
+            line = 'worker %d%s: %s' % (replica, ' (plots)' if replica == 0 else '', replica_status)
+            if replica_filepaths:
+                line += ' %s' % os.path.basename(replica_filepaths[0])
+                if len(replica_filepaths) > 1:
+                    line += ' and %d more' % (len(replica_filepaths) - 1)
+            tooltip_lines.append(line)
+        if 'compile_cache_hits' in self.worker_info:
+            tooltip_lines.append('compiled code reused %d times, compiled %d times' % (
+                self.worker_info['compile_cache_hits'], self.worker_info['compile_cache_misses']))
+        status_item.setToolTip('\n'.join(tooltip_lines))
         
     @inmain_decorator()
     def enabled(self):
@@ -363,17 +440,27 @@ class AnalysisRoutine(object):
         self.model.removeRow(index)
          
     def end_child(self, restart=False):
-        self.to_worker.put(['quit', None])
+        if not restart:
+            # No more analysis can be run:
+            self.replicas.end()
+        for replica in list(self.workers):
+            self.end_replica(replica, restart=restart)
+
+    def end_replica(self, replica, restart=False):
+        to_worker, from_worker, worker = self.workers[replica]
+        if not restart:
+            self.stopping_workers.append(worker)
+        to_worker.put(['quit', None])
         timeout_time = time.time() + 2
         self.exiting = True
         QtCore.QTimer.singleShot(50,
-            lambda: self.check_child_exited(self.worker, timeout_time, kill=False, restart=restart))
+            lambda: self.check_child_exited(replica, worker, from_worker, timeout_time, kill=False, restart=restart))
 
-    def check_child_exited(self, worker, timeout_time, kill=False, restart=False):
+    def check_child_exited(self, replica, worker, from_worker, timeout_time, kill=False, restart=False):
         worker.poll()
         if worker.returncode is None and time.time() < timeout_time:
             QtCore.QTimer.singleShot(50,
-                lambda: self.check_child_exited(worker, timeout_time, kill, restart))
+                lambda: self.check_child_exited(replica, worker, from_worker, timeout_time, kill, restart))
             return
         elif worker.returncode is None:
             if not kill:
@@ -381,7 +468,7 @@ class AnalysisRoutine(object):
                 app.output_box.output('%s worker not responding.\n'%self.shortname)
                 timeout_time = time.time() + 2
                 QtCore.QTimer.singleShot(50,
-                    lambda: self.check_child_exited(worker, timeout_time, kill=True, restart=restart))
+                    lambda: self.check_child_exited(replica, worker, from_worker, timeout_time, kill=True, restart=restart))
                 return
             else:
                 worker.kill()
@@ -390,13 +477,22 @@ class AnalysisRoutine(object):
             app.output_box.output('%s worker terminated\n'%self.shortname, red=True)
         else:
             app.output_box.output('%s worker exited cleanly\n'%self.shortname)
-        
-        # if analysis was running notify analysisloop that analysis has failed
-        self.from_worker.put(('error', {}))
 
         if restart:
-            self.to_worker, self.from_worker, self.worker = self.start_worker()
+            # Replace the worker before notifying of the failure below, so that
+            # analysis run once this replica is free again uses the new worker:
+            self.workers[replica] = self.start_worker(replica)
             app.output_box.output('%s worker restarted\n'%self.shortname)
+        else:
+            self.stopping_workers.remove(worker)
+            if self.workers.get(replica, (None,) * 3)[2] is worker:
+                # Not replaced by a new worker in the meantime:
+                del self.workers[replica]
+                del self.replica_status[replica]
+                self.set_status(None)
+
+        # if analysis was running notify analysisloop that analysis has failed
+        from_worker.put(('error', {}))
         self.exiting = False
 
 
@@ -467,6 +563,14 @@ class RoutineBox(object):
         self.from_filebox = from_filebox
         self.to_filebox = to_filebox
         self.output_box_port = output_box_port
+
+        # Results saved by routines during the current run of do_analysis, by shot
+        # filepath. These may not have reached the dataframe yet when a later routine
+        # calls lyse.data(filepath), so they are provided to it from here:
+        self.updated_data = {}
+        self.updated_data_lock = threading.Lock()
+        # For numbering shots in the order they are received:
+        self.shot_numbers = itertools.count()
         
         self.logger = logging.getLogger('lyse.RoutineBox.%s'%('multishot' if multishot else 'singleshot'))  
         
@@ -516,6 +620,9 @@ class RoutineBox(object):
             QtGui.QIcon(':qtutils/fugue/ui-check-box-uncheck'), 'set selected routines inactive',  self.ui)
         self.action_restart_selected = QtWidgets.QAction(
             QtGui.QIcon(':qtutils/fugue/arrow-circle'), 'restart worker process for selected routines',  self.ui)
+        self.action_set_n_replicas_selected = QtWidgets.QAction(
+            QtGui.QIcon(':qtutils/fugue/applications-stack'),
+            'set number of worker processes for selected routines', self.ui)
         self.action_remove_selected = QtWidgets.QAction(
             QtGui.QIcon(':qtutils/fugue/minus'), 'Remove selected routines',  self.ui)
         self.last_opened_routine_folder = self.exp_config.get('paths', 'analysislib')
@@ -545,6 +652,7 @@ class RoutineBox(object):
         self.action_set_selected_inactive.triggered.connect(
             lambda: self.on_set_selected_triggered(QtCore.Qt.Unchecked))
         self.action_restart_selected.triggered.connect(self.on_restart_selected_triggered)
+        self.action_set_n_replicas_selected.triggered.connect(self.on_set_n_replicas_selected_triggered)
         self.action_remove_selected.triggered.connect(self.on_remove_selection)
         self.ui.toolButton_move_to_top.clicked.connect(self.on_move_to_top_clicked)
         self.ui.toolButton_move_up.clicked.connect(self.on_move_up_clicked)
@@ -572,7 +680,8 @@ class RoutineBox(object):
     def add_routines(self, routine_files, clear_existing=False):
         """Add routines to the routine box, where routine_files is a list of
         tuples containing the filepath and whether the routine is enabled or
-        not when it is added. if clear_existing == True, then any existing
+        not when it is added, and optionally the number of worker processes to
+        run it in. if clear_existing == True, then any existing
         analysis routines will be cleared before the new ones are added."""
         if clear_existing:
             for routine in self.routines[:]:
@@ -580,11 +689,16 @@ class RoutineBox(object):
                 self.routines.remove(routine)
 
         # Queue the files to be opened:
-        for filepath, checked in routine_files:
+        for routine_file in routine_files:
+            filepath, checked = routine_file[:2]
+            n_replicas = routine_file[2] if len(routine_file) > 2 else 1
             if filepath in [routine.filepath for routine in self.routines]:
                 app.output_box.output('Warning: Ignoring duplicate analysis routine %s\n'%filepath, red=True)
                 continue
-            routine = AnalysisRoutine(filepath, self.model, self.output_box_port, checked)
+            if self.multishot:
+                # Multishot routines run once at a time, so more workers are no use:
+                n_replicas = 1
+            routine = AnalysisRoutine(filepath, self.model, self.output_box_port, checked, n_replicas)
             self.routines.append(routine)
         self.update_select_all_checkstate()
         
@@ -650,6 +764,8 @@ class RoutineBox(object):
         menu.addAction(self.action_set_selected_active)
         menu.addAction(self.action_set_selected_inactive)
         menu.addAction(self.action_restart_selected)
+        if not self.multishot:
+            menu.addAction(self.action_set_n_replicas_selected)
         menu.addAction(self.action_remove_selected)
         menu.exec_(QtGui.QCursor.pos())
         
@@ -729,6 +845,28 @@ class RoutineBox(object):
                 i_unselected += 1
         self.reorder(order)
         
+    def on_set_n_replicas_selected_triggered(self):
+        selected_indexes = self.ui.treeView.selectedIndexes()
+        selected_rows = set(index.row() for index in selected_indexes)
+        filepaths = [self.model.item(row, self.COL_NAME).data(self.ROLE_FULLPATH) for row in selected_rows]
+        routines = [routine for routine in self.routines if routine.filepath in filepaths]
+        if not routines:
+            return
+        n_replicas, ok = QtWidgets.QInputDialog.getInt(
+            self.ui,
+            'Set number of worker processes',
+            'Number of worker processes for each selected routine.\n'
+            'Different shots are analysed in each. Only the first shows plots.',
+            routines[0].n_replicas,
+            1,
+            max(multiprocessing.cpu_count(), 1),
+        )
+        if not ok:
+            return
+        for routine in routines:
+            routine.set_n_replicas(n_replicas)
+            routine.set_status(None)
+
     def on_restart_selected_triggered(self):
         selected_indexes = self.ui.treeView.selectedIndexes()
         selected_rows = set(index.row() for index in selected_indexes)
@@ -747,56 +885,73 @@ class RoutineBox(object):
                 # TODO: get the filepath of the output h5 file: 
                 # filepath = self.filechooserentry.get_text()
             self.logger.info('got a file to process: %s'%filepath)
-            self.do_analysis(filepath)
+            if self.multishot:
+                self.do_analysis(filepath)
+            else:
+                # The FileBox may send more shots before this one is done. These
+                # are analysed at the same time, each routine taking the next shot
+                # that is done with all routines it depends on as soon as one of
+                # its workers is free:
+                shot_number = next(self.shot_numbers)
+                thread = threading.Thread(target=self.do_analysis, args=(filepath, shot_number))
+                thread.daemon = True
+                thread.start()
+
+    @inmain_decorator()
+    def max_shots_in_flight(self):
+        """How many shots can usefully be analysed at once. This is the total
+        number of worker processes of the enabled routines, since then every worker
+        can be kept busy with a different shot, or batch of shots for routines that
+        analyse shots in batches."""
+        return max(sum(r.n_replicas * r.max_batch_size for r in self.routines if r.enabled()), 1)
     
     def todo(self):
         """How many analysis routines are not done?"""
         return len([r for r in self.routines if r.enabled() and not r.done])
-        
-    def do_analysis(self, filepath):
-        """Run all analysis routines once on the given filepath,
-        which is a shot file if we are a singleshot routine box"""
+
+    def do_analysis(self, filepath, shot_number=0):
+        """Run all analysis routines once on the given filepath, which is a shot
+        file if we are a singleshot routine box. Each routine runs as soon as all
+        routines it depends on are done, so routines that do not depend on each
+        other run at the same time. shot_number is the order in which the shot was
+        received, routines with other shots waiting to be analysed take the earliest
+        first."""
         for routine in self.routines:
-            routine.set_status('clear')
-        remaining = self.todo()
-        error = False
-        updated_data = {}
-        while remaining:
-            self.logger.debug('%d routines left to do'%remaining)
-            for routine in self.routines:
-                if routine.enabled() and not routine.done:
-                    break
-            else:
-                routine = None
-            if routine is not None:
-                self.logger.info('running analysis routine %s'%routine.shortname)
-                routine.set_status('working')
-                success, updated_data = routine.do_analysis(filepath)
-                if success:
-                    routine.set_status('done')
-                    self.logger.debug('success')
-                else:
-                    routine.set_status('error')
-                    self.logger.debug('failure')
-                    error = True
-                    break
-            # Race conditions here, but it's only for reporting percent done
-            # so it doesn't matter if it's wrong briefly:
-            remaining = self.todo()
-            total = len([r for r in self.routines if r.enabled()])
-            done = total - remaining
-            try:
-                status_percent = 100*float(done)/(remaining + done)
-            except ZeroDivisionError:
-                # All routines got deleted mid-analysis, we're done here:
-                status_percent = 100.0
-            self.to_filebox.put(['progress', status_percent, updated_data])
-        if error:
-            self.to_filebox.put(['error', None, updated_data])
+            if not routine.busy():
+                routine.set_status('clear')
+        routines = [r for r in self.routines if r.enabled()]
+
+        def run_routine(routine):
+            self.logger.info('running analysis routine %s'%routine.shortname)
+            return routine.do_analysis(filepath, shot_number)
+
+        def on_result(routine, success, updated_data, n_done):
+            with self.updated_data_lock:
+                for file in updated_data:
+                    self.updated_data.setdefault(file, {}).update(updated_data[file])
+            self.logger.debug('success' if success else 'failure')
+            self.logger.debug('%d routines left to do'%(len(routines) - n_done))
+            status_percent = 100*float(n_done)/len(routines)
+            self.to_filebox.put(['progress', filepath, status_percent, updated_data])
+
+        if run_routines(routines, run_routine, on_result):
+            self.to_filebox.put(['done', filepath, 100.0, {}])
         else:
-            self.to_filebox.put(['done', 100.0, {}])
+            self.to_filebox.put(['error', filepath, None, {}])
         self.logger.debug('completed analysis of %s'%filepath)
             
+    def get_updated_data(self, filepath):
+        """Return a dict of the results saved to the given shot by routines during
+        the current analysis run, keyed by (group, name)"""
+        with self.updated_data_lock:
+            return dict(self.updated_data.get(filepath, {}))
+
+    def discard_updated_data(self, filepaths):
+        """Forget results saved to the given shots, once they are in the dataframe"""
+        with self.updated_data_lock:
+            for filepath in filepaths:
+                self.updated_data.pop(filepath, None)
+
     def reorder(self, order):
         assert len(order) == len(set(order)), 'ordering contains non-unique elements'
         # Apply the reordering to the liststore:
@@ -1152,6 +1307,157 @@ class TableView(QtWidgets.QTableView):
         return result
         
         
+class ShotsTableModel(QtCore.QAbstractTableModel):
+    """A Qt table model that reads the values it displays from the column store of a
+    DataFrameModel on demand, rather than holding a QStandardItem for every cell.
+    Only the cells Qt asks for - the visible ones - are formatted, and their
+    display strings are cached until their row or the columns change. The only
+    per-row state held here is the analysis status of each shot."""
+
+    # Display strings are cached for at most this many rows:
+    MAX_CACHED_ROWS = 1000
+
+    def __init__(self, dataframe_model):
+        QtCore.QAbstractTableModel.__init__(self)
+        self.dataframe_model = dataframe_model
+        self.COL_STATUS = dataframe_model.COL_STATUS
+        self.COL_FILEPATH = dataframe_model.COL_FILEPATH
+        self.ROLE_STATUS_PERCENT = dataframe_model.ROLE_STATUS_PERCENT
+        self.ROLE_DELETED_OFF_DISK = dataframe_model.ROLE_DELETED_OFF_DISK
+
+        # The status of each row:
+        self.status_percent = []
+        self.deleted_off_disk = []
+
+        # Display strings by row and column number:
+        self._display_cache = {}
+
+        self._status_header_icon = QtGui.QIcon(':qtutils/fugue/information')
+        self._done_icon = QtGui.QIcon(':qtutils/fugue/tick')
+        self._deleted_off_disk_icon = QtGui.QIcon(':qtutils/fugue/drive--minus')
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.status_percent)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.dataframe_model.column_names)
+
+    def flags(self, index):
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def value(self, row, column):
+        column_name = self.dataframe_model.column_names[column]
+        return self.dataframe_model.column_store.get_value(row, column_name)
+
+    def display_text(self, row, column):
+        try:
+            return self._display_cache[row][column]
+        except KeyError:
+            pass
+        value = self.value(row, column)
+        if column == self.COL_FILEPATH:
+            text = value
+        else:
+            if isinstance(value, float):
+                value_str = scientific_notation(value)
+            else:
+                value_str = str(value)
+            lines = value_str.splitlines()
+            if len(lines) > 1:
+                text = lines[0] + ' ...'
+            else:
+                text = value_str
+        if row not in self._display_cache and len(self._display_cache) >= self.MAX_CACHED_ROWS:
+            self._display_cache.clear()
+        self._display_cache.setdefault(row, {})[column] = text
+        return text
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        column = index.column()
+        if column == self.COL_STATUS:
+            if role == self.ROLE_STATUS_PERCENT:
+                return self.status_percent[row]
+            elif role == self.ROLE_DELETED_OFF_DISK:
+                return self.deleted_off_disk[row]
+            elif role == QtCore.Qt.DecorationRole:
+                # Only displayed once analysis is complete, otherwise the item
+                # delegate draws a progress bar instead:
+                if self.deleted_off_disk[row]:
+                    return self._deleted_off_disk_icon
+                return self._done_icon
+            elif role == QtCore.Qt.ToolTipRole and self.deleted_off_disk[row]:
+                return "Shot has been deleted off disk or is unreadable"
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.display_text(row, column)
+        if column == self.COL_FILEPATH:
+            return None
+        if role == QtCore.Qt.ToolTipRole:
+            return repr(self.value(row, column))
+        elif role == QtCore.Qt.TextAlignmentRole:
+            return QtCore.Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Vertical:
+            if role == QtCore.Qt.DisplayRole and 0 <= section < self.rowCount():
+                return self.dataframe_model.vertical_header_text(section)
+            return None
+        if section == self.COL_STATUS:
+            if role == QtCore.Qt.DecorationRole:
+                return self._status_header_icon
+            elif role == QtCore.Qt.ToolTipRole:
+                return 'status/progress of single-shot analysis'
+            return None
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.ToolTipRole):
+            try:
+                column_name = self.dataframe_model.column_names[section]
+            except KeyError:
+                return None
+            if section == self.COL_FILEPATH:
+                return 'filepath'
+            return '\n'.join(column_name).strip()
+        return None
+
+    def append_rows(self, n_rows, status_percent):
+        first_row = self.rowCount()
+        self.beginInsertRows(QtCore.QModelIndex(), first_row, first_row + n_rows - 1)
+        self.status_percent.extend([status_percent] * n_rows)
+        self.deleted_off_disk.extend([False] * n_rows)
+        self.endInsertRows()
+
+    def remove_rows(self, rows):
+        rows = set(rows)
+        self.beginResetModel()
+        self.status_percent = [s for i, s in enumerate(self.status_percent) if i not in rows]
+        self.deleted_off_disk = [d for i, d in enumerate(self.deleted_off_disk) if i not in rows]
+        self._display_cache.clear()
+        self.endResetModel()
+
+    def set_status(self, row, status_percent=None, deleted_off_disk=None):
+        if status_percent is not None:
+            self.status_percent[row] = status_percent
+        if deleted_off_disk is not None:
+            self.deleted_off_disk[row] = deleted_off_disk
+        index = self.index(row, self.COL_STATUS)
+        self.dataChanged.emit(index, index)
+
+    def row_changed(self, row):
+        self._display_cache.pop(row, None)
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
+    def vertical_headers_changed(self):
+        if self.rowCount():
+            self.headerDataChanged.emit(QtCore.Qt.Vertical, 0, self.rowCount() - 1)
+
+
 class DataFrameModel(QtCore.QObject):
 
     COL_STATUS = 0
@@ -1166,11 +1472,30 @@ class DataFrameModel(QtCore.QObject):
         QtCore.QObject.__init__(self)
         self._view = view
         self.exp_config = exp_config
-        self._model = UneditableModel()
         self.row_number_by_filepath = {}
         self._previous_n_digits = 0
 
-        self._header = HorizontalHeaderViewWithWidgets(self._model)
+        # Check if integer indexing is to be used
+        try:
+            self.integer_indexing = self.exp_config.getboolean('lyse', 'integer_indexing')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.integer_indexing = False
+
+        # This will contain all the scalar data from the shot files that are
+        # currently open, from which a dataframe is produced when needed:
+        self.column_store = ColumnStore(columns=[('filepath',)])
+        # How many levels the dataframe's multiindex has:
+        self.nlevels = self.column_store.nlevels
+
+        # Column indices to names and vice versa for fast lookup:
+        self.column_indices = {'__status': self.COL_STATUS, ('filepath', ''): self.COL_FILEPATH}
+        self.column_names = {self.COL_STATUS: '__status', self.COL_FILEPATH: ('filepath', '')}
+        self.columns_visible = {self.COL_STATUS: True, self.COL_FILEPATH: True}
+
+        self._model = ShotsTableModel(self)
+
+        self._header = QtWidgets.QHeaderView(QtCore.Qt.Horizontal)
+        self._header.setSectionsClickable(True)
         self._vertheader = QtWidgets.QHeaderView(QtCore.Qt.Vertical)
         self._vertheader.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
 
@@ -1191,39 +1516,14 @@ class DataFrameModel(QtCore.QObject):
         self._view.setSelectionBehavior(QtWidgets.QTableView.SelectRows)
         self._view.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
 
-        # Check if integer indexing is to be used
-        try:
-            self.integer_indexing = self.exp_config.getboolean('lyse', 'integer_indexing')
-        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
-            self.integer_indexing = False
-
-        # This dataframe will contain all the scalar data
-        # from the shot files that are currently open:
-        index = pandas.MultiIndex.from_tuples([('filepath', '')])
-        self.dataframe = pandas.DataFrame({'filepath': []}, columns=index)
-        # How many levels the dataframe's multiindex has:
-        self.nlevels = self.dataframe.columns.nlevels
-
-        status_item = QtGui.QStandardItem()
-        status_item.setIcon(QtGui.QIcon(':qtutils/fugue/information'))
-        status_item.setToolTip('status/progress of single-shot analysis')
-        self._model.setHorizontalHeaderItem(self.COL_STATUS, status_item)
-
-        filepath_item = QtGui.QStandardItem('filepath')
-        filepath_item.setToolTip('filepath')
-        self._model.setHorizontalHeaderItem(self.COL_FILEPATH, filepath_item)
+        # All rows are the height the item delegate would give them, set here rather
+        # than by resizing each row to its contents as it is added:
+        fontmetrics = QtGui.QFontMetrics(self._view.font())
+        self._vertheader.setDefaultSectionSize(fontmetrics.height() + ItemDelegate.EXTRA_ROW_HEIGHT)
 
         self._view.setColumnWidth(self.COL_STATUS, 70)
         self._view.setColumnWidth(self.COL_FILEPATH, 100)
 
-        # Column indices to names and vice versa for fast lookup:
-        self.column_indices = {'__status': self.COL_STATUS, ('filepath', ''): self.COL_FILEPATH}
-        self.column_names = {self.COL_STATUS: '__status', self.COL_FILEPATH: ('filepath', '')}
-        self.columns_visible = {self.COL_STATUS: True, self.COL_FILEPATH: True}
-
-        # Whether or not a deleted column was visible at the time it was deleted (by name):
-        self.deleted_columns_visible = {}
-        
         # Make the actions for the context menu:
         self.action_remove_selected = QtWidgets.QAction(
             QtGui.QIcon(':qtutils/fugue/minus'), 'Remove selected shots',  self._view)
@@ -1239,40 +1539,42 @@ class DataFrameModel(QtCore.QObject):
 
     def remove_selection(self, confirm=True):
         selection_model = self._view.selectionModel()
-        selected_indexes = selection_model.selectedRows()
-        selected_name_items = [self._model.itemFromIndex(index) for index in selected_indexes]
-        if not selected_name_items:
+        selected_rows = sorted(set(index.row() for index in selection_model.selectedRows()))
+        if not selected_rows:
             return
-        if confirm and not question_dialog("Remove %d shots?" % len(selected_name_items)):
+        if confirm and not question_dialog("Remove %d shots?" % len(selected_rows)):
             return
         # Remove from DataFrame first:
-        self.dataframe = self.dataframe.drop(index.row() for index in selected_indexes)
-        self.dataframe.index = pandas.Index(range(len(self.dataframe)))
-        # Delete one at a time from Qt model:
-        for name_item in selected_name_items:
-            row = name_item.row()
-            self._model.removeRow(row)
+        self.column_store.remove_rows(selected_rows)
+        self._model.remove_rows(selected_rows)
         self.renumber_rows()
 
+    def get_selected_filepaths(self):
+        selected_rows = sorted(set(index.row() for index in self._view.selectedIndexes()))
+        return [self.column_store.get_value(row, 'filepath') for row in selected_rows]
+
     def mark_selection_not_done(self):
-        selected_indexes = self._view.selectedIndexes()
-        selected_rows = set(index.row() for index in selected_indexes)
-        for row in selected_rows:
-            status_item = self._model.item(row, self.COL_STATUS)
-            if status_item.data(self.ROLE_DELETED_OFF_DISK):
+        self.mark_not_done(self.get_selected_filepaths())
+
+    @inmain_decorator()
+    def mark_not_done(self, filepaths):
+        for filepath in filepaths:
+            try:
+                row = self.row_number_by_filepath[filepath]
+            except KeyError:
+                # Row has been deleted:
+                continue
+            if self._model.deleted_off_disk[row]:
                 # If the shot was previously not readable on disk, check to
                 # see if it's readable now. It may have been undeleted or
                 # perhaps it being unreadable before was due to a network
                 # glitch or similar.
-                filepath = self._model.item(row, self.COL_FILEPATH).text()
                 if not os.path.exists(filepath):
                     continue
                 # Shot file is accesible again:
-                status_item.setData(False, self.ROLE_DELETED_OFF_DISK)
-                status_item.setIcon(QtGui.QIcon(':qtutils/fugue/tick'))
-                status_item.setToolTip(None)
+                self._model.set_status(row, deleted_off_disk=False)
 
-            status_item.setData(0, self.ROLE_STATUS_PERCENT)
+            self._model.set_status(row, status_percent=0)
         
     def on_view_context_menu_requested(self, point):
         menu = QtWidgets.QMenu(self._view)
@@ -1280,8 +1582,7 @@ class DataFrameModel(QtCore.QObject):
         menu.exec_(QtGui.QCursor.pos())
 
     def on_double_click(self, index):
-        filepath_item = self._model.item(index.row(), self.COL_FILEPATH)
-        shot_filepath = filepath_item.text()
+        shot_filepath = self.column_store.get_value(index.row(), 'filepath')
         
         # get path to text editor
         viewer_path = self.exp_config.get('programs', 'hdf5_viewer')
@@ -1310,10 +1611,10 @@ class DataFrameModel(QtCore.QObject):
         """Pads the keys and values of our lists of column names so that
         they still match those in the dataframe after the number of
         levels in its multiindex has increased (the number of levels never
-        decreases, given the current implementation of concat_with_padding())"""
-        extra_levels = self.dataframe.columns.nlevels - self.nlevels
+        decreases, given the current implementation of ColumnStore)"""
+        extra_levels = self.column_store.nlevels - self.nlevels
         if extra_levels > 0:
-            self.nlevels = self.dataframe.columns.nlevels
+            self.nlevels = self.column_store.nlevels
             column_indices = {}
             column_names = {}
             for column_name in self.column_indices:
@@ -1328,44 +1629,82 @@ class DataFrameModel(QtCore.QObject):
             self.column_indices = column_indices
             self.column_names = column_names
 
+    def update_columns(self):
+        """Add columns to the Qt model for any columns in the column store it does not
+        yet have. The column store never removes columns, so neither do we."""
+        new_column_names = set(self.column_store.columns) - set(self.column_names.values())
+        if not new_column_names:
+            return
+        new_columns_start = self._model.columnCount()
+        new_columns_end = new_columns_start + len(new_column_names) - 1
+        self._model.beginInsertColumns(QtCore.QModelIndex(), new_columns_start, new_columns_end)
+        for i, column_name in enumerate(sorted(new_column_names)):
+            column_number = new_columns_start + i
+            self.column_names[column_number] = column_name
+            self.column_indices[column_name] = column_number
+            # new columns are visible by default:
+            self.columns_visible[column_number] = True
+        self._model.endInsertColumns()
+        for column_number in range(new_columns_start, new_columns_end + 1):
+            # Resize any new columns to fit contents:
+            self._view.resizeColumnToContents(column_number)
+        self.columns_changed.emit()
+
     @inmain_decorator()
     def mark_as_deleted_off_disk(self, filepath):
         # Confirm the shot hasn't been removed from lyse (we are in the main
         # thread so there is no race condition in checking first)
-        if not filepath in self.dataframe['filepath'].values:
+        if not filepath in self.row_number_by_filepath:
             # Shot has been removed from FileBox, nothing to do here:
             return
 
         row_number = self.row_number_by_filepath[filepath]
-        status_item = self._model.item(row_number, self.COL_STATUS)
-        already_marked_as_deleted = status_item.data(self.ROLE_DELETED_OFF_DISK)
-        if already_marked_as_deleted:
+        if self._model.deleted_off_disk[row_number]:
             return
         # Icon only displays if percent completion is 100. This is also
         # important so that the shot is not picked up as analysis
         # incomplete and analysis re-attempted on it.
-        status_item.setData(True, self.ROLE_DELETED_OFF_DISK)
-        status_item.setData(100, self.ROLE_STATUS_PERCENT)
-        status_item.setToolTip("Shot has been deleted off disk or is unreadable")
-        status_item.setIcon(QtGui.QIcon(':qtutils/fugue/drive--minus'))
+        self._model.set_status(row_number, status_percent=100, deleted_off_disk=True)
         app.output_box.output('Warning: Shot deleted from disk or no longer readable %s\n' % filepath, red=True)
 
+    @property
+    def dataframe(self):
+        """A dataframe of the data from all shots. It is produced from the column
+        store on first access after any change, so accessing it repeatedly is cheap
+        but accessing it between each change is not. Must only be accessed from the
+        main thread, other threads should call get_dataframe()."""
+        return self.column_store.dataframe()
+
+    def get_dataframe(self):
+        """As the dataframe property, but may be called from any thread"""
+        return self.column_store.dataframe()
+
+    def get_dataframe_update(self, since=None):
+        """Return the changes to the dataframe since the version since, as from
+        ColumnStore.get_update(). May be called from any thread, and the
+        dataframe is built in the calling thread."""
+        return self.column_store.get_update(since)
+
     @inmain_decorator()
-    def infer_objects(self):
-        """Convert columns in the dataframe with dtype 'object' into compatible, more
-        specific types, if possible. This improves pickling performance and ensures
-        multishot analysis code does not encounter columns with dtype 'object' for
-        non-mixed numerical data, which it might choke on.
-        """
-        self.dataframe = self.dataframe.infer_objects()
+    def get_series(self, filepath, updated_data=None):
+        """Return the data for a single shot as a flat Series, like that returned by
+        dataframe_utilities.get_series_from_shot(filepath), but from the data already
+        held in memory rather than by reading the shot file. Results in updated_data,
+        a dict keyed by (group, name), take precedence. Returns None if the shot is
+        not loaded."""
+        try:
+            row_number = self.row_number_by_filepath[filepath]
+        except KeyError:
+            return None
+        flat_dict = self.column_store.get_flat_dict(row_number)
+        if updated_data:
+            flat_dict.update(updated_data)
+        return flat_dict_to_flat_series(flat_dict)
 
     @inmain_decorator()
     def update_row(self, filepath, dataframe_already_updated=False, new_row_data=None, updated_row_data=None):
         """"Updates a row in the dataframe and Qt model to the data in the HDF5 file for
         that shot."""
-        # To speed things up block signals to the model during update
-        self._model.blockSignals(True)
-
         # Update the row in the dataframe first:
         if (new_row_data is None) == (updated_row_data is None) and not dataframe_already_updated:
             raise ValueError('Exactly one of new_row_data or updated_row_data must be provided')
@@ -1376,123 +1715,28 @@ class DataFrameModel(QtCore.QObject):
             # Row has been deleted, nothing to do here:
             return
 
-        filepath_colname = ('filepath',) + ('',) * (self.nlevels - 1)
-        assert filepath == self.dataframe.at[row_number, filepath_colname]
+        assert filepath == self.column_store.get_value(row_number, 'filepath')
 
         if updated_row_data is not None and not dataframe_already_updated:
             for group, name in updated_row_data:
-                column_name = (group, name) + ('',) * (self.nlevels - 2)
-                value = updated_row_data[group, name]
-                try:
-                    self.dataframe.at[row_number, column_name] = value
-                except ValueError:
-                    # did the column not already exist when we tried to set an iterable?
-                    if not column_name in self.dataframe.columns:
-                        # create it with a non-iterable and then overwrite with the iterable value:
-                        self.dataframe.at[row_number, column_name] = None
-                    else:
-                        # Incompatible datatype - convert the datatype of the column to
-                        # 'object'
-                        self.dataframe[column_name] = self.dataframe[column_name].astype('object')
-                    # Now that the column exists and has dtype object, we can set the value:
-                    self.dataframe.at[row_number, column_name] = value
-
+                # The column store holds values of any type, and adds the column if
+                # it does not already exist:
+                self.column_store.set_value(row_number, (group, name), updated_row_data[group, name])
+            self.update_column_levels()
             dataframe_already_updated = True
 
         if not dataframe_already_updated:
             if new_row_data is None:
                 raise ValueError("If dataframe_already_updated is False, then new_row_data, as returned "
-                                 "by dataframe_utils.get_dataframe_from_shot(filepath) must be provided.")
-            self.dataframe = replace_with_padding(self.dataframe, new_row_data, row_number)
+                                 "by dataframe_utils.get_flat_dict_from_shot(filepath) must be provided.")
+            self.column_store.replace_row(row_number, new_row_data)
             self.update_column_levels()
 
         # Check and create necessary new columns in the Qt model:
-        new_column_names = set(self.dataframe.columns) - set(self.column_names.values())
-        new_columns_start = self._model.columnCount()
-        self._model.insertColumns(new_columns_start, len(new_column_names))
-        for i, column_name in enumerate(sorted(new_column_names)):
-            # Set the header label of the new column:
-            column_number = new_columns_start + i
-            self.column_names[column_number] = column_name
-            self.column_indices[column_name] = column_number
-            if column_name in self.deleted_columns_visible:
-                # Restore the former visibility of this column if we've
-                # seen one with its name before:
-                visible = self.deleted_columns_visible[column_name]
-                self.columns_visible[column_number] = visible
-                self._view.setColumnHidden(column_number, not visible)
-            else:
-                # new columns are visible by default:
-                self.columns_visible[column_number] = True
-            column_name_as_string = '\n'.join(column_name).strip()
-            header_item = QtGui.QStandardItem(column_name_as_string)
-            header_item.setToolTip(column_name_as_string)
-            self._model.setHorizontalHeaderItem(column_number, header_item)
-
-        # Check and remove any no-longer-needed columns in the Qt model:
-        defunct_column_names = (set(self.column_names.values()) - set(self.dataframe.columns)
-                                - {self.column_names[self.COL_STATUS], self.column_names[self.COL_FILEPATH]})
-        defunct_column_indices = [self.column_indices[column_name] for column_name in defunct_column_names]
-        for column_number in sorted(defunct_column_indices, reverse=True):
-            # Remove columns from the Qt model. In reverse order so that
-            # removals do not change the position of columns yet to be
-            # removed.
-            self._model.removeColumn(column_number)
-            # Save whether or not the column was visible when it was
-            # removed (so that if it is re-added the visibility will be retained):
-            self.deleted_columns_visible[self.column_names[column_number]] = self.columns_visible[column_number]
-            del self.column_names[column_number]
-            del self.columns_visible[column_number]
-
-        if defunct_column_indices:
-            # Renumber the keys of self.columns_visible and self.column_names to reflect deletions:
-            self.column_names = {newindex: name for newindex, (oldindex, name) in enumerate(sorted(self.column_names.items()))}
-            self.columns_visible = {newindex: visible for newindex, (oldindex, visible) in enumerate(sorted(self.columns_visible.items()))}
-            # Update the inverse mapping of self.column_names:
-            self.column_indices = {name: index for index, name in self.column_names.items()}
-
-        # Update the data in the Qt model:
-        dataframe_row = self.dataframe.iloc[row_number].to_dict()
-        for column_number, column_name in self.column_names.items():
-            if not isinstance(column_name, tuple):
-                # One of our special columns, does not correspond to a column in the dataframe:
-                continue
-            if updated_row_data is not None:
-                # Must remove empty strings from tuple to compare with updated_row_data:
-                if tuple(s for s in column_name if s) not in updated_row_data:
-                    continue
-            value = dataframe_row[column_name]
-            if isinstance(value, float):
-                value_str = scientific_notation(value)
-            else:
-                value_str = str(value)
-            lines = value_str.splitlines()
-            if len(lines) > 1:
-                short_value_str = lines[0] + ' ...'
-            else:
-                short_value_str = value_str
-
-            item = self._model.item(row_number, column_number)
-            if item is None:
-                # This is the first time we've written a value to this part of the model:
-                item = QtGui.QStandardItem(short_value_str)
-                item.setData(QtCore.Qt.AlignCenter, QtCore.Qt.TextAlignmentRole)
-                self._model.setItem(row_number, column_number, item)
-            else:
-                item.setText(short_value_str)
-            item.setToolTip(repr(value))
-
-        for i, column_name in enumerate(sorted(new_column_names)):
-            # Resize any new columns to fit contents:
-            column_number = new_columns_start + i
-            self._view.resizeColumnToContents(column_number)
-
-        if new_column_names or defunct_column_names:
-            self.columns_changed.emit()
-
-        # unblock signals to the model and tell it to update
-        self._model.blockSignals(False)
-        self._model.layoutChanged.emit()
+        self.update_columns()
+        # Values are read from the column store when displayed, the Qt model only
+        # needs to know they have changed:
+        self._model.row_changed(row_number)
 
     @inmain_decorator()
     def set_status_percent(self, filepath, status_percent):
@@ -1501,112 +1745,114 @@ class DataFrameModel(QtCore.QObject):
         except KeyError:
             # Row has been deleted, nothing to do here:
             return
-        status_item = self._model.item(row_number, self.COL_STATUS)
-        status_item.setData(status_percent, self.ROLE_STATUS_PERCENT)
+        self._model.set_status(row_number, status_percent=status_percent)
 
-    def new_row(self, filepath, done=False):
-        status_item = QtGui.QStandardItem()
-        if done:
-            status_item.setData(100, self.ROLE_STATUS_PERCENT)
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/tick'))
+    def vertical_header_text(self, row_number):
+        """The text of the vertical header for a row, computed only when Qt asks for
+        it. Rows are numbered in simple sequential order for easy comparison with the
+        dataframe."""
+        n_digits = len(str(self._model.rowCount()))
+        row_number_str = str(row_number).rjust(n_digits)
+        vert_header_text = '{}. '.format(row_number_str)
+        if self.integer_indexing:
+            header_cols = ['sequence_index', 'run number', 'run repeat']
+            header_strings = []
+            for col in header_cols:
+                val = self.column_store.get_value(row_number, col)
+                if pandas.notna(val):
+                    header_strings.append('{:04d}'.format(val))
+                else:
+                    header_strings.append('----')
+            vert_header_text += ' | '.join(header_strings)
         else:
-            status_item.setData(0, self.ROLE_STATUS_PERCENT)
-        status_item.setIcon(QtGui.QIcon(':qtutils/fugue/tick'))
-        name_item = QtGui.QStandardItem(filepath)
-        return [status_item, name_item]
+            filepath = self.column_store.get_value(row_number, 'filepath')
+            basename = os.path.splitext(os.path.basename(filepath))[0]
+            vert_header_text += basename
+        return vert_header_text
 
     def renumber_rows(self, add_from=0):
-        """Add/update row indices - the rows are numbered in simple sequential
-        order for easy comparison with the dataframe. add_from allows you to
+        """Add/update the lookup of row numbers by filepath. add_from allows you to
         only add numbers for new rows from the given index as a performance
-        optimisation, though if the number of digits changes, all rows will
-        still be renumbered. add_from should not be used if rows have been
-        deleted."""
+        optimisation. add_from should not be used if rows have been deleted. If
+        the number of digits in the row numbers changes, the vertical header
+        labels are all updated."""
         n_digits = len(str(self._model.rowCount()))
         if n_digits != self._previous_n_digits:
             # All labels must be updated:
-            add_from = 0
+            self._model.vertical_headers_changed()
         self._previous_n_digits = n_digits
 
         if add_from == 0:
             self.row_number_by_filepath = {}
 
         for row_number in range(add_from, self._model.rowCount()):
-            vertical_header_item = self._model.verticalHeaderItem(row_number)
-            row_number_str = str(row_number).rjust(n_digits)
-            vert_header_text = '{}. '.format(row_number_str)
-            filepath_item = self._model.item(row_number, self.COL_FILEPATH)
-            filepath = filepath_item.text()
+            filepath = self.column_store.get_value(row_number, 'filepath')
             self.row_number_by_filepath[filepath] = row_number
-            if self.integer_indexing:
-                header_cols = ['sequence_index', 'run number', 'run repeat']
-                header_strings = []
-                for col in header_cols:
-                    val = self.dataframe[col].values[row_number]
-                    if pandas.notna(val):
-                        header_strings.append('{:04d}'.format(val))
-                    else:
-                        header_strings.append('----')
-                vert_header_text += ' | '.join(header_strings)
-            else:
-                basename = os.path.splitext(os.path.basename(filepath))[0]
-                vert_header_text += basename
-            vertical_header_item.setText(vert_header_text)
     
     @inmain_decorator()
     def add_files(self, filepaths, new_row_data, done=False):
-        """Add files to the dataframe model. New_row_data should be a
-        dataframe containing the new rows."""
+        """Add files to the dataframe model. new_row_data should be a list of
+        the data for each file, in the same order as filepaths, each a flat
+        dictionary as returned by dataframe_utilities.get_flat_dict_from_shot()."""
+
+        assert len(new_row_data) == len(filepaths)
 
         to_add = []
+        rows_to_add = []
 
         # Check for duplicates:
-        for filepath in filepaths:
+        for filepath, row in zip(filepaths, new_row_data):
             if filepath in self.row_number_by_filepath or filepath in to_add:
                 app.output_box.output('Warning: Ignoring duplicate shot %s\n' % filepath, red=True)
-                if new_row_data is not None:
-                    df_row_index = np.where(new_row_data['filepath'].values == filepath)
-                    new_row_data = new_row_data.drop(df_row_index[0])
-                    new_row_data.index = pandas.Index(range(len(new_row_data)))
             else:
                 to_add.append(filepath)
+                rows_to_add.append(row)
 
-        assert len(new_row_data) == len(to_add)
+        if not to_add:
+            return
 
-        if to_add:
-            # Update the dataframe:
-            self.dataframe = concat_with_padding(self.dataframe, new_row_data)
-            self.update_column_levels()
+        # Update the dataframe. Appending to the column store costs time
+        # proportional only to the amount of new data:
+        self.column_store.append_rows(rows_to_add)
+        self.update_column_levels()
 
         app.filebox.set_add_shots_progress(None, None, "updating filebox")
 
-        for filepath in to_add:
-            # Add the new rows to the Qt model:
-            self._model.appendRow(self.new_row(filepath, done=done))
-            vert_header_item = QtGui.QStandardItem('...loading...')
-            self._model.setVerticalHeaderItem(self._model.rowCount() - 1, vert_header_item)
-            self._view.resizeRowToContents(self._model.rowCount() - 1)
-
+        # Update the Qt model:
+        self._model.append_rows(len(to_add), 100 if done else 0)
         self.renumber_rows(add_from=self._model.rowCount()-len(to_add))
+        self.update_columns()
 
-        # Update the Qt model:
-        for filepath in to_add:
-            self.update_row(filepath, dataframe_already_updated=True)
-            
+    @inmain_decorator()
+    def get_sequence(self, filepath):
+        """Returns the value of the 'sequence' column for a shot, or None if the
+        shot is no longer in the model"""
+        try:
+            row_number = self.row_number_by_filepath[filepath]
+        except KeyError:
+            return None
+        try:
+            return self.column_store.get_value(row_number, 'sequence')
+        except KeyError:
+            # No shots with a sequence attribute:
+            return None
 
     @inmain_decorator()
-    def get_first_incomplete(self):
+    def get_first_incomplete(self, exclude=()):
         """Returns the filepath of the first shot in the model that has not
-        been analysed"""
-        for row in range(self._model.rowCount()):
-            status_item = self._model.item(row, self.COL_STATUS)
-            if status_item.data(self.ROLE_STATUS_PERCENT) != 100:
-                filepath_item = self._model.item(row, self.COL_FILEPATH)
-                return filepath_item.text()
+        been analysed, ignoring those in exclude"""
+        for row, status_percent in enumerate(self._model.status_percent):
+            if status_percent != 100:
+                filepath = self.column_store.get_value(row, 'filepath')
+                if filepath not in exclude:
+                    return filepath
         
         
 class FileBox(object):
 
+    # The most shots the incoming thread will read and add to the shots model at once:
+    INCOMING_BATCH_SIZE = 250
+
     def __init__(self, container, exp_config, to_singleshot, from_singleshot, to_multishot, from_multishot):
 
         self.exp_config = exp_config
@@ -1629,6 +1875,14 @@ class FileBox(object):
 
         self.last_opened_shots_folder = self.exp_config.get('paths', 'experiment_shot_storage')
 
+        # Reads shot files in a pool of processes, skipping those in the persistent
+        # cache that are unchanged on disk since lyse last read them. Only used by
+        # the incoming thread:
+        self.shot_reader = ShotReader.from_labconfig(
+            self.exp_config,
+            warn=lambda message: app.output_box.output('Warning: %s\n' % message, red=True),
+        )
+
         self.connect_signals()
 
         self.analysis_paused = False
@@ -1638,6 +1892,32 @@ class FileBox(object):
         # need analysing, rather than using a time.sleep:
         self.analysis_pending = threading.Event()
 
+        # When to run multishot analysis automatically:
+        self.multishot_scheduler = MultishotScheduler()
+        for policy, text in [
+            ('queue empty', 'when no shots are left'),
+            ('every n shots', 'every N shots'),
+            ('interval', 'at most every T seconds'),
+            ('end of sequence', 'at end of sequence'),
+            ('idle', 'when idle for T seconds'),
+        ]:
+            self.ui.comboBox_multishot_policy.addItem(text, policy)
+        self.ui.spinBox_multishot_parameter.setValue(self.multishot_scheduler.n)
+        self.ui.comboBox_multishot_policy.currentIndexChanged.connect(self.on_multishot_policy_changed)
+        self.ui.spinBox_multishot_parameter.valueChanged.connect(self.on_multishot_policy_changed)
+        self.on_multishot_policy_changed()
+        # Routines skip shots whose inputs are unchanged since they last ran on them
+        # only if this is enabled, in which case they can be forced to run again:
+        try:
+            skip_unchanged = self.exp_config.getboolean('lyse', 'skip_unchanged_reruns')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            skip_unchanged = False
+        self.ui.pushButton_force_rerun.setVisible(skip_unchanged)
+
+        # Shown in the main window's status bar:
+        self.multishot_status_label = QtWidgets.QLabel()
+        self.update_multishot_status()
+
         # The folder that the 'add shots' dialog will open to:
         self.current_folder = self.exp_config.get('paths', 'experiment_shot_storage')
 
@@ -1664,6 +1944,7 @@ class FileBox(object):
         self.ui.tableView.doubleLeftClicked.connect(self.shots_model.on_double_click)
         self.ui.pushButton_analysis_running.toggled.connect(self.on_analysis_running_toggled)
         self.ui.pushButton_mark_as_not_done.clicked.connect(self.on_mark_selection_not_done_clicked)
+        self.ui.pushButton_force_rerun.clicked.connect(self.on_force_rerun_clicked)
         self.ui.pushButton_run_multishot_analysis.clicked.connect(self.on_run_multishot_analysis_clicked)
         
     def on_edit_columns_clicked(self):
@@ -1697,10 +1978,12 @@ class FileBox(object):
     def on_analysis_running_toggled(self, pressed):
         if pressed:
             self.analysis_paused = True
+            self.multishot_scheduler.paused = True
             self.ui.pushButton_analysis_running.setIcon(QtGui.QIcon(':qtutils/fugue/control'))
             self.ui.pushButton_analysis_running.setText('Analysis paused')
         else:
             self.analysis_paused = False
+            self.multishot_scheduler.paused = False
             self.ui.pushButton_analysis_running.setIcon(QtGui.QIcon(':qtutils/fugue/control'))
             self.ui.pushButton_analysis_running.setText('Analysis running')
             self.analysis_pending.set()
@@ -1710,9 +1993,52 @@ class FileBox(object):
         # Let the analysis loop know to look for these shots:
         self.analysis_pending.set()
         
+    def on_force_rerun_clicked(self):
+        filepaths = self.shots_model.get_selected_filepaths()
+        if filepaths:
+            thread = threading.Thread(target=self.force_rerun, args=(filepaths,))
+            thread.daemon = True
+            thread.start()
+
+    def force_rerun(self, filepaths):
+        """Mark shots as not done, having removed the fingerprints of routines'
+        inputs from them, so that every routine runs on them again even if its
+        inputs are unchanged"""
+        for filepath in filepaths:
+            try:
+                memoization.clear(filepath)
+            except (IOError, OSError):
+                # Not readable, mark_not_done() will skip it if it no longer exists:
+                pass
+        self.shots_model.mark_not_done(filepaths)
+        self.analysis_pending.set()
+
     def on_run_multishot_analysis_clicked(self):
         self.multishot_required = True
         self.analysis_pending.set()
+
+    def on_multishot_policy_changed(self, *args):
+        policy = self.ui.comboBox_multishot_policy.itemData(self.ui.comboBox_multishot_policy.currentIndex())
+        if policy == 'every n shots':
+            self.ui.spinBox_multishot_parameter.setSuffix(' shots')
+        else:
+            self.ui.spinBox_multishot_parameter.setSuffix(' s')
+        self.ui.spinBox_multishot_parameter.setVisible(policy in ['every n shots', 'interval', 'idle'])
+        self.multishot_scheduler.set_policy(policy, self.ui.spinBox_multishot_parameter.value())
+        # Let the analysis loop know in case multishot analysis is now due:
+        self.analysis_pending.set()
+
+    @inmain_decorator()
+    def set_multishot_policy(self, policy, n):
+        self.ui.spinBox_multishot_parameter.setValue(n)
+        self.ui.comboBox_multishot_policy.setCurrentIndex(
+            self.ui.comboBox_multishot_policy.findData(policy))
+        self.on_multishot_policy_changed()
+
+    @inmain_decorator()
+    def update_multishot_status(self):
+        self.multishot_status_label.setText('Multishot analysis: %d shots pending, %d runs skipped' % (
+            self.multishot_scheduler.pending, self.multishot_scheduler.skipped))
         
     def set_columns_visible(self, columns_visible):
         self.shots_model.set_columns_visible(columns_visible)
@@ -1755,8 +2081,9 @@ class FileBox(object):
                 if self.incoming_queue.qsize() == 0:
                     # Wait momentarily in case more arrive so we can batch process them:
                     time.sleep(0.1)
-                # Batch process to decrease number of dataframe concatenations:
-                batch_size = len(self.shots_model.dataframe) // 3 + 1 
+                # Batch process to make the most of the reader processes and decrease
+                # the number of calls into the GUI thread:
+                batch_size = self.INCOMING_BATCH_SIZE
                 while True:
                     try:
                         filepath = self.incoming_queue.get(False)
@@ -1775,32 +2102,20 @@ class FileBox(object):
                 # client sent the same filepath multiple times:
                 filepaths = sorted(set(filepaths), key=filepaths.index) # Inefficient but readable
                 # We open the HDF5 files here outside the GUI thread so as not to hang the GUI:
-                dataframes = []
-                indices_of_files_not_found = []
-                for i, filepath in enumerate(filepaths):
-                    try:
-                        dataframe = get_dataframe_from_shot(filepath)
-                        dataframes.append(dataframe)
-                    except IOError:
-                        app.output_box.output('Warning: Ignoring shot file not found or not readable %s\n' % filepath, red=True)
-                        indices_of_files_not_found.append(i)
-                    n_shots_added += 1
-                    shots_remaining = self.incoming_queue.qsize()
-                    total_shots = n_shots_added + shots_remaining + len(filepaths) - (i + 1)
-                    self.set_add_shots_progress(n_shots_added, total_shots, "reading shot files")
-                self.set_add_shots_progress(n_shots_added, total_shots, "concatenating dataframes")
-                if dataframes:
-                    new_row_data = concat_with_padding(*dataframes)
-                else:
-                    new_row_data = None
-
-                # Do not add the shots that were not found on disk. Reverse
-                # loop so that removing an item doesn't change the indices of
-                # subsequent removals:
-                for i in reversed(indices_of_files_not_found):
-                    del filepaths[i]
+                def progress(n_read):
+                    total_shots = n_shots_added + self.incoming_queue.qsize() + len(filepaths)
+                    self.set_add_shots_progress(n_shots_added + n_read, total_shots, "reading shot files")
+                rows = self.shot_reader.read(filepaths, progress)
+                n_shots_added += len(filepaths)
+                shots_remaining = self.incoming_queue.qsize()
+                total_shots = n_shots_added + shots_remaining
+
+                # Do not add the shots that could not be read:
+                added = [(filepath, row) for filepath, row in zip(filepaths, rows) if row is not None]
+                filepaths = [filepath for filepath, _ in added]
+                rows = [row for _, row in added]
                 if filepaths:
-                    self.shots_model.add_files(filepaths, new_row_data)
+                    self.shots_model.add_files(filepaths, rows)
                     # Let the analysis loop know to look for new shots:
                     self.analysis_pending.set()
                 if shots_remaining == 0:
@@ -1821,30 +2136,60 @@ class FileBox(object):
         h5py._errors.silence_errors()
         while True:
             try:
-                self.analysis_pending.wait()
+                # Wake up when multishot analysis is due, if the multishot policy
+                # is time based:
+                self.analysis_pending.wait(self.multishot_scheduler.timeout())
                 self.analysis_pending.clear()
-                at_least_one_shot_analysed = False
+                # Shots sent to the singleshot routinebox, in the order they were
+                # sent. More than one shot is analysed at a time, with each routine
+                # working on the next shot as soon as the routines before it are
+                # done with it, and with routines that have multiple worker
+                # processes working on several:
+                in_flight = []
+                # Updated data from each shot in flight, held until all shots sent
+                # before it are done so that the dataframe is updated in shot order:
+                buffered_data = {}
+                finished = set()
                 while True:
-                    if not self.analysis_paused:
-                        # Find the first shot that has not finished being analysed:
-                        filepath = self.shots_model.get_first_incomplete()
-                        if filepath is not None:
-                            logger.info('analysing: %s'%filepath)
-                            self.do_singleshot_analysis(filepath)
-                            at_least_one_shot_analysed = True
-                        if filepath is None and at_least_one_shot_analysed:
-                            self.multishot_required = True
-                        if filepath is None:
-                            break
+                    # No more shots are sent once multishot analysis is required, so
+                    # that it can run once those in flight are done:
+                    if not self.analysis_paused and not self.multishot_required:
+                        max_in_flight = app.singleshot_routinebox.max_shots_in_flight()
+                        while len(in_flight) < max_in_flight:
+                            # Find the first shot that has not finished being analysed:
+                            filepath = self.shots_model.get_first_incomplete(exclude=in_flight)
+                            if filepath is None:
+                                break
+                            sequence = self.shots_model.get_sequence(filepath)
+                            if self.multishot_scheduler.sequence_starting(sequence):
+                                logger.info('end of sequence')
+                                self.multishot_required = True
+                                break
+                            if self.start_singleshot_analysis(filepath):
+                                logger.info('analysing: %s'%filepath)
+                                in_flight.append(filepath)
+                                buffered_data[filepath] = []
+                    if not in_flight:
                         if self.multishot_required:
                             logger.info('doing multishot analysis')
                             self.do_multishot_analysis()
-                    else:
-                        logger.info('analysis is paused')
+                            if not self.multishot_required:
+                                continue
+                        elif self.analysis_paused:
+                            logger.info('analysis is paused')
+                        elif self.multishot_scheduler.queue_empty():
+                            self.multishot_required = True
+                            continue
+                        self.update_multishot_status()
                         break
-                if self.multishot_required:
-                    logger.info('doing multishot analysis')
-                    self.do_multishot_analysis()
+                    # Once paused, no more shots are sent, but those in flight are
+                    # allowed to finish:
+                    n_shots_done = self.handle_singleshot_message(in_flight, buffered_data, finished)
+                    for _ in range(n_shots_done):
+                        if self.multishot_scheduler.shot_done():
+                            self.multishot_required = True
+                    if n_shots_done:
+                        self.update_multishot_status()
             except Exception:
                 etype, value, tb = sys.exc_info()
                 orig_exception = ''.join(traceback.format_exception_only(etype, value))
@@ -1863,7 +2208,9 @@ class FileBox(object):
         # This automatically triggers the slot that sets self.analysis_paused
         self.ui.pushButton_analysis_running.setChecked(True)
         
-    def do_singleshot_analysis(self, filepath):
+    def start_singleshot_analysis(self, filepath):
+        """Send a shot to the singleshot routinebox for analysis. Returns whether
+        it was sent."""
         # Check the shot file exists before sending it to the singleshot
         # routinebox. This does not guarantee it won't have been deleted by
         # the time the routinebox starts running analysis on it, but by
@@ -1873,41 +2220,65 @@ class FileBox(object):
         # more errors than necessary.
         if not os.path.exists(filepath):
             self.shots_model.mark_as_deleted_off_disk(filepath)
-            return
+            return False
         self.to_singleshot.put(filepath)
-        while True:
-            signal, status_percent, updated_data = self.from_singleshot.get()
-            for file in updated_data:
-                # Update the data for all the rows with new data:
-                self.shots_model.update_row(file, updated_row_data=updated_data[file])
-            # Update the status percent for the the row on which analysis is actually
-            # running:
-            if status_percent is not None:
-                self.shots_model.set_status_percent(filepath, status_percent)
-            if signal == 'done':
-                return
-            if signal == 'error':
-                if not os.path.exists(filepath):
-                    # Do not pause if the file has been deleted. An error is
-                    # no surprise there:
-                    self.shots_model.mark_as_deleted_off_disk(filepath)
-                else:
-                    self.pause_analysis()
-                return
-            if signal == 'progress':
-                continue
+        return True
+
+    def handle_singleshot_message(self, in_flight, buffered_data, finished):
+        """Wait for a message from the singleshot routinebox about one of the shots
+        in flight, and update the shots model accordingly. Shots are removed from
+        in_flight once they are done and their results are in the dataframe.
+        Returns how many were removed."""
+        signal, filepath, status_percent, updated_data = self.from_singleshot.get()
+        if signal not in ('progress', 'done', 'error'):
             raise ValueError('invalid signal %s' % str(signal))
-                        
+        buffered_data[filepath].append(updated_data)
+        # Update the status percent for the the row on which analysis is actually
+        # running:
+        if status_percent is not None:
+            self.shots_model.set_status_percent(filepath, status_percent)
+        if signal == 'error':
+            if not os.path.exists(filepath):
+                # Do not pause if the file has been deleted. An error is
+                # no surprise there:
+                self.shots_model.mark_as_deleted_off_disk(filepath)
+            else:
+                self.pause_analysis()
+        if signal != 'progress':
+            finished.add(filepath)
+        # Update the data for all the rows with new data, for the shots whose
+        # predecessors are all done:
+        n_shots_done = 0
+        while in_flight:
+            first = in_flight[0]
+            for updated_data in buffered_data[first]:
+                for file in updated_data:
+                    self.shots_model.update_row(file, updated_row_data=updated_data[file])
+                # The results are in the dataframe now, so the routinebox need no
+                # longer hold onto them for lyse.data():
+                app.singleshot_routinebox.discard_updated_data(updated_data)
+            buffered_data[first] = []
+            if first not in finished:
+                break
+            in_flight.pop(0)
+            del buffered_data[first]
+            finished.remove(first)
+            n_shots_done += 1
+        return n_shots_done
+
     def do_multishot_analysis(self):
         self.to_multishot.put(None)
         while True:
-            signal, _, updated_data = self.from_multishot.get()
+            signal, _, _, updated_data = self.from_multishot.get()
             for file in updated_data:
                 self.shots_model.update_row(file, updated_row_data=updated_data[file])
+            app.multishot_routinebox.discard_updated_data(updated_data)
             if signal == 'done':
                 self.multishot_required = False
+                self.multishot_scheduler.ran()
                 return
             elif signal == 'error':
+                self.multishot_scheduler.ran()
                 self.pause_analysis()
                 return
         
@@ -1940,6 +2311,7 @@ class Lyse(object):
                                                self, to_multishot, from_multishot, self.output_box.port, multishot=True)
         self.filebox = FileBox(self.ui.verticalLayout_filebox, self.exp_config,
                                to_singleshot, from_singleshot, to_multishot, from_multishot)
+        self.ui.statusBar().addWidget(self.filebox.multishot_status_label)
 
         self.last_save_config_file = None
         self.last_save_data = None
@@ -1996,12 +2368,16 @@ class Lyse(object):
     def terminate_all_workers(self):
         for routine in self.singleshot_routinebox.routines + self.multishot_routinebox.routines:
             routine.end_child()
+        self.filebox.shot_reader.close()
 
     def workers_terminated(self):
         terminated = {}
         for routine in self.singleshot_routinebox.routines + self.multishot_routinebox.routines:
-            routine.worker.poll()
-            terminated[routine.filepath] = routine.worker.returncode is not None
+            for _, _, worker in routine.workers.values():
+                worker.poll()
+            terminated[routine.filepath] = all(
+                worker.returncode is not None for _, _, worker in routine.workers.values()
+            )
         return terminated
 
     def are_you_sure(self):
@@ -2088,6 +2464,12 @@ class Lyse(object):
         save_data['SingleShot'] = list(zip([routine.filepath for routine in box.routines],
                                            [box.model.item(row, box.COL_ACTIVE).checkState() 
                                             for row in range(box.model.rowCount())]))
+        # The number of worker processes is saved only if not the default, so that
+        # the saved configuration can be read by older versions of lyse otherwise:
+        save_data['SingleShot'] = [
+            (filepath, checked) if routine.n_replicas == 1 else (filepath, checked, routine.n_replicas)
+            for routine, (filepath, checked) in zip(box.routines, save_data['SingleShot'])
+        ]
         save_data['LastSingleShotFolder'] = box.last_opened_routine_folder
         box = self.multishot_routinebox
         save_data['MultiShot'] = list(zip([routine.filepath for routine in box.routines],
@@ -2098,6 +2480,7 @@ class Lyse(object):
         save_data['LastFileBoxFolder'] = self.filebox.last_opened_shots_folder
 
         save_data['analysis_paused'] = self.filebox.analysis_paused
+        save_data['multishot_policy'] = (self.filebox.multishot_scheduler.policy, self.filebox.multishot_scheduler.n)
         window_size = self.ui.size()
         save_data['window_size'] = (window_size.width(), window_size.height())
         window_pos = self.ui.pos()
@@ -2180,6 +2563,10 @@ class Lyse(object):
                 self.filebox.pause_analysis()
         except (LabConfig.NoOptionError, LabConfig.NoSectionError):
             pass
+        try:
+            self.filebox.set_multishot_policy(*ast.literal_eval(lyse_config.get('lyse_state', 'multishot_policy')))
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            pass
         if restore_window_geometry:
             self.load_window_geometry_configuration(filename)
 
@@ -2229,6 +2616,21 @@ class Lyse(object):
                     pass
 
 
+    def get_dataframe(self):
+        return self.filebox.shots_model.get_dataframe()
+
+    def get_dataframe_update(self, since):
+        return self.filebox.shots_model.get_dataframe_update(since)
+
+    def get_series(self, filepath):
+        updated_data = {}
+        for routinebox in [self.singleshot_routinebox, self.multishot_routinebox]:
+            updated_data.update(routinebox.get_updated_data(filepath))
+        return self.filebox.shots_model.get_series(filepath, updated_data)
+
+    def add_shot(self, filepath):
+        self.filebox.incoming_queue.put(filepath)
+
     def setup_config(self):
         required_config_params = {"DEFAULT": ["experiment_name"],
                                   "programs": ["text_editor",
@@ -2310,7 +2712,7 @@ class Lyse(object):
             self.filebox.incoming_queue.put(filepath)
         df = df.drop(need_updating)
         
-        self.filebox.shots_model.add_files(filepaths, df, done=True)
+        self.filebox.shots_model.add_files(filepaths, dataframe_to_flat_dicts(df), done=True)
 
     def delete_items(self, confirm):
         """Delete items from whichever box has focus, with optional confirmation
@@ -2333,7 +2735,7 @@ if __name__ == "__main__":
 
     # Start the web server:
     splash.update_text('starting analysis server')
-    server = WebServer(app.port)
+    server = WebServer(app, app.port)
     splash.update_text('done')
     # Let the interpreter run every 500ms so it sees Ctrl-C interrupts:
     timer = QtCore.QTimer()
@@ -24,6 +24,7 @@ import os
 import threading
 import traceback
 import time
+import hashlib
 from types import ModuleType
 
 from qtutils.qt import QtCore, QtGui, QtWidgets, QT_ENV, PYQT5
@@ -34,6 +35,8 @@ from qtutils import inmain, inmain_later, inmain_decorator, UiLoader, inthread,
 import qtutils.icons
 
 from labscript_utils.winshell import set_appusermodel, appids, app_descriptions
+from labscript_utils.labconfig import LabConfig
+from labscript_utils.properties import get_attributes
     
 import multiprocessing
 
@@ -253,10 +256,17 @@ class Plot(object):
 
 
 class AnalysisWorker(object):
-    def __init__(self, filepath, to_parent, from_parent):
+    def __init__(self, filepath, to_parent, from_parent, show_plots=True, headless=False):
         self.to_parent = to_parent
         self.from_parent = from_parent
         self.filepath = filepath
+        # Whether to show figures in windows. When a routine runs in several worker
+        # processes, only the first shows its figures, otherwise each shot's figures
+        # would appear in a different window:
+        self.show_plots = show_plots and not headless
+        # Whether there is no Qt application, in which case analysis runs in the
+        # main thread, which must call mainloop() itself:
+        self.headless = headless
 
         # Filepath as a unicode string on py3 and a bytestring on py2,
         # so that the right string type can be passed to functions that
@@ -281,15 +291,36 @@ class AnalysisWorker(object):
         # Plot objects, keyed by matplotlib Figure object:
         self.plots = {}
 
+        # The routine's compiled code, and the (mtime, size) and hash of the file it
+        # was compiled from, along with when they were last checked:
+        self.code = None
+        self.code_stat = None
+        self.code_hash = None
+        self.code_checked_time = None
+        # How many times the compiled code has been reused or had to be compiled:
+        self.compile_cache_hits = 0
+        self.compile_cache_misses = 0
+
         # An object with a method to unload user modules if any have
         # changed on disk:
         self.modulewatcher = ModuleWatcher()
+
+        # Whether to skip running the routine on a shot if it has run successfully
+        # on it before and none of its inputs have changed since:
+        try:
+            self.skip_unchanged = LabConfig().getboolean('lyse', 'skip_unchanged_reruns')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.skip_unchanged = False
+        self.module_hasher = memoization.ModuleHasher()
+        # The group in the shot file the routine saves its results to:
+        self.results_group = os.path.basename(self.filepath).split('.py')[0]
         
-        # Start the thread that listens for instructions from the
-        # parent process:
-        self.mainloop_thread = threading.Thread(target=self.mainloop)
-        self.mainloop_thread.daemon = True
-        self.mainloop_thread.start()
+        if not self.headless:
+            # Start the thread that listens for instructions from the
+            # parent process:
+            self.mainloop_thread = threading.Thread(target=self.mainloop)
+            self.mainloop_thread.daemon = True
+            self.mainloop_thread.start()
         
     def mainloop(self):
         # HDF5 prints lots of errors by default, for things that aren't
@@ -301,27 +332,102 @@ class AnalysisWorker(object):
             task, data = self.from_parent.get()
             with kill_lock:
                 if task == 'quit':
+                    if self.headless:
+                        return
                     inmain(qapplication.quit)
                 elif task == 'analyse':
-                    path = data
-                    success = self.do_analysis(path)
+                    # Either a single shot, or a list of them for routines that
+                    # analyse shots in batches:
+                    if isinstance(data, list):
+                        paths = data
+                    else:
+                        paths = [data]
+                    if self.headless:
+                        success = self.run_analysis(paths)
+                    else:
+                        success = self.do_analysis(paths)
                     if success:
                         if lyse._delay_flag:
                             lyse.delay_event.wait()
-                        self.to_parent.put(['done', lyse._updated_data])
+                        self.to_parent.put(['done', lyse._updated_data, self.get_info()])
                     else:
-                        self.to_parent.put(['error', lyse._updated_data])
+                        self.to_parent.put(['error', lyse._updated_data, self.get_info()])
                 else:
                     self.to_parent.put(['error','invalid task %s'%str(task)])
         
+    def get_info(self):
+        """Information about the worker to send to the parent along with the results
+        of each run"""
+        return {
+            'compile_cache_hits': self.compile_cache_hits,
+            'compile_cache_misses': self.compile_cache_misses,
+            'depends_on': lyse._depends_on,
+            'max_batch_size': lyse._max_batch_size,
+        }
+
+    # How long after a file is modified its mtime and size can be trusted to
+    # identify its contents. A file modified again within the resolution of the
+    # filesystem's timestamps may not get a new mtime:
+    MTIME_RESOLUTION = 2
+
+    def get_code(self):
+        """Return the compiled code of the routine. It is compiled again only if
+        the file's contents have changed, which is checked by comparing its mtime
+        and size to the last time it was compiled, and if those differ or were
+        recorded too soon after the file was modified to be relied upon, its hash."""
+        st = os.stat(self.filepath)
+        stat = (st.st_mtime, st.st_size)
+        now = time.time()
+        if (
+            self.code is not None
+            and stat == self.code_stat
+            and self.code_checked_time - st.st_mtime > self.MTIME_RESOLUTION
+        ):
+            self.compile_cache_hits += 1
+            return self.code
+        # Read as bytes, so that the source's encoding is determined by compile()
+        # from any coding declaration, as when importing, and not by the locale:
+        with open(self.filepath, 'rb') as f:
+            source = f.read()
+        source_hash = hashlib.sha1(source).hexdigest()
+        if self.code is not None and source_hash == self.code_hash:
+            self.compile_cache_hits += 1
+        else:
+            self.code = compile(source, self.routine_module.__file__, 'exec', dont_inherit=True)
+            self.code_hash = source_hash
+            self.compile_cache_misses += 1
+        self.code_stat = stat
+        self.code_checked_time = now
+        return self.code
+
     @inmain_decorator()
-    def do_analysis(self, path):
+    def do_analysis(self, paths):
+        return self.run_analysis(paths)
+
+    def run_analysis(self, paths):
+        """Run the routine on the given shots, returning whether it succeeded. Must
+        be called from the main thread."""
         now = time.strftime('[%x %X]')
-        if path is not None:
+        path = paths[-1]
+        if len(paths) > 1:
+            print('%s %s %s (and %d earlier shots)' % (
+                now, os.path.basename(self.filepath), os.path.basename(path), len(paths) - 1))
+        elif path is not None:
             print('%s %s %s ' %(now, os.path.basename(self.filepath), os.path.basename(path)))
         else:
             print('%s %s' %(now, os.path.basename(self.filepath)))
 
+        if self.skip_unchanged and len(paths) == 1 and path is not None:
+            unchanged = self.check_fingerprint(path)
+            if unchanged is not None:
+                # Reuse the results saved last time. Figures are not updated:
+                inputs, lyse._updated_data = unchanged
+                lyse._delay_flag = False
+                lyse._depends_on = inputs['depends_on']
+                lyse._max_batch_size = inputs['max_batch_size']
+                print('inputs unchanged since last run, skipped\n')
+                return True
+
         self.pre_analysis_plot_actions()
 
         # Reset the routine module's namespace:
@@ -330,10 +436,15 @@ class AnalysisWorker(object):
 
         # Use lyse.path instead:
         lyse.path = path
+        lyse.paths = [p for p in paths if p is not None]
         lyse.plots = self.plots
         lyse.Plot = Plot
         lyse._updated_data = {}
         lyse._delay_flag = False
+        lyse._depends_on = None
+        lyse._max_batch_size = None
+        lyse._results_read = set()
+        lyse._data_versions = {}
         lyse.delay_event.clear()
 
         # Save the current working directory before changing it to the
@@ -345,14 +456,8 @@ class AnalysisWorker(object):
         try:
             with self.modulewatcher.lock:
                 # Actually run the user's analysis!
-                with open(self.filepath) as f:
-                    code = compile(
-                        f.read(),
-                        self.routine_module.__file__,
-                        'exec',
-                        dont_inherit=True,
-                    )
-                    exec(code, self.routine_module.__dict__)
+                code = self.get_code()
+                exec(code, self.routine_module.__dict__)
         except:
             traceback_lines = traceback.format_exception(*sys.exc_info())
             del traceback_lines[1]
@@ -373,19 +478,83 @@ class AnalysisWorker(object):
             sys.stderr.write(message)
             return False
         else:
+            # So that lyse.data(since_last_run=True) returns the rows changed since
+            # the data this run got:
+            lyse._last_run_data_versions.update(lyse._data_versions)
+            if self.skip_unchanged and len(paths) == 1 and path is not None:
+                self.store_fingerprint(path)
             return True
         finally:
             os.chdir(cwd)
             print('')
             self.post_analysis_plot_actions()
+
+    def check_fingerprint(self, path):
+        """If the routine has run successfully on the shot before, and none of its
+        inputs have changed since, return the inputs stored then, and the results it
+        saved in the form of lyse._updated_data. Otherwise return None."""
+        try:
+            # Compile the routine if it has changed, to get the hash of its source:
+            self.get_code()
+            with h5py.File(path, 'r') as h5_file:
+                stored, inputs = memoization.get_stored(h5_file, self.results_group)
+                if stored is None:
+                    return None
+                results_groups = memoization.results_groups_read(
+                    h5_file, inputs['results_read'], self.results_group
+                )
+                module_hashes = self.module_hasher.file_hashes(inputs['modules'])
+                if memoization.fingerprint(h5_file, self.code_hash, module_hashes, results_groups) != stored:
+                    return None
+                try:
+                    results = get_attributes(h5_file['results'][self.results_group])
+                except KeyError:
+                    results = {}
+        except Exception:
+            # Run the routine, which will report the problem if there is one:
+            return None
+        updated_data = {path: dict(((self.results_group, name), value) for name, value in results.items())}
+        return inputs, updated_data
+
+    def store_fingerprint(self, path):
+        """Store in the shot file the fingerprint of the inputs of the run of the
+        routine that just completed successfully"""
+        if None in lyse._results_read:
+            # It read data from other shots, which we can't tell have changed:
+            return
+        # User modules, the same ones the modulewatcher would unload if they
+        # changed:
+        modules = self.module_hasher.user_module_files(set(sys.modules) - self.modulewatcher.whitelist)
+        inputs = {
+            'results_read': sorted(lyse._results_read),
+            'modules': modules,
+            'depends_on': lyse._depends_on,
+            'max_batch_size': lyse._max_batch_size,
+        }
+        try:
+            with h5py.File(path, 'a') as h5_file:
+                results_groups = memoization.results_groups_read(
+                    h5_file, inputs['results_read'], self.results_group
+                )
+                module_hashes = self.module_hasher.file_hashes(modules)
+                fingerprint = memoization.fingerprint(h5_file, self.code_hash, module_hashes, results_groups)
+                memoization.store(h5_file, self.results_group, fingerprint, inputs)
+        except Exception:
+            sys.stderr.write('Could not store fingerprint of inputs:\n' + traceback.format_exc())
         
     def pre_analysis_plot_actions(self):
         lyse.figure_manager.figuremanager.reset()
+        if not self.show_plots:
+            return
         for plot in self.plots.values():
             plot.save_axis_limits()
             plot.clear()
 
     def post_analysis_plot_actions(self):
+        if not self.show_plots:
+            # Discard the figures rather than showing them:
+            lyse.figure_manager.figuremanager.close('all')
+            return
         # reset the current figure to figure 1:
         lyse.figure_manager.figuremanager.set_first_figure_current()
         # Introspect the figures that were produced:
@@ -492,8 +661,23 @@ class AnalysisWorker(object):
         
 if __name__ == '__main__':
 
+    process_tree = ProcessTree.connect_to_parent()
+    to_parent = process_tree.to_parent
+    from_parent = process_tree.from_parent
+    kill_lock = process_tree.kill_lock
+    filepath = from_parent.get()
+    if isinstance(filepath, list):
+        filepath, options = filepath
+    else:
+        options = {}
+    # Headless workers, run by headless lyse, have no Qt application, and render
+    # figures off-screen:
+    headless = options.get('headless', False)
+
     import matplotlib
-    if QT_ENV == PYQT5:
+    if headless:
+        matplotlib.use("Agg")
+    elif QT_ENV == PYQT5:
         matplotlib.use("QT5Agg")
     else:
         matplotlib.use("QT4Agg")
@@ -504,7 +688,9 @@ if __name__ == '__main__':
     import lyse.figure_manager
     lyse.figure_manager.install()
 
-    if QT_ENV == PYQT5:
+    if headless:
+        pass
+    elif QT_ENV == PYQT5:
         from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
     else:
         from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
@@ -512,12 +698,7 @@ if __name__ == '__main__':
     import labscript_utils.h5_lock, h5py
 
     from labscript_utils.modulewatcher import ModuleWatcher
-
-    process_tree = ProcessTree.connect_to_parent()
-    to_parent = process_tree.to_parent
-    from_parent = process_tree.from_parent
-    kill_lock = process_tree.kill_lock
-    filepath = from_parent.get()
+    from lyse import memoization
 
     # Rename this module to _analysis_subprocess and put it in sys.modules
     # under that name. The user's analysis routine will become the __main__ module
@@ -531,7 +712,10 @@ if __name__ == '__main__':
     # Set a meaningful client id for zlock
     process_tree.zlock_client.set_process_name('lyse-'+os.path.basename(filepath))
 
-    qapplication = QtWidgets.QApplication(sys.argv)
-    worker = AnalysisWorker(filepath, to_parent, from_parent)
-    qapplication.exec_()
-        
+    if headless:
+        worker = AnalysisWorker(filepath, to_parent, from_parent, **options)
+        worker.mainloop()
+    else:
+        qapplication = QtWidgets.QApplication(sys.argv)
+        worker = AnalysisWorker(filepath, to_parent, from_parent, **options)
+        qapplication.exec_()
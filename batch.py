@@ -0,0 +1,293 @@
+#####################################################################
+#                                                                   #
+# /batch.py                                                         #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Reprocess shot files with single-shot analysis routines, in parallel and without
+the lyse GUI:
+
+    python -m lyse.batch --routines a.py b.py --shots '/data/2020/01/**/*.h5' --jobs 16
+
+Each shot is analysed by the routines in the order given, in one of a pool of
+worker processes, one per core by default. As in lyse, each routine runs in a fresh
+__main__ module, with lyse.path set to the shot file, and saves its results to the
+shot file with Run.save_result(). Unlike in lyse, lyse.data(path) reads the shot
+file, and there is no lyse server to get the dataframe of other shots from.
+Routines that fail on a shot are reported, and the routines after it are skipped
+for that shot.
+
+Progress is recorded in an SQLite database as each shot is done, so an
+interrupted run can be resumed by running the same command again, which skips the
+shots already analysed successfully. Once all shots are done, the data of each,
+including the results saved by the routines, is exported as a single dataframe, in
+the same form as lyse.data() returns, including its index."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import sys
+import glob
+import json
+import pickle
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+from types import ModuleType
+
+from labscript_utils.labconfig import LabConfig
+
+from lyse.dataframe_utilities import ColumnStore, get_flat_dict_from_shot, set_dataframe_index
+
+
+class BatchProgress(object):
+    """A record, in an SQLite database, of the shots that have been analysed by a
+    batch run, whether the routines succeeded, and the data read from each shot
+    afterwards. The routines are recorded too, and a database recording different
+    routines may not be resumed from."""
+
+    def __init__(self, path, routines, restart=False):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            if restart:
+                self.connection.execute("DROP TABLE IF EXISTS shots")
+                self.connection.execute("DROP TABLE IF EXISTS routines")
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS shots (
+                    filepath TEXT PRIMARY KEY,
+                    error TEXT,
+                    row BLOB
+                )"""
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS routines (routines TEXT NOT NULL)")
+            result = self.connection.execute("SELECT routines FROM routines").fetchone()
+            if result is None:
+                self.connection.execute("INSERT INTO routines (routines) VALUES (?)", (json.dumps(routines),))
+            elif json.loads(result[0]) != routines:
+                raise ValueError(
+                    'Progress file %s is from a batch run with different routines: %s. '
+                    'Use --restart to discard it.' % (path, ', '.join(json.loads(result[0])))
+                )
+
+    def done_shots(self, include_failed=True):
+        """Return the set of filepaths of the shots analysed so far"""
+        query = "SELECT filepath FROM shots"
+        if not include_failed:
+            query += " WHERE error IS NULL"
+        return set(filepath for filepath, in self.connection.execute(query))
+
+    def record(self, filepath, error, row):
+        """Record that a shot has been analysed. error is the traceback of the
+        routine that failed, if any, and row is the data read from the shot
+        afterwards, or None if it could not be read."""
+        if row is not None:
+            row = sqlite3.Binary(pickle.dumps(row, protocol=2))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO shots (filepath, error, row) VALUES (?, ?, ?)",
+            (filepath, error, row),
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def rows(self):
+        """Return the data read from each shot, in order of filepath"""
+        return [
+            pickle.loads(bytes(row))
+            for row, in self.connection.execute(
+                "SELECT row FROM shots WHERE row IS NOT NULL ORDER BY filepath"
+            )
+        ]
+
+    def close(self):
+        self.connection.close()
+
+
+# In worker processes, the routines to run as (filepath, code) tuples:
+_routines = None
+
+
+def _init_worker(routine_paths):
+    global _routines
+    # Figures are rendered off-screen, and may be saved by routines:
+    import matplotlib
+    matplotlib.use('Agg')
+    for routine_path in routine_paths:
+        # So that routines can import modules alongside them:
+        if os.path.dirname(routine_path) not in sys.path:
+            sys.path.insert(0, os.path.dirname(routine_path))
+    _routines = []
+    for routine_path in routine_paths:
+        with open(routine_path) as f:
+            code = compile(f.read(), routine_path, 'exec', dont_inherit=True)
+        _routines.append((routine_path, code))
+
+
+def _run_routine(routine_path, code, shot_path):
+    """Run a routine on a shot as lyse would, in a fresh __main__ module. Return the
+    traceback if it raises an exception, otherwise None."""
+    import lyse
+    lyse.path = shot_path
+    lyse.paths = [shot_path]
+    lyse._updated_data = {}
+    routine_module = ModuleType(b'__main__' if PY2 else '__main__')
+    routine_module.__file__ = routine_path
+    main_module = sys.modules['__main__']
+    sys.modules['__main__'] = routine_module
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(routine_path))
+    try:
+        exec(code, routine_module.__dict__)
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        sys.modules['__main__'] = main_module
+        # Don't accumulate figures from one shot to the next:
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+    return None
+
+
+def _process_shot(shot_path):
+    """Run the routines on a shot, and return (shot_path, error, row), where error
+    is the traceback of the routine that failed, if any, and row is the data read
+    from the shot afterwards, or None if it could not be read"""
+    error = None
+    for routine_path, code in _routines:
+        error = _run_routine(routine_path, code, shot_path)
+        if error is not None:
+            error = '%s failed:\n%s' % (os.path.basename(routine_path), error)
+            break
+    try:
+        row = get_flat_dict_from_shot(shot_path)
+    except IOError:
+        row = None
+        if error is None:
+            error = 'shot file not found or not readable'
+    return shot_path, error, row
+
+
+def find_shots(patterns):
+    """Return the sorted filepaths of shot files matching the given glob patterns,
+    which may include '**' for any number of subdirectories, or directories to
+    search recursively"""
+    shots = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dirpath, _, filenames in os.walk(pattern):
+                shots.update(os.path.join(dirpath, f) for f in filenames if f.endswith('.h5'))
+            continue
+        try:
+            matches = glob.glob(pattern, recursive=True)
+        except TypeError:
+            # Python 2, no recursive globbing:
+            matches = glob.glob(pattern)
+        shots.update(matches)
+    return sorted(os.path.abspath(shot) for shot in shots)
+
+
+def export_dataframe(df, path):
+    """Save a dataframe in a format determined by the file extension: .csv, .h5 or
+    .hdf5, otherwise pickled"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        df.to_csv(path)
+    elif extension in ('.h5', '.hdf5'):
+        df.to_hdf(path, key='dataframe')
+    else:
+        df.to_pickle(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reprocess shot files with single-shot analysis routines in parallel.'
+    )
+    parser.add_argument('--routines', nargs='+', required=True,
+                        help='analysis routines to run on each shot, in order')
+    parser.add_argument('--shots', nargs='+', required=True,
+                        help="shot files, directories or glob patterns, with '**' matching any subdirectories")
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--output', default='lyse_batch_dataframe.pkl',
+                        help='file to export the dataframe to, as CSV or HDF5 if it ends in .csv or .h5, '
+                             'otherwise pickled (default: %(default)s)')
+    parser.add_argument('--progress', default=None,
+                        help='progress database, for resuming (default: the output file with .progress appended)')
+    parser.add_argument('--restart', action='store_true',
+                        help='discard any progress and analyse all shots again')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='analyse shots again on which a routine failed previously')
+    args = parser.parse_args()
+
+    routines = [os.path.abspath(routine) for routine in args.routines]
+    for routine in routines:
+        if not os.path.isfile(routine):
+            parser.error('routine not found: %s' % routine)
+    shots = find_shots(args.shots)
+    if not shots:
+        parser.error('no shot files found')
+
+    progress_path = args.progress or args.output + '.progress'
+    try:
+        progress = BatchProgress(progress_path, routines, restart=args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+    done = progress.done_shots(include_failed=not args.retry_failed)
+    to_do = [shot for shot in shots if shot not in done]
+    print('%d shots, %d already done, %d to do with %d processes' % (
+        len(shots), len(shots) - len(to_do), len(to_do), args.jobs))
+
+    n_failed = 0
+    if hasattr(multiprocessing, 'get_context'):
+        # Analysis routines may not be fork-safe. Spawn fresh processes on platforms
+        # that would fork:
+        context = multiprocessing.get_context('spawn')
+    else:
+        # Python 2, which has no start methods:
+        context = multiprocessing
+    pool = context.Pool(args.jobs, initializer=_init_worker, initargs=(routines,))
+    try:
+        results = pool.imap_unordered(_process_shot, to_do)
+        for i, (shot_path, error, row) in enumerate(results):
+            progress.record(shot_path, error, row)
+            progress.commit()
+            if error is not None:
+                n_failed += 1
+                sys.stderr.write('%s: %s\n' % (shot_path, error))
+            print('[%d/%d] %s' % (i + 1, len(to_do), os.path.basename(shot_path)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        progress.close()
+        sys.stderr.write('Interrupted. Run the same command again to resume.\n')
+        sys.exit(1)
+    finally:
+        pool.join()
+
+    print('%d shots analysed, %d with errors. Exporting dataframe to %s' % (len(to_do), n_failed, args.output))
+    store = ColumnStore()
+    store.append_rows(progress.rows())
+    progress.close()
+    df = store.dataframe()
+    # Indexed as by lyse.data():
+    try:
+        integer_indexing = LabConfig().getboolean('lyse', 'integer_indexing')
+    except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+        integer_indexing = False
+    export_dataframe(set_dataframe_index(df, integer_indexing), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/dataframe_transport.py                                #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the time taken to encode and decode lyse dataframes as pickles and in the
+Arrow IPC format, with and without compression, and the size of the result.
+
+    python benchmarks/dataframe_transport.py [n_rows ...]
+
+By default dataframes of 1000, 10000 and 100000 rows are used, each with columns
+similar to those of a lyse session: mostly floating point globals and results,
+plus filepaths, timestamps, and a column of mixed Python objects."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import sys
+import time
+
+import numpy as np
+import pandas
+
+from lyse.dataframe_transport import arrow_available, encode_dataframe, decode_dataframe
+
+N_GLOBALS = 100
+N_RESULTS = 100
+N_REPEATS = 3
+
+
+def make_dataframe(n_rows):
+    data = {}
+    data['filepath', ''] = ['/experiments/2020/01/01/shot_%06d.h5' % i for i in range(n_rows)]
+    data['run time', ''] = pandas.date_range('2020-01-01', periods=n_rows, freq='s', tz='UTC')
+    data['run number', ''] = np.arange(n_rows)
+    for i in range(N_GLOBALS):
+        data['global_%d' % i, ''] = np.full(n_rows, float(i))
+    for i in range(N_RESULTS):
+        values = np.random.random(n_rows)
+        # Shots on which the routine did not run:
+        values[::10] = np.nan
+        data['routine', 'result_%d' % i] = values
+    # Arrow cannot represent this column, so it is pickled separately:
+    data['routine', 'mixed'] = np.array([[i] if i % 2 else 'result' for i in range(n_rows)], dtype=object)
+    return pandas.DataFrame(data, columns=pandas.MultiIndex.from_tuples(sorted(data)))
+
+
+def best_time(function, *args):
+    times = []
+    for _ in range(N_REPEATS):
+        start_time = time.time()
+        result = function(*args)
+        times.append(time.time() - start_time)
+    return min(times), result
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    transports = [('pickle', None)]
+    if arrow_available():
+        transports += [('arrow', None), ('arrow', 'lz4'), ('arrow', 'zstd')]
+    else:
+        print('pyarrow not installed, only pickle will be benchmarked')
+    for n_rows in sizes:
+        df = make_dataframe(n_rows)
+        print('%d rows x %d columns' % df.shape)
+        for format, compression in transports:
+            encode_time, encoded = best_time(encode_dataframe, df, format, compression)
+            decode_time, decoded = best_time(decode_dataframe, encoded)
+            assert decoded.shape == df.shape
+            name = format if compression is None else '%s+%s' % (format, compression)
+            print('  %-12s encode %8.1f ms  decode %8.1f ms  size %8.2f MB' % (
+                name, 1e3 * encode_time, 1e3 * decode_time, len(encoded[1]) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/shot_reader.py                                        #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Compare the single-pass shot reader in lyse.dataframe_utilities with the previous
+implementation, which read the globals with runmanager.get_shot_globals() and then
+opened the file a second time for everything else.
+
+    python benchmarks/shot_reader.py [n_shots] [directory]
+
+Synthetic shot files are written to a temporary directory unless a directory is
+given - pass a directory on a network share to include the cost of opening files
+there."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import labscript_utils.h5_lock, h5py
+import numpy as np
+import runmanager
+import labscript_utils.shared_drive
+from labscript_utils.connections import _ensure_str
+from labscript_utils.properties import get_attributes
+
+from lyse.dataframe_utilities import asdatetime, get_nested_dict_from_shot
+
+N_GLOBALS = 200
+N_RESULTS_GROUPS = 10
+N_RESULTS = 20
+N_IMAGES = 4
+
+
+def legacy_get_nested_dict_from_shot(filepath):
+    """The previous implementation, for comparison"""
+    row = runmanager.get_shot_globals(filepath)
+    with h5py.File(filepath,'r') as h5_file:
+        if 'results' in h5_file:
+            for groupname in h5_file['results']:
+                resultsgroup = h5_file['results'][groupname]
+                row[groupname] = get_attributes(resultsgroup)
+        if 'images' in h5_file:
+            for orientation in h5_file['images'].keys():
+                if isinstance(h5_file['images'][orientation], h5py.Group):
+                    row[orientation] = get_attributes(h5_file['images'][orientation])
+                    for label in h5_file['images'][orientation]:
+                        row[orientation][label] = {}
+                        group = h5_file['images'][orientation][label]
+                        for image in group:
+                            row[orientation][label][image] = {}
+                            for key, val in get_attributes(group[image]).items():
+                                if not isinstance(val, h5py.Reference):
+                                    row[orientation][label][image][key] = val
+        row['filepath'] = _ensure_str(filepath)
+        row['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
+        seq_id = _ensure_str(h5_file.attrs['sequence_id'])
+        row['sequence'] = asdatetime(seq_id.split('_')[0])
+        try:
+            row['sequence_index'] = h5_file.attrs['sequence_index']
+        except KeyError:
+            row['sequence_index'] = None
+        if 'script' in h5_file: 
+            row['labscript'] = _ensure_str(h5_file['script'].attrs['name'])
+        try:
+            row['run time'] = asdatetime(_ensure_str(h5_file.attrs['run time']))
+        except KeyError:
+            row['run time'] = float('nan')
+        try:    
+            row['run number'] = h5_file.attrs['run number']
+        except KeyError:
+            row['run number'] = float('nan')
+        try:
+            row['run repeat'] = h5_file.attrs['run repeat']
+        except KeyError:
+            row['run repeat'] = 0
+        return row
+
+
+def make_shot(filepath, run_number):
+    with h5py.File(filepath, 'w') as f:
+        f.attrs['sequence_id'] = '2020-01-01T00:00:00_benchmark'
+        f.attrs['sequence_index'] = 0
+        f.attrs['run time'] = '2020-01-01T00:00:%02d' % (run_number % 60)
+        f.attrs['run number'] = run_number
+        f.attrs['run repeat'] = 0
+        f.create_group('script').attrs['name'] = 'benchmark.py'
+        globals_group = f.create_group('globals')
+        for i in range(N_GLOBALS):
+            globals_group.attrs['global_%d' % i] = float(i)
+        results = f.create_group('results')
+        for i in range(N_RESULTS_GROUPS):
+            group = results.create_group('routine_%d' % i)
+            for j in range(N_RESULTS):
+                group.attrs['result_%d' % j] = float(j)
+        label = f.create_group('images/side/absorption')
+        label.parent.attrs['camera'] = 'side'
+        for i in range(N_IMAGES):
+            dataset = label.create_dataset('frame_%d' % i, data=np.zeros((4, 4)))
+            dataset.attrs['exposure_time'] = 1e-3
+
+
+def time_reader(reader, filepaths):
+    start_time = time.time()
+    for filepath in filepaths:
+        reader(filepath)
+    return time.time() - start_time
+
+
+def main():
+    n_shots = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    if len(sys.argv) > 2:
+        directory = sys.argv[2]
+        cleanup = False
+    else:
+        directory = tempfile.mkdtemp()
+        cleanup = True
+    try:
+        filepaths = [os.path.join(directory, 'shot_%05d.h5' % i) for i in range(n_shots)]
+        for i, filepath in enumerate(filepaths):
+            make_shot(filepath, i)
+        assert legacy_get_nested_dict_from_shot(filepaths[0]).keys() == get_nested_dict_from_shot(filepaths[0]).keys()
+        # Warm the OS file cache before timing:
+        time_reader(get_nested_dict_from_shot, filepaths)
+        legacy = time_reader(legacy_get_nested_dict_from_shot, filepaths)
+        single_pass = time_reader(get_nested_dict_from_shot, filepaths)
+        print('%d shots' % n_shots)
+        print('legacy reader:      %.2f ms/shot' % (1e3 * legacy / n_shots))
+        print('single-pass reader: %.2f ms/shot' % (1e3 * single_pass / n_shots))
+        print('speedup:            %.2fx' % (legacy / single_pass))
+    finally:
+        if cleanup:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
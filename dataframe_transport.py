@@ -0,0 +1,161 @@
+#####################################################################
+#                                                                   #
+# /dataframe_transport.py                                           #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Encoding of dataframes for sending from the lyse server to lyse.data().
+
+Dataframes are pickled by default. If pyarrow is installed they may instead be
+encoded in the Arrow IPC stream format, which is faster to produce and read for
+numeric columns, and may be compressed. Arrow requires column names to be strings,
+so the hierarchical column names of lyse dataframes are stored separately as JSON,
+along with any columns of Python objects that Arrow cannot represent, which are
+pickled."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import json
+import pickle
+
+import numpy as np
+import pandas
+
+from lyse.shared_dataframe import attach_dataframe
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+FORMATS = ('pickle', 'arrow')
+COMPRESSIONS = (None, 'lz4', 'zstd')
+
+# Keys in the Arrow schema metadata:
+_COLUMNS_KEY = b'lyse.columns'
+_PICKLED_COLUMNS_KEY = b'lyse.pickled_columns'
+_INDEX_FIELD = '__index__'
+
+
+def arrow_available():
+    return pyarrow is not None
+
+
+def _column_to_arrow(series):
+    """Return the pyarrow Array for a column, or None if it cannot be converted"""
+    try:
+        # from_pandas=True treats NaN as null, which is what it is used for in lyse
+        # dataframes:
+        return pyarrow.Array.from_pandas(series)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        return None
+
+
+def _encode_arrow(df, compression):
+    names = [name if isinstance(name, tuple) else (name,) for name in df.columns]
+    # Arrow field names are column positions, the real names are in the metadata:
+    flat = df.copy(deep=False)
+    flat.columns = [str(i) for i in range(len(names))]
+    flat = flat.reset_index(drop=True)
+    pickled_columns = {}
+    try:
+        # Converting the whole frame at once is fastest:
+        table = pyarrow.Table.from_pandas(flat, preserve_index=False)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        # Some columns cannot be converted. Find them and pickle them instead:
+        arrays = []
+        fields = []
+        for i, field in enumerate(flat.columns):
+            array = _column_to_arrow(flat.iloc[:, i])
+            if array is None:
+                pickled_columns[i] = flat.iloc[:, i].values
+            else:
+                arrays.append(array)
+                fields.append(field)
+        table = pyarrow.Table.from_arrays(arrays, names=fields)
+    if not isinstance(df.index, pandas.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        table = table.append_column(_INDEX_FIELD, pyarrow.array(np.asarray(df.index)))
+    metadata = {_COLUMNS_KEY: json.dumps([list(name) for name in names]).encode('utf8')}
+    if pickled_columns:
+        metadata[_PICKLED_COLUMNS_KEY] = pickle.dumps(pickled_columns, protocol=2)
+    table = table.replace_schema_metadata(metadata)
+    sink = pyarrow.BufferOutputStream()
+    options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+    with pyarrow.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _decode_arrow(data):
+    table = pyarrow.ipc.open_stream(pyarrow.py_buffer(data)).read_all()
+    metadata = table.schema.metadata
+    names = [tuple(name) for name in json.loads(metadata[_COLUMNS_KEY].decode('utf8'))]
+    if _PICKLED_COLUMNS_KEY in metadata:
+        pickled_columns = pickle.loads(metadata[_PICKLED_COLUMNS_KEY])
+    else:
+        pickled_columns = {}
+    if _INDEX_FIELD in table.column_names:
+        index = pandas.Index(table.column(_INDEX_FIELD).to_pandas().array)
+        table = table.drop([_INDEX_FIELD])
+    else:
+        index = None
+    # Drop our metadata so that pyarrow uses only its own to reconstruct the frame:
+    df = table.replace_schema_metadata(None).to_pandas()
+    for i, field in enumerate(df.columns):
+        if df.dtypes.iloc[i] == object:
+            # Arrow nulls come back as None, lyse uses NaN for missing values:
+            values = df.iloc[:, i]
+            df[field] = values.where(values.notna(), np.nan)
+    for i in sorted(pickled_columns):
+        df.insert(i, str(i), pickled_columns[i])
+    if index is not None:
+        df.index = index
+    if not names:
+        return df
+    nlevels = max(len(name) for name in names)
+    if nlevels > 1:
+        df.columns = pandas.MultiIndex.from_tuples(names)
+    else:
+        df.columns = pandas.Index([name[0] for name in names])
+    return df
+
+
+def encode_dataframe(df, format='pickle', compression=None):
+    """Encode a dataframe for sending to another process. Returns a (format, data)
+    tuple for passing to decode_dataframe(). If format is 'arrow' but pyarrow is not
+    installed, the dataframe is pickled instead, so the returned format may differ
+    from that requested. compression may be 'lz4' or 'zstd', and applies to the
+    Arrow format only."""
+    if format not in FORMATS:
+        raise ValueError('format must be one of %s, not %r' % (FORMATS, format))
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression must be one of %s, not %r' % (COMPRESSIONS, compression))
+    if format == 'arrow' and pyarrow is not None:
+        return 'arrow', _encode_arrow(df, compression)
+    return 'pickle', pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_dataframe(encoded):
+    """Decode a dataframe from the (format, data) tuple returned by
+    encode_dataframe(). The format may also be 'shm', in which case data is the
+    metadata of a dataframe in shared memory, and the numeric columns of the
+    dataframe returned are read-only views of it."""
+    format, data = encoded
+    if format == 'shm':
+        return attach_dataframe(data)
+    elif format == 'arrow':
+        if pyarrow is None:
+            raise RuntimeError('pyarrow is required to decode Arrow-encoded dataframes')
+        return _decode_arrow(data)
+    elif format == 'pickle':
+        return pickle.loads(data)
+    raise ValueError('unknown dataframe encoding %r' % format)
@@ -19,13 +19,15 @@ if PY2:
 import labscript_utils.h5_lock, h5py
 import pandas
 import os
+import uuid
+import threading
+import functools
 from numpy import *
 import tzlocal
 import labscript_utils.shared_drive
 from labscript_utils.dict_diff import dict_diff
 from labscript_utils.connections import _ensure_str
 from labscript_utils.properties import get_attributes
-import runmanager
 
 
 def asdatetime(timestr):
@@ -34,45 +36,68 @@ def asdatetime(timestr):
     tz = tzlocal.get_localzone().zone
     return pandas.Timestamp(timestr, tz=tz)
 
+def _get_shot_globals(h5_file):
+    """Return the globals of an already open shot file, converted in the same way as
+    runmanager.get_shot_globals(), which we can't use here as it opens the file
+    itself."""
+    params = {}
+    for name, value in h5_file['globals'].attrs.items():
+        # Convert numpy bools to normal bools:
+        if isinstance(value, bool_):
+            value = bool(value)
+        # Convert null HDF references to None:
+        if isinstance(value, h5py.Reference) and not value:
+            value = None
+        # Convert numpy strings to Python ones:
+        if isinstance(value, str_):
+            value = str(value)
+        if isinstance(value, bytes):
+            value = value.decode()
+        params[name] = value
+    return params
+
 def get_nested_dict_from_shot(filepath):
-    row = runmanager.get_shot_globals(filepath)
+    # Everything is read in a single pass with the file opened (and the h5_lock
+    # acquired) only once, holding on to each group rather than looking it up again
+    # from the root of the file for every item within it:
     with h5py.File(filepath,'r') as h5_file:
+        row = _get_shot_globals(h5_file)
         if 'results' in h5_file:
-            for groupname in h5_file['results']:
-                resultsgroup = h5_file['results'][groupname]
+            for groupname, resultsgroup in h5_file['results'].items():
                 row[groupname] = get_attributes(resultsgroup)
         if 'images' in h5_file:
-            for orientation in h5_file['images'].keys():
-                if isinstance(h5_file['images'][orientation], h5py.Group):
-                    row[orientation] = get_attributes(h5_file['images'][orientation])
-                    for label in h5_file['images'][orientation]:
-                        row[orientation][label] = {}
-                        group = h5_file['images'][orientation][label]
-                        for image in group:
-                            row[orientation][label][image] = {}
-                            for key, val in get_attributes(group[image]).items():
-                                if not isinstance(val, h5py.Reference):
-                                    row[orientation][label][image][key] = val
+            for orientation, orientation_group in h5_file['images'].items():
+                if isinstance(orientation_group, h5py.Group):
+                    orientation_row = row[orientation] = get_attributes(orientation_group)
+                    for label, label_group in orientation_group.items():
+                        label_row = orientation_row[label] = {}
+                        for image, image_dataset in label_group.items():
+                            label_row[image] = {
+                                key: val
+                                for key, val in get_attributes(image_dataset).items()
+                                if not isinstance(val, h5py.Reference)
+                            }
+        attrs = h5_file.attrs
         row['filepath'] = _ensure_str(filepath)
         row['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
-        seq_id = _ensure_str(h5_file.attrs['sequence_id'])
+        seq_id = _ensure_str(attrs['sequence_id'])
         row['sequence'] = asdatetime(seq_id.split('_')[0])
         try:
-            row['sequence_index'] = h5_file.attrs['sequence_index']
+            row['sequence_index'] = attrs['sequence_index']
         except KeyError:
             row['sequence_index'] = None
         if 'script' in h5_file: 
             row['labscript'] = _ensure_str(h5_file['script'].attrs['name'])
         try:
-            row['run time'] = asdatetime(_ensure_str(h5_file.attrs['run time']))
+            row['run time'] = asdatetime(_ensure_str(attrs['run time']))
         except KeyError:
             row['run time'] = float('nan')
         try:    
-            row['run number'] = h5_file.attrs['run number']
+            row['run number'] = attrs['run number']
         except KeyError:
             row['run number'] = float('nan')
         try:
-            row['run repeat'] = h5_file.attrs['run repeat']
+            row['run repeat'] = attrs['run repeat']
         except KeyError:
             row['run repeat'] = 0
         return row
@@ -116,9 +141,12 @@ def flat_dict_to_flat_series(dictionary):
         (len(item),) + item if isinstance(item, tuple) else (1,item))
     return pandas.Series(result,index=keys)  
           
-def get_dataframe_from_shot(filepath):
+def get_flat_dict_from_shot(filepath):
     nested_dict = get_nested_dict_from_shot(filepath)
-    flat_dict =  flatten_dict(nested_dict)
+    return flatten_dict(nested_dict)
+
+def get_dataframe_from_shot(filepath):
+    flat_dict = get_flat_dict_from_shot(filepath)
     df = flat_dict_to_hierarchical_dataframe(flat_dict)
     return df
     
@@ -126,8 +154,7 @@ def get_dataframe_from_shots(filepaths):
     return concat_with_padding(*[get_dataframe_from_shot(filepath) for filepath in filepaths])
 
 def get_series_from_shot(filepath):
-    nested_dict = get_nested_dict_from_shot(filepath)
-    flat_dict =  flatten_dict(nested_dict)
+    flat_dict = get_flat_dict_from_shot(filepath)
     s = flat_dict_to_flat_series(flat_dict)
     return s
     
@@ -158,6 +185,9 @@ def concat_with_padding(*dataframes):
     return pandas.concat(dataframes, ignore_index=True)
     
 def replace_with_padding(df, row, index):
+    """Return a copy of df with the row at the given index replaced by the single
+    row DataFrame row. This copies the whole DataFrame - to replace rows in place,
+    use ColumnStore.replace_row()."""
     if df.columns.nlevels < row.columns.nlevels:
         df = pad_columns(df, row.columns.nlevels)
     elif df.columns.nlevels > row.columns.nlevels:
@@ -165,14 +195,356 @@ def replace_with_padding(df, row, index):
 
     # Change the index of the row object to equal that of where it is to be
     # inserted:
-    row.index = pandas.Int64Index([index])
+    row.index = pandas.Index([index])
 
-    # Replace the target row in the dataframe by dropping, appending, then
+    # Replace the target row in the dataframe by dropping, concatenating, then
     # sorting by index:
     df = df.drop([index])
-    df = df.append(row)
+    df = pandas.concat([df, row])
     df = df.sort_index()
     return df
-    
 
-    
+
+def _is_missing(value):
+    """Whether a value is the NaN used as padding in DataFrames for rows with no
+    value in a column"""
+    return isinstance(value, float) and value != value
+
+
+def dataframe_to_flat_dicts(df):
+    """Return a list of flat dictionaries, one per row of the DataFrame, with the
+    (padded) column names as keys. NaN values are omitted, as they are taken to be
+    padding for rows that have no value in that column."""
+    names = [name if isinstance(name, tuple) else (name,) for name in df.columns]
+    columns = [df.iloc[:, i].values for i in range(len(names))]
+    return [
+        {name: value for name, value in zip(names, values) if not _is_missing(value)}
+        for values in zip(*columns)
+    ]
+
+
+def set_dataframe_index(df, integer_indexing=False):
+    """Index a dataframe of shots in place as lyse.data() does, by sequence and run
+    time, or if integer_indexing is True, by sequence index, run number and run
+    repeat, and sort it by the index. A dataframe without those columns keeps its
+    RangeIndex. Returns the dataframe."""
+    try:
+        padding = ('',)*(df.columns.nlevels - 1)
+        if integer_indexing:
+            df.set_index(['sequence_index', 'run number', 'run repeat'], inplace=True, drop=False)
+        else:
+            df.set_index([('sequence',) + padding,('run time',) + padding], inplace=True, drop=False)
+            df.index.names = ['sequence', 'run time']
+    except KeyError:
+        # Empty DataFrame or index column not found, so fall back to RangeIndex instead
+        pass
+    df.sort_index(inplace=True)
+    return df
+
+
+def _locked(method):
+    """Decorator for ColumnStore methods to be called with its lock held"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class ColumnStore(object):
+    """An append-optimised store of the data from shot files, one row per shot, from
+    which pandas DataFrames with hierarchical column labels are produced only on
+    request.
+
+    Each column is an object array with spare capacity that is doubled whenever it
+    runs out, so adding a row costs time proportional to the number of values in it,
+    rather than to the size of the store as concatenating DataFrames does. Rows
+    without a value in a column are NaN in DataFrames, as with concat_with_padding(),
+    and a boolean array alongside each column records which rows actually have a
+    value.
+
+    Column names are tuples padded with empty strings to nlevels, which grows (but
+    never shrinks) to fit the deepest name added, and which is at least 2 so that
+    the columns of DataFrames produced are a MultiIndex. Methods taking column names
+    accept them padded or not.
+
+    Every modification increments version, and the version at which each row was
+    last modified is recorded, so that the rows changed since a given version can
+    be found without comparing data. Removing rows renumbers the remaining ones,
+    and increasing nlevels renames every column, so these also set
+    structure_version, before which changes cannot be described row by row. id is
+    unique to each ColumnStore, so that versions from different stores, for example
+    from before and after lyse is restarted, are not confused.
+
+    Modifications are made with lock held, and dataframe() and get_update() hold it
+    only while copying out the values they need, so they may be called from another
+    thread than the one modifying the store, without the DataFrame being built
+    holding up modifications."""
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, columns=()):
+        self.nlevels = 2
+        self.capacity = self.INITIAL_CAPACITY
+        self.n_rows = 0
+        # Column names in the order they were added, and their positions in that list:
+        self.columns = []
+        self.column_positions = {}
+        # The values of each column and whether each row has a value, by position:
+        self._values = []
+        self._present = []
+        # The version at which each row was last modified:
+        self._row_versions = zeros(self.capacity, dtype=int64)
+        self.id = uuid.uuid4().hex
+        self.version = 0
+        self.structure_version = 0
+        # The most recent DataFrame produced, until the store is next modified:
+        self._dataframe = None
+        self.lock = threading.RLock()
+        for name in columns:
+            self._column_position(name)
+
+    def __len__(self):
+        return self.n_rows
+
+    def _padded(self, name):
+        if not isinstance(name, tuple):
+            name = (name,)
+        return name + ('',) * (self.nlevels - len(name))
+
+    def _increase_nlevels(self, nlevels):
+        padding = ('',) * (nlevels - self.nlevels)
+        self.version += 1
+        self.structure_version = self.version
+        self.nlevels = nlevels
+        self.columns = [name + padding for name in self.columns]
+        self.column_positions = {name: i for i, name in enumerate(self.columns)}
+
+    def _new_values(self):
+        return full(self.capacity, nan, dtype=object)
+
+    def _column_position(self, name):
+        """Return the position of the named column, adding it if it doesn't exist"""
+        if not isinstance(name, tuple):
+            name = (name,)
+        if len(name) > self.nlevels:
+            self._increase_nlevels(len(name))
+        name = self._padded(name)
+        try:
+            return self.column_positions[name]
+        except KeyError:
+            position = len(self.columns)
+            self.columns.append(name)
+            self.column_positions[name] = position
+            self._values.append(self._new_values())
+            self._present.append(zeros(self.capacity, dtype=bool))
+            return position
+
+    def _reserve(self, n_rows):
+        """Ensure there is capacity for at least n_rows rows"""
+        if n_rows <= self.capacity:
+            return
+        while self.capacity < n_rows:
+            self.capacity *= 2
+        for position in range(len(self.columns)):
+            values = self._new_values()
+            values[:self.n_rows] = self._values[position][:self.n_rows]
+            present = zeros(self.capacity, dtype=bool)
+            present[:self.n_rows] = self._present[position][:self.n_rows]
+            self._values[position] = values
+            self._present[position] = present
+        row_versions = zeros(self.capacity, dtype=int64)
+        row_versions[:self.n_rows] = self._row_versions[:self.n_rows]
+        self._row_versions = row_versions
+
+    def _modified(self, row_numbers):
+        """Record that the given rows (a slice, list or int) have been modified"""
+        self.version += 1
+        self._row_versions[row_numbers] = self.version
+        self._dataframe = None
+
+    def _check_row_number(self, row_number):
+        if not 0 <= row_number < self.n_rows:
+            raise IndexError('row %d out of range for %d rows' % (row_number, self.n_rows))
+
+    @_locked
+    def append_rows(self, rows):
+        """Append rows, each a flat dictionary as returned by
+        get_flat_dict_from_shot(), adding any new columns required"""
+        self._reserve(self.n_rows + len(rows))
+        first_row = self.n_rows
+        for row in rows:
+            for name, value in row.items():
+                position = self._column_position(name)
+                self._values[position][self.n_rows] = value
+                self._present[position][self.n_rows] = True
+            self.n_rows += 1
+        self._modified(slice(first_row, self.n_rows))
+
+    def append_dataframe(self, df):
+        """Append the rows of a DataFrame, such as one produced by dataframe(). NaN
+        values are treated as the row not having a value in that column."""
+        self.append_rows(dataframe_to_flat_dicts(df))
+
+    @_locked
+    def remove_rows(self, row_numbers):
+        """Remove the given rows. Remaining rows are renumbered to be contiguous,
+        keeping their order. Columns are retained even if no rows have a value in
+        them anymore."""
+        keep = ones(self.n_rows, dtype=bool)
+        keep[list(row_numbers)] = False
+        n_rows = int(keep.sum())
+        for position in range(len(self.columns)):
+            values = self._new_values()
+            values[:n_rows] = self._values[position][:self.n_rows][keep]
+            present = zeros(self.capacity, dtype=bool)
+            present[:n_rows] = self._present[position][:self.n_rows][keep]
+            self._values[position] = values
+            self._present[position] = present
+        row_versions = zeros(self.capacity, dtype=int64)
+        row_versions[:n_rows] = self._row_versions[:self.n_rows][keep]
+        self._row_versions = row_versions
+        self.n_rows = n_rows
+        self._modified([])
+        self.structure_version = self.version
+
+    @_locked
+    def set_value(self, row_number, name, value):
+        """Set the value of one row in the named column, adding the column if it
+        does not exist"""
+        self._check_row_number(row_number)
+        position = self._column_position(name)
+        self._values[position][row_number] = value
+        self._present[position][row_number] = True
+        self._modified(row_number)
+
+    @_locked
+    def replace_row(self, row_number, row):
+        """Replace the values of a row with those in row, a flat dictionary as
+        returned by get_flat_dict_from_shot(). The row will have no value in
+        columns not present in the dictionary, and new columns are added as
+        required. This is done in place, in time proportional to the number of
+        columns."""
+        self._check_row_number(row_number)
+        for position in range(len(self.columns)):
+            self._values[position][row_number] = nan
+            self._present[position][row_number] = False
+        for name, value in row.items():
+            position = self._column_position(name)
+            self._values[position][row_number] = value
+            self._present[position][row_number] = True
+        self._modified(row_number)
+
+    def get_value(self, row_number, name):
+        """Return the value of one row in the named column. This is NaN if the row
+        has no value in the column, and KeyError is raised if there is no such
+        column."""
+        self._check_row_number(row_number)
+        return self._values[self.column_positions[self._padded(name)]][row_number]
+
+    def get_row(self, row_number, include_missing=True):
+        """Return a dict of a row's values, keyed by padded column name. If
+        include_missing is False, columns in which the row has no value are
+        omitted, otherwise they are NaN."""
+        self._check_row_number(row_number)
+        if include_missing:
+            return {name: self._values[i][row_number] for i, name in enumerate(self.columns)}
+        return {
+            name: self._values[i][row_number]
+            for i, name in enumerate(self.columns)
+            if self._present[i][row_number]
+        }
+
+    def get_flat_dict(self, row_number):
+        """Return a dict of the values a row has, keyed by column name without
+        padding, in the form returned by get_flat_dict_from_shot()"""
+        flat_dict = {}
+        for name, value in self.get_row(row_number, include_missing=False).items():
+            while len(name) > 1 and name[-1] == '':
+                name = name[:-1]
+            flat_dict[name] = value
+        return flat_dict
+
+    def changed_rows(self, version):
+        """Return an array of the numbers of the rows modified since the given
+        version, or None if the structure of the store has changed since then, in
+        which case all rows should be considered changed."""
+        if version < self.structure_version or version > self.version:
+            return None
+        return flatnonzero(self._row_versions[:self.n_rows] > version)
+
+    def _snapshot(self, row_numbers=None):
+        """Return copies of the data needed to build a DataFrame of the given rows,
+        or all rows if None, for passing to _build_dataframe(). Must be called with
+        the lock held."""
+        names = sorted(self.columns)
+        if row_numbers is None:
+            rows = arange(self.n_rows)
+            index = None
+        else:
+            rows = index = asarray(row_numbers, dtype=int64)
+        # Indexing with an array of row numbers makes copies of the values:
+        data = {name: self._values[self.column_positions[name]][rows] for name in names}
+        return names, data, index
+
+    @staticmethod
+    def _build_dataframe(names, data, index):
+        if not names:
+            return pandas.DataFrame()
+        df = pandas.DataFrame(data, columns=pandas.MultiIndex.from_tuples(names), index=index)
+        return df.infer_objects()
+
+    def _cache_dataframe(self, df, version):
+        """Cache a DataFrame of all rows, built from a snapshot at the given version,
+        if the store has not been modified since"""
+        with self.lock:
+            if self.version == version:
+                self._dataframe = df
+
+    def dataframe(self, row_numbers=None):
+        """Return a DataFrame of the data in the store, with sorted, hierarchical
+        column labels, a RangeIndex, and columns converted from dtype object to
+        more specific types where possible. The DataFrame is cached until the store
+        is next modified, so it must not be modified by the caller.
+
+        If row_numbers is given, the DataFrame instead contains only those rows,
+        indexed by row number, and is not cached."""
+        with self.lock:
+            if row_numbers is None and self._dataframe is not None:
+                return self._dataframe
+            version = self.version
+            snapshot = self._snapshot(row_numbers)
+        df = self._build_dataframe(*snapshot)
+        if row_numbers is None:
+            self._cache_dataframe(df, version)
+        return df
+
+    def get_update(self, since=None):
+        """Return a dict describing the dataframe in terms of the changes made to it
+        since the version since, an (id, version) tuple as returned in a previous
+        call. If since is None, is from a different ColumnStore, or predates rows
+        being removed or the columns' levels increasing, 'dataframe' is the full
+        dataframe, otherwise 'rows' is a dataframe of the rows that have changed,
+        indexed by row number, which may include columns not previously present.
+        The update is consistent, that is, it describes the store at one version,
+        even if the store is modified from another thread meanwhile."""
+        with self.lock:
+            version = self.version
+            update = {'id': self.id, 'version': version, 'n_rows': self.n_rows,
+                      'dataframe': None, 'rows': None}
+            changed_rows = None
+            if since is not None:
+                store_id, since_version = since
+                if store_id == self.id:
+                    changed_rows = self.changed_rows(since_version)
+            if changed_rows is None and self._dataframe is not None:
+                update['dataframe'] = self._dataframe
+                return update
+            snapshot = self._snapshot(changed_rows)
+        df = self._build_dataframe(*snapshot)
+        if changed_rows is None:
+            self._cache_dataframe(df, version)
+            update['dataframe'] = df
+        else:
+            update['rows'] = df
+        return update
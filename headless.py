@@ -0,0 +1,366 @@
+#####################################################################
+#                                                                   #
+# /headless.py                                                      #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Run lyse without its graphical interface, for example on a machine with no
+display:
+
+    python -m lyse.headless [lyse_config.ini]
+
+Shots are received and data served to lyse.data() on the same port and with the
+same protocol as the lyse GUI. The analysis routines to run are those that are
+active in the given lyse configuration file, as saved by the GUI, and they run in
+the order saved there. Routine workers have no Qt application, and render figures
+off-screen with matplotlib's Agg backend, so figures are not shown, but may be
+saved to file by the routines.
+
+Shots are analysed one at a time in the order received. As in the GUI, each
+routine runs as soon as the routines it depends on (see lyse.depends_on()) are
+done, and multishot analysis runs according to the multishot policy saved in the
+configuration file. Analysis is not paused when a routine raises an exception, as
+there is nobody to resume it. Instead the error is logged and the remaining
+routines skipped for that shot.
+
+Routines run in a single worker process each. A configuration with more worker
+processes for a routine is refused, and routines that call
+lyse.analyse_in_batches() are given one shot at a time, with a warning."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+    import Queue as queue
+else:
+    import queue
+
+import os
+import sys
+import ast
+import time
+import signal
+import logging
+import argparse
+import threading
+
+from labscript_utils.ls_zprocess import ProcessTree
+from labscript_utils.labconfig import LabConfig
+from labscript_utils.setup_logging import setup_logging
+
+from lyse import LYSE_DIR
+from lyse.dataframe_utilities import ColumnStore, flat_dict_to_flat_series
+from lyse.shot_cache import ShotReader
+from lyse.multishot_scheduler import MultishotScheduler
+from lyse.routine_chain import run_routines
+from lyse.server import WebServer
+
+process_tree = ProcessTree.instance()
+
+logger = logging.getLogger('lyse.headless')
+
+
+class HeadlessRoutine(object):
+    """An analysis routine, run in a worker process with no Qt application"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.shortname = os.path.basename(self.filepath)
+        # The name of the group in shot files the routine saves results to:
+        self.results_group = self.shortname.split('.py')[0]
+        # Information about the worker sent with the results of each run:
+        self.worker_info = {}
+        # Whether the user has been told that shots are not analysed in batches:
+        self.warned_batches = False
+        self.to_worker, self.from_worker, self.worker = self.start_worker()
+
+    def start_worker(self):
+        worker_path = os.path.join(LYSE_DIR, 'analysis_subprocess.py')
+        # Output is not redirected, so goes to our own stdout and stderr:
+        to_worker, from_worker, worker = process_tree.subprocess(worker_path, startup_timeout=30)
+        to_worker.put([self.filepath, {'headless': True}])
+        return to_worker, from_worker, worker
+
+    def do_analysis(self, filepath):
+        """Run the routine on a shot, or on no shot for a multishot routine, and
+        return (success, updated_data)"""
+        self.to_worker.put(['analyse', filepath])
+        message = self.from_worker.get()
+        signal, data = message[:2]
+        if len(message) > 2:
+            self.worker_info = message[2]
+        if signal not in ('done', 'error'):
+            raise ValueError('invalid signal %s'%str(signal))
+        if (self.worker_info.get('max_batch_size') or 1) > 1 and not self.warned_batches:
+            logger.warning('%s calls lyse.analyse_in_batches(), but headless lyse gives it '
+                           'one shot at a time' % self.shortname)
+            self.warned_batches = True
+        return signal == 'done', data
+
+    def end_child(self, timeout=2):
+        self.to_worker.put(['quit', None])
+        timeout_time = time.time() + timeout
+        while self.worker.poll() is None and time.time() < timeout_time:
+            time.sleep(0.05)
+        if self.worker.poll() is None:
+            logger.warning('%s worker not responding, killing it' % self.shortname)
+            self.worker.kill()
+            self.worker.wait()
+
+
+class HeadlessLyse(object):
+    """Receives shots, reads them into a dataframe, and runs analysis routines on
+    them, like the lyse GUI but with no Qt models or windows. Provides the methods
+    the WebServer needs to serve requests."""
+
+    # The most shots the incoming thread will read and add to the dataframe at once:
+    INCOMING_BATCH_SIZE = 250
+
+    def __init__(self, config_file=None):
+        self.exp_config = LabConfig(required_params={"ports": ["lyse"]})
+        self.port = int(self.exp_config.get('ports', 'lyse'))
+
+        # The data from all shots, and which of them have been analysed. These are
+        # accessed from several threads, so only with the lock held, except for
+        # reading the dataframe, which the ColumnStore's own lock makes safe:
+        self.lock = threading.Lock()
+        self.column_store = ColumnStore()
+        self.row_number_by_filepath = {}
+        self.analysed = []
+
+        self.singleshot_routines = []
+        self.multishot_routines = []
+        # When to run multishot analysis, as in the GUI:
+        self.multishot_scheduler = MultishotScheduler()
+        if config_file is not None:
+            self.load_configuration(config_file)
+
+        # Reads shot files as in the GUI. Only used by the incoming thread:
+        self.shot_reader = ShotReader.from_labconfig(self.exp_config, warn=logger.warning)
+
+        self.incoming_queue = queue.Queue()
+        self.analysis_pending = threading.Event()
+
+        self.incoming = threading.Thread(target=self.incoming_loop)
+        self.incoming.daemon = True
+        self.incoming.start()
+
+        self.analysis = threading.Thread(target=self.analysis_loop)
+        self.analysis.daemon = True
+        self.analysis.start()
+
+    def load_configuration(self, filename):
+        """Start workers for the routines active in a lyse configuration file, and
+        set the multishot policy saved in it. Raises ValueError if the configuration
+        uses features headless lyse does not support."""
+        lyse_config = LabConfig(filename)
+        routine_files = {}
+        for key in ['SingleShot', 'MultiShot']:
+            try:
+                routine_files[key] = ast.literal_eval(lyse_config.get('lyse_state', key))
+            except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+                routine_files[key] = []
+        for routine_file in routine_files['SingleShot']:
+            # checked is a Qt check state, which is zero if unchecked:
+            filepath, checked = routine_file[:2]
+            n_replicas = routine_file[2] if len(routine_file) > 2 else 1
+            if checked and n_replicas > 1:
+                raise ValueError(
+                    '%s is configured to run in %d worker processes, but headless lyse '
+                    'runs each routine in one. Set it to one worker process in the lyse '
+                    'GUI and save the configuration again.' % (filepath, n_replicas)
+                )
+        try:
+            self.multishot_scheduler.set_policy(
+                *ast.literal_eval(lyse_config.get('lyse_state', 'multishot_policy'))
+            )
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            pass
+        logger.info('multishot policy: %s, n = %s' % (self.multishot_scheduler.policy,
+                                                      self.multishot_scheduler.n))
+        for key, routines in [('SingleShot', self.singleshot_routines),
+                              ('MultiShot', self.multishot_routines)]:
+            for routine_file in routine_files[key]:
+                filepath, checked = routine_file[:2]
+                if not checked:
+                    continue
+                logger.info('starting %s routine %s' % (key, filepath))
+                routines.append(HeadlessRoutine(filepath))
+
+    def get_dataframe(self):
+        return self.column_store.dataframe()
+
+    def get_dataframe_update(self, since):
+        """As DataFrameModel.get_dataframe_update() in the GUI"""
+        return self.column_store.get_update(since)
+
+    def get_series(self, filepath):
+        with self.lock:
+            try:
+                row_number = self.row_number_by_filepath[filepath]
+            except KeyError:
+                return None
+            # Results are added to the dataframe as soon as each routine finishes,
+            # so there are no others still to be included:
+            flat_dict = self.column_store.get_flat_dict(row_number)
+        return flat_dict_to_flat_series(flat_dict)
+
+    def add_shot(self, filepath):
+        self.incoming_queue.put(filepath)
+
+    def incoming_loop(self):
+        while True:
+            try:
+                filepaths = [self.incoming_queue.get()]
+                if self.incoming_queue.qsize() == 0:
+                    # Wait momentarily in case more arrive so we can batch process them:
+                    time.sleep(0.1)
+                while len(filepaths) < self.INCOMING_BATCH_SIZE:
+                    try:
+                        filepaths.append(self.incoming_queue.get(False))
+                    except queue.Empty:
+                        break
+                # Remove duplicates, preserving order:
+                filepaths = sorted(set(filepaths), key=filepaths.index)
+                with self.lock:
+                    filepaths = [f for f in filepaths if f not in self.row_number_by_filepath]
+                logger.info('adding:\n%s' % '\n'.join(filepaths))
+                rows = self.shot_reader.read(filepaths)
+                added = [(filepath, row) for filepath, row in zip(filepaths, rows) if row is not None]
+                if not added:
+                    continue
+                with self.lock:
+                    self.column_store.append_rows([row for _, row in added])
+                    for filepath, _ in added:
+                        self.row_number_by_filepath[filepath] = len(self.analysed)
+                        self.analysed.append(False)
+                self.analysis_pending.set()
+            except Exception:
+                # Keep this incoming loop running at all costs:
+                logger.exception('Exception in incoming loop')
+
+    def get_first_incomplete(self):
+        with self.lock:
+            for row_number, analysed in enumerate(self.analysed):
+                if not analysed:
+                    return self.column_store.get_value(row_number, 'filepath')
+
+    def get_sequence(self, filepath):
+        """The value of the 'sequence' column for a shot, or None if there is none"""
+        with self.lock:
+            try:
+                return self.column_store.get_value(self.row_number_by_filepath[filepath], 'sequence')
+            except KeyError:
+                return None
+
+    def update_rows(self, updated_data):
+        """Add the results saved by a routine, keyed by filepath then by (group,
+        name), to the dataframe"""
+        with self.lock:
+            for filepath, updated_row_data in updated_data.items():
+                try:
+                    row_number = self.row_number_by_filepath[filepath]
+                except KeyError:
+                    # Not a shot we have loaded:
+                    continue
+                for (group, name), value in updated_row_data.items():
+                    self.column_store.set_value(row_number, (group, name), value)
+
+    def set_analysed(self, filepath):
+        with self.lock:
+            self.analysed[self.row_number_by_filepath[filepath]] = True
+
+    def run_routines(self, routines, filepath):
+        """Run routines on a shot, each as soon as those it depends on are done, as
+        in the GUI, and starting no more once one fails. Returns whether they all
+        succeeded."""
+        def run_routine(routine):
+            logger.info('running %s on %s' % (routine.shortname, filepath))
+            return routine.do_analysis(filepath)
+
+        def on_result(routine, success, updated_data, n_done):
+            self.update_rows(updated_data)
+            if not success:
+                logger.error('%s failed on %s, skipping remaining routines' % (routine.shortname, filepath))
+
+        return run_routines(routines, run_routine, on_result)
+
+    def run_multishot(self):
+        logger.info('doing multishot analysis')
+        if self.multishot_routines:
+            self.run_routines(self.multishot_routines, None)
+        self.multishot_scheduler.ran()
+
+    def analysis_loop(self):
+        while True:
+            try:
+                # Wake up when multishot analysis is due, if the multishot policy
+                # is time based:
+                self.analysis_pending.wait(self.multishot_scheduler.timeout())
+                self.analysis_pending.clear()
+                while True:
+                    filepath = self.get_first_incomplete()
+                    if filepath is None:
+                        break
+                    if self.multishot_scheduler.sequence_starting(self.get_sequence(filepath)):
+                        self.run_multishot()
+                        continue
+                    if os.path.exists(filepath):
+                        self.run_routines(self.singleshot_routines, filepath)
+                    else:
+                        logger.warning('Shot deleted from disk or no longer readable %s' % filepath)
+                    self.set_analysed(filepath)
+                    if self.multishot_scheduler.shot_done():
+                        self.run_multishot()
+                if self.multishot_scheduler.queue_empty():
+                    self.run_multishot()
+            except Exception:
+                # Keep the analysis loop running at all costs:
+                logger.exception('Exception in analysis loop')
+
+    def shutdown(self):
+        for routine in self.singleshot_routines + self.multishot_routines:
+            routine.end_child()
+        self.shot_reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run lyse with no graphical interface.')
+    parser.add_argument(
+        'config_file',
+        nargs='?',
+        default=None,
+        help='lyse configuration file, as saved by the lyse GUI, to load analysis routines from',
+    )
+    args = parser.parse_args()
+
+    setup_logging('lyse')
+    logger.info('\n\n===============starting headless===============\n')
+    process_tree.zlock_client.set_process_name('lyse')
+
+    try:
+        app = HeadlessLyse(args.config_file)
+    except ValueError as e:
+        # A configuration headless lyse cannot run as the GUI would:
+        logger.error(str(e))
+        sys.exit('error: %s' % str(e))
+    server = WebServer(app, app.port)
+    print('lyse running headless on port %d. Press Ctrl-C to quit.' % app.port)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    # Wait with a timeout so that the interpreter sees the signals:
+    while not stop.wait(0.5):
+        pass
+    server.shutdown()
+    app.shutdown()
+
+
+if __name__ == '__main__':
+    main()
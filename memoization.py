@@ -0,0 +1,197 @@
+#####################################################################
+#                                                                   #
+# /memoization.py                                                   #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Fingerprints of the inputs of single-shot analysis routines, so that a routine
+need not be run again on a shot when nothing it depends on has changed.
+
+A routine's fingerprint on a shot is a hash of the routine's source, the user
+modules it has imported, the shot's globals, and the result groups of other
+routines it read from the shot. After a routine runs successfully, its fingerprint
+is stored in the shot file, in the /lyse/fingerprints group, along with the names
+of the result groups and module files it read. Before it runs again, the
+fingerprint is computed again from the same inputs, and if it is unchanged, the
+run can be skipped and the results already in the shot file used instead.
+
+Enabled with the [lyse] skip_unchanged_reruns labconfig option."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import sys
+import json
+import hashlib
+import sysconfig
+
+import numpy as np
+import labscript_utils.h5_lock, h5py
+from labscript_utils.properties import get_attributes
+
+FINGERPRINTS_GROUP = 'lyse/fingerprints'
+
+# In the names of result groups read by a routine, meaning all of them:
+ALL_RESULTS = '*'
+
+
+def _update_hash(hasher, value):
+    """Hash a value read from an HDF5 file. Arrays are hashed by their contents
+    rather than their repr, which numpy abbreviates for large arrays."""
+    if isinstance(value, np.ndarray):
+        hasher.update(str(value.dtype).encode('utf8'))
+        hasher.update(str(value.shape).encode('utf8'))
+        if value.dtype.kind == 'O':
+            hasher.update(repr(value.tolist()).encode('utf8'))
+        else:
+            hasher.update(np.ascontiguousarray(value).tobytes())
+    else:
+        hasher.update(repr(value).encode('utf8'))
+
+
+def hash_group(group):
+    """Return a hash of the attributes and datasets of an HDF5 group and all its
+    subgroups"""
+    hasher = hashlib.sha1()
+    items = [('', group)]
+    group.visititems(lambda name, obj: items.append((name, obj)))
+    for name, obj in sorted(items, key=lambda item: item[0]):
+        hasher.update(name.encode('utf8'))
+        attrs = get_attributes(obj)
+        for attr_name in sorted(attrs):
+            hasher.update(attr_name.encode('utf8'))
+            _update_hash(hasher, attrs[attr_name])
+        if isinstance(obj, h5py.Dataset):
+            _update_hash(hasher, obj[()])
+    return hasher.hexdigest()
+
+
+def results_groups_read(h5_file, groups_read, own_group):
+    """Return the sorted names of the result groups a routine has read, given the
+    names it recorded, which may include ALL_RESULTS. The routine's own group is
+    excluded, as are groups that do not exist."""
+    if 'results' not in h5_file:
+        return []
+    if ALL_RESULTS in groups_read:
+        groups = set(h5_file['results'])
+    else:
+        groups = set(group for group in groups_read if group in h5_file['results'])
+    groups.discard(own_group)
+    return sorted(groups)
+
+
+class ModuleHasher(object):
+    """Computes hashes of the source files of user modules, which are those not in
+    the standard library or installed packages. Hashes are recomputed only if a
+    file's mtime or size has changed."""
+
+    def __init__(self):
+        self.library_dirs = set()
+        for name in ['stdlib', 'platstdlib', 'purelib', 'platlib']:
+            try:
+                self.library_dirs.add(os.path.realpath(sysconfig.get_paths()[name]))
+            except KeyError:
+                pass
+        self.library_dirs.update(os.path.realpath(p) for p in [sys.prefix, sys.exec_prefix])
+        # (mtime, size, hash) by filepath:
+        self.hashes = {}
+
+    def is_user_module(self, filepath):
+        filepath = os.path.realpath(filepath)
+        return not any(filepath.startswith(d + os.sep) for d in self.library_dirs)
+
+    def file_hash(self, filepath):
+        st = os.stat(filepath)
+        cached = self.hashes.get(filepath)
+        if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+        with open(filepath, 'rb') as f:
+            file_hash = hashlib.sha1(f.read()).hexdigest()
+        self.hashes[filepath] = (st.st_mtime, st.st_size, file_hash)
+        return file_hash
+
+    def user_module_files(self, module_names):
+        """Return the sorted source filepaths of the user modules among those
+        named"""
+        filepaths = set()
+        for name in module_names:
+            module = sys.modules.get(name)
+            filepath = getattr(module, '__file__', None)
+            if not filepath:
+                continue
+            if filepath.endswith('.pyc'):
+                filepath = filepath[:-1]
+            if filepath.endswith('.py') and self.is_user_module(filepath):
+                filepaths.add(filepath)
+        return sorted(filepaths)
+
+    def file_hashes(self, filepaths):
+        """Return a list of (filepath, hash) for the given files, with None as the
+        hash of any that no longer exist"""
+        hashes = []
+        for filepath in filepaths:
+            try:
+                hashes.append((filepath, self.file_hash(filepath)))
+            except (IOError, OSError):
+                hashes.append((filepath, None))
+        return hashes
+
+
+def fingerprint(h5_file, routine_hash, module_hashes, results_groups):
+    """Return the fingerprint of a routine's inputs from an open shot file, given
+    the hash of the routine's source, the (filepath, hash) of the user modules it
+    imported, and the names of the result groups it read"""
+    hasher = hashlib.sha1()
+    hasher.update(routine_hash.encode('utf8'))
+    hasher.update(json.dumps(module_hashes).encode('utf8'))
+    if 'globals' in h5_file:
+        attrs = get_attributes(h5_file['globals'])
+        for name in sorted(attrs):
+            hasher.update(name.encode('utf8'))
+            _update_hash(hasher, attrs[name])
+    for group in results_groups:
+        hasher.update(group.encode('utf8'))
+        hasher.update(hash_group(h5_file['results'][group]).encode('utf8'))
+    return hasher.hexdigest()
+
+
+def get_stored(h5_file, own_group):
+    """Return the (fingerprint, inputs) stored for a routine in an open shot file,
+    or (None, None) if there are none. inputs is the dict passed to store()."""
+    try:
+        attrs = h5_file[FINGERPRINTS_GROUP][own_group].attrs
+        fingerprint = attrs['fingerprint']
+        inputs = attrs['inputs']
+    except KeyError:
+        return None, None
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.decode('utf8')
+    if isinstance(inputs, bytes):
+        inputs = inputs.decode('utf8')
+    return fingerprint, json.loads(inputs)
+
+
+def store(h5_file, own_group, fingerprint, inputs):
+    """Store the fingerprint of a routine's inputs in an open shot file, along with
+    a JSON-serialisable dict of what is needed to compute it again, and anything
+    else to restore if the routine's next run is skipped"""
+    group = h5_file.require_group(FINGERPRINTS_GROUP).require_group(own_group)
+    group.attrs['fingerprint'] = fingerprint
+    group.attrs['inputs'] = json.dumps(inputs)
+
+
+def clear(h5_path):
+    """Remove all stored fingerprints from a shot file, so that all routines will
+    run on it again"""
+    with h5py.File(h5_path, 'a') as h5_file:
+        if FINGERPRINTS_GROUP in h5_file:
+            del h5_file[FINGERPRINTS_GROUP]
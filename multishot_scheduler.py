@@ -0,0 +1,131 @@
+#####################################################################
+#                                                                   #
+# /multishot_scheduler.py                                           #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import time
+
+import pandas
+
+
+def _normalise_sequence(sequence):
+    """Return None if a shot's sequence is missing or NaN, as it is in the
+    dataframe for shots without sequence attributes, otherwise the sequence"""
+    try:
+        if pandas.isnull(sequence):
+            return None
+    except (TypeError, ValueError):
+        # Not a scalar:
+        pass
+    return sequence
+
+
+class MultishotScheduler(object):
+    """Decides when multishot analysis should run automatically, according to one
+    of the policies in POLICIES, which are:
+
+    'queue empty': whenever no shots are left to be analysed
+    'every n shots': after every n shots have been analysed
+    'interval': whenever shots have been analysed, but at most every n seconds
+    'end of sequence': when a shot from a different sequence than the previous
+        shot is about to be analysed
+    'idle': once no shots are left to be analysed and none have been analysed
+        for n seconds
+
+    Counts of the shots analysed since multishot analysis last ran ('pending'), and
+    of the times since then that multishot analysis would have run when no shots
+    were left, had the policy allowed it ('skipped') are kept for display."""
+
+    POLICIES = ['queue empty', 'every n shots', 'interval', 'end of sequence', 'idle']
+
+    def __init__(self, policy='queue empty', n=10):
+        self.policy = policy
+        self.n = n
+        self.pending = 0
+        self.skipped = 0
+        self.last_run_time = 0
+        self.last_shot_time = 0
+        self.last_sequence = None
+        # Whether analysis is paused, in which case nothing becomes due until it
+        # is resumed:
+        self.paused = False
+        # Whether the current run of shots has been counted as skipped:
+        self.skip_counted = False
+
+    def set_policy(self, policy, n):
+        if policy not in self.POLICIES:
+            raise ValueError('multishot policy must be one of %s, not %r' % (self.POLICIES, policy))
+        self.policy = policy
+        self.n = n
+
+    def shot_done(self):
+        """Record that a shot has been analysed, and return whether multishot
+        analysis should now run"""
+        self.pending += 1
+        self.last_shot_time = time.time()
+        self.skip_counted = False
+        if self.policy == 'every n shots':
+            return self.pending >= self.n
+        elif self.policy == 'interval':
+            return time.time() - self.last_run_time >= self.n
+        return False
+
+    def sequence_starting(self, sequence):
+        """Record that a shot from the given sequence is about to be analysed, and
+        return whether multishot analysis should run first because the previous
+        sequence has ended. Shots with a missing or NaN sequence are treated as
+        being from the same sequence as each other."""
+        sequence = _normalise_sequence(sequence)
+        if self.policy == 'end of sequence' and self.pending and sequence != self.last_sequence:
+            return True
+        self.last_sequence = sequence
+        return False
+
+    def queue_empty(self):
+        """Return whether multishot analysis should run now that no shots are left
+        to be analysed"""
+        if not self.pending:
+            return False
+        if self.policy == 'queue empty':
+            due = True
+        elif self.policy == 'interval':
+            due = time.time() - self.last_run_time >= self.n
+        elif self.policy == 'idle':
+            due = time.time() - self.last_shot_time >= self.n
+        else:
+            due = False
+        if not due and not self.skip_counted:
+            self.skipped += 1
+            self.skip_counted = True
+        return due
+
+    def timeout(self):
+        """How long until multishot analysis will be due if no more shots arrive,
+        or None if it will not become due with the passing of time alone"""
+        if not self.pending or self.paused:
+            return None
+        if self.policy == 'interval':
+            return max(self.last_run_time + self.n - time.time(), 0)
+        elif self.policy == 'idle':
+            return max(self.last_shot_time + self.n - time.time(), 0)
+        return None
+
+    def ran(self):
+        """Record that multishot analysis has run"""
+        self.pending = 0
+        self.skipped = 0
+        self.skip_counted = False
+        self.last_run_time = time.time()
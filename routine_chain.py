@@ -0,0 +1,188 @@
+#####################################################################
+#                                                                   #
+# /routine_chain.py                                                 #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Running a list of analysis routines on a shot, each as soon as the routines it
+depends on are done, and sharing a routine's worker processes between the shots
+it is run on. Shared by the lyse GUI and headless lyse, so has nothing to do with
+Qt. Routines are any objects with the attributes:
+
+    results_group: the name of the group in shot files the routine saves results
+        to, by which other routines name it in lyse.depends_on().
+    worker_info: a dict of information sent by the routine's worker with the
+        results of its last run, including 'depends_on'."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+    import Queue as queue
+else:
+    import queue
+
+import logging
+import threading
+
+logger = logging.getLogger('lyse.routine_chain')
+
+
+def get_dependencies(routines):
+    """Return a dict of the set of routines each routine must wait for before
+    running, given a list of routines in the order they are to be run. These are
+    those named in the routine's last call to lyse.depends_on() that are above it
+    in the list, or all routines above it if it did not call depends_on()."""
+    dependencies = {}
+    for i, routine in enumerate(routines):
+        depends_on = routine.worker_info.get('depends_on')
+        if depends_on is None:
+            dependencies[routine] = set(routines[:i])
+        else:
+            dependencies[routine] = set(r for r in routines[:i] if r.results_group in depends_on)
+    return dependencies
+
+
+def run_routines(routines, run_routine, on_result=None):
+    """Run routines, each in its own thread as soon as all routines it depends on
+    have succeeded, so that routines that do not depend on each other run at the
+    same time. run_routine(routine) must run a routine and return (success,
+    updated_data). If given, on_result(routine, success, updated_data, n_done) is
+    called in the calling thread as each routine finishes, where n_done is how many
+    have succeeded so far. Once a routine fails, no more are started, but those
+    already running are allowed to finish. Returns whether all succeeded."""
+    dependencies = get_dependencies(routines)
+    results = queue.Queue()
+
+    def run(routine):
+        try:
+            success, updated_data = run_routine(routine)
+        except Exception:
+            logger.exception('Exception running %r' % routine)
+            success, updated_data = False, {}
+        results.put((routine, success, updated_data))
+
+    running = set()
+    done = set()
+    error = False
+    while True:
+        if not error:
+            for routine in routines:
+                if routine in running or routine in done or not dependencies[routine] <= done:
+                    continue
+                running.add(routine)
+                thread = threading.Thread(target=run, args=(routine,))
+                thread.daemon = True
+                thread.start()
+        if not running:
+            break
+        routine, success, updated_data = results.get()
+        running.remove(routine)
+        if success:
+            done.add(routine)
+        else:
+            # Start no more routines, but let those already running finish:
+            error = True
+        if on_result is not None:
+            on_result(routine, success, updated_data, len(done))
+    return not error
+
+
+class ReplicaPool(object):
+    """The worker processes ('replicas') of a routine, numbered from zero, which
+    each run the routine on a different shot at the same time. Threads running the
+    routine on a shot wait in run() for a replica to be free, and of those waiting,
+    the shot sent for analysis earliest is given the next free replica, so that shots
+    pass through the routine in order. If the routine analyses shots in batches, the
+    shots waiting are analysed along with it.
+
+    run_batch(replica, filepaths) must run the routine in a replica on a list of
+    shots, release the replica with release(), and return a list of (success,
+    updated_data) for each shot. max_batch_size() must return how many shots the
+    routine may be given at once. Starting and stopping the workers themselves is
+    up to the caller."""
+
+    def __init__(self, run_batch, max_batch_size=lambda: 1):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        # Held while modifying the pool, and waited on for a replica to be free:
+        self.condition = threading.Condition()
+        # The number of replicas there should be. Replicas numbered this or higher
+        # are to be stopped once they have finished any analysis they are running:
+        self.n_replicas = 0
+        # Replicas not currently running analysis:
+        self.free_replicas = []
+        # The filepaths of the shots waiting for a free replica, by the order number
+        # of the shot:
+        self.waiting_shots = {}
+        # Results of shots analysed in a batch with an earlier shot, by order number,
+        # for the threads waiting on them to collect:
+        self.batch_results = {}
+        # Whether the routine's workers have been stopped for good:
+        self.ended = False
+
+    def set_n_replicas(self, n_replicas, new_replicas=()):
+        """Set how many replicas there should be, adding new_replicas, those which
+        have just had workers started, to the free replicas. Returns the free
+        replicas numbered n_replicas or higher, whose workers should be stopped."""
+        with self.condition:
+            self.n_replicas = n_replicas
+            self.free_replicas.extend(new_replicas)
+            surplus = [replica for replica in self.free_replicas if replica >= n_replicas]
+            self.free_replicas = [replica for replica in self.free_replicas if replica < n_replicas]
+            self.condition.notify_all()
+        return surplus
+
+    def release(self, replica):
+        """Return a replica to the pool once it has finished running analysis.
+        Returns False if it is surplus and its worker should be stopped instead."""
+        with self.condition:
+            if replica < self.n_replicas:
+                self.free_replicas.append(replica)
+                self.condition.notify_all()
+                return True
+        return False
+
+    def end(self):
+        """Run no more analysis. Shots still waiting for a replica fail."""
+        with self.condition:
+            self.ended = True
+            self.condition.notify_all()
+
+    def run(self, filepath, shot_number=0):
+        """Run the routine on a shot, and return (success, updated_data). shot_number
+        is the order in which the shot was sent for analysis. If the routine analyses
+        shots in batches, the results for the other shots in the batch are returned
+        to the threads waiting on them."""
+        with self.condition:
+            self.waiting_shots[shot_number] = filepath
+            while True:
+                if shot_number in self.batch_results:
+                    return self.batch_results.pop(shot_number)
+                if shot_number in self.waiting_shots:
+                    # Not yet taken into a batch by another thread:
+                    if self.ended:
+                        del self.waiting_shots[shot_number]
+                        return False, {}
+                    if self.free_replicas and shot_number == min(self.waiting_shots):
+                        break
+                self.condition.wait()
+            # Prefer the lowest numbered replica, so that replica 0, which shows
+            # plots, is used whenever it is free:
+            self.free_replicas.sort()
+            replica = self.free_replicas.pop(0)
+            shot_numbers = sorted(self.waiting_shots)[:self.max_batch_size()]
+            filepaths = [self.waiting_shots.pop(n) for n in shot_numbers]
+            self.condition.notify_all()
+        results = self.run_batch(replica, filepaths)
+        with self.condition:
+            for n, result in zip(shot_numbers[1:], results[1:]):
+                self.batch_results[n] = result
+            self.condition.notify_all()
+        return results[0]
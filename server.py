@@ -0,0 +1,111 @@
+#####################################################################
+#                                                                   #
+# /server.py                                                        #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""The server that receives shot files and answers requests from lyse.data() and
+other clients. It is shared by the lyse GUI and headless lyse, which each provide
+the application object it serves requests from."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import logging
+
+from labscript_utils.ls_zprocess import ZMQServer
+import labscript_utils.shared_drive as shared_drive
+
+from lyse.dataframe_transport import encode_dataframe
+from lyse.shared_dataframe import SharedDataFramePublisher, shared_memory_available
+
+logger = logging.getLogger('lyse.WebServer')
+
+
+class WebServer(ZMQServer):
+    """Serves requests using app, which must have the methods:
+
+    get_dataframe(): return the dataframe of all shots.
+    get_dataframe_update(since): return a dict describing the changes to the
+        dataframe since the given (id, version), as from
+        DataFrameModel.get_dataframe_update().
+    get_series(filepath): return a shot's data as a flat Series, including results
+        saved by routines still running on it, or None if the shot is not loaded.
+    add_shot(filepath): queue a shot file to be loaded and analysed.
+
+    which may be called from the server's thread."""
+
+    def __init__(self, app, *args, **kwargs):
+        self.app = app
+        # For sharing dataframes with analysis workers on this machine:
+        if shared_memory_available():
+            self.shared_dataframes = SharedDataFramePublisher()
+        else:
+            self.shared_dataframes = None
+        ZMQServer.__init__(self, *args, **kwargs)
+
+    def handler(self, request_data):
+        logger.info('WebServer request: %s' % str(request_data))
+        if request_data == 'hello':
+            return 'hello'
+        elif request_data == 'get dataframe':
+            return self.app.get_dataframe()
+        elif isinstance(request_data, dict):
+            if request_data.get('request') == 'get dataframe':
+                format = request_data.get('format')
+                compression = request_data.get('compression')
+                # The changes to the dataframe since the version given, if any:
+                update = self.app.get_dataframe_update(request_data.get('since'))
+                if format == 'shm':
+                    if self.shared_dataframes is not None and update['dataframe'] is not None:
+                        # Send the whole dataframe in shared memory. Workers map it
+                        # rather than copy it, and it is published once per version
+                        # no matter how many workers request it:
+                        update['dataframe'] = ('shm', self.shared_dataframes.publish(
+                            update['dataframe'], (update['id'], update['version'])
+                        ))
+                        return update
+                    # Changed rows are few, and are pickled:
+                    format = 'pickle'
+                if format is not None:
+                    # Encode here rather than in the main thread:
+                    for key in ['dataframe', 'rows']:
+                        if update[key] is not None:
+                            update[key] = encode_dataframe(update[key], format, compression)
+                return update
+            elif request_data.get('request') == 'get series':
+                # A single shot's data, as returned by lyse.data(filepath), including
+                # results saved by analysis routines still running on the shot:
+                filepath = shared_drive.path_to_local(request_data['path'])
+                return self.app.get_series(filepath)
+            elif 'filepath' in request_data:
+                h5_filepath = shared_drive.path_to_local(request_data['filepath'])
+                if isinstance(h5_filepath, bytes):
+                    h5_filepath = h5_filepath.decode('utf8')
+                if not isinstance(h5_filepath, str):
+                    raise AssertionError(str(type(h5_filepath)) + ' is not str or bytes')
+                self.app.add_shot(h5_filepath)
+                return 'added successfully'
+        elif isinstance(request_data, str):
+            # Just assume it's a filepath:
+            self.app.add_shot(shared_drive.path_to_local(request_data))
+            return "Experiment added successfully\n"
+
+        return ("error: operation not supported. Recognised requests are:\n "
+                "'get dataframe'\n 'hello'\n {'filepath': <some_h5_filepath>}\n "
+                "{'request': 'get dataframe', 'since': <None or (id, version)>,\n"
+                "  'format': <None, 'pickle', 'arrow' or 'shm'>, 'compression': <None, 'lz4' or 'zstd'>}\n "
+                "{'request': 'get series', 'path': <some_h5_filepath>}")
+
+    def shutdown(self):
+        ZMQServer.shutdown(self)
+        if self.shared_dataframes is not None:
+            self.shared_dataframes.close()
@@ -0,0 +1,180 @@
+#####################################################################
+#                                                                   #
+# /shared_dataframe.py                                              #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Sharing of dataframes between lyse and analysis workers on the same machine
+using shared memory.
+
+lyse copies the numeric columns of a dataframe into a single shared memory
+segment, grouped by dtype into the two-dimensional blocks pandas stores them in
+internally. The metadata describing the segment, which is small, is sent to
+workers, which construct dataframes whose numeric columns are read-only views of
+the segment rather than copies. Any other columns, such as strings and other
+Python objects, are included in the metadata in the usual way. This way multiple
+workers reading the same version of the dataframe share a single copy of it.
+
+Requires Python 3.8 or later."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import threading
+from collections import deque
+
+import numpy as np
+import pandas
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# Kinds of numpy dtypes that can be shared - everything except Python objects:
+_SHARED_KINDS = 'biufcmM'
+# Alignment of each block within the segment:
+_ALIGNMENT = 64
+
+
+def shared_memory_available():
+    return shared_memory is not None
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def _dataframe_from_columns(columns_by_position, index, columns):
+    """Construct a DataFrame from a dict of one-dimensional arrays keyed by column
+    position. They are not copied, unless the version of pandas consolidates
+    columns of the same dtype into blocks regardless, which is correct but not
+    zero-copy."""
+    df = pandas.DataFrame(
+        columns_by_position, index=index, columns=range(len(columns)), copy=False
+    )
+    df.columns = columns
+    return df
+
+
+class SharedDataFramePublisher(object):
+    """Publishes dataframes in shared memory for attach_dataframe() to read in other
+    processes. Each dataframe is published under a key identifying its contents,
+    such as a version number, and is published only once no matter how many times
+    it is requested. The most recent KEEP segments are retained, older ones are
+    unlinked, which frees their memory once all processes that have attached to
+    them have closed them."""
+
+    KEEP = 2
+
+    def __init__(self):
+        self.segments = deque()
+        self.lock = threading.Lock()
+
+    def publish(self, df, key):
+        """Return metadata, to be sent to other processes, describing a copy of df
+        in shared memory."""
+        with self.lock:
+            for segment_key, _, metadata in self.segments:
+                if segment_key == key:
+                    return metadata
+            segment, metadata = self._create(df)
+            self.segments.append((key, segment, metadata))
+            while len(self.segments) > self.KEEP:
+                _, old_segment, _ = self.segments.popleft()
+                old_segment.close()
+                old_segment.unlink()
+            return metadata
+
+    def _create(self, df):
+        n_rows = len(df)
+        shared_positions = {}
+        other_columns = {}
+        for i in range(df.shape[1]):
+            column = df.iloc[:, i]
+            if not isinstance(column.dtype, np.dtype):
+                # An extension array, such as timezone-aware datetimes:
+                other_columns[i] = getattr(column, 'array', column.values)
+            elif column.dtype.kind in _SHARED_KINDS:
+                shared_positions.setdefault(column.dtype, []).append(i)
+            else:
+                other_columns[i] = column.values
+        layout = []
+        size = 0
+        for dtype, positions in shared_positions.items():
+            layout.append((dtype.str, size, positions))
+            size = _aligned(size + len(positions) * n_rows * dtype.itemsize)
+        segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for dtype_str, offset, positions in layout:
+            block = np.ndarray((len(positions), n_rows), dtype=dtype_str, buffer=segment.buf, offset=offset)
+            for j, i in enumerate(positions):
+                block[j] = df.iloc[:, i].values
+            del block
+        metadata = {
+            'name': segment.name,
+            'n_rows': n_rows,
+            'layout': layout,
+            'other_columns': other_columns,
+            'index': df.index,
+            'columns': df.columns,
+        }
+        return segment, metadata
+
+    def close(self):
+        with self.lock:
+            while self.segments:
+                _, segment, _ = self.segments.popleft()
+                segment.close()
+                segment.unlink()
+
+
+# Segments attached to by this process. They cannot be closed until no dataframes
+# using them remain, so are closed when no longer in use on a later call to
+# attach_dataframe():
+_attached_segments = {}
+
+
+def _attach_segment(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13. The resource tracker would otherwise unlink the segment
+        # when this process exits, but it belongs to the publishing process:
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def attach_dataframe(metadata):
+    """Return a dataframe whose numeric columns are read-only views of the shared
+    memory described by metadata, as returned by SharedDataFramePublisher.publish().
+    Raises OSError if the segment no longer exists."""
+    name = metadata['name']
+    for other_name in list(_attached_segments):
+        if other_name != name:
+            try:
+                _attached_segments[other_name].close()
+            except BufferError:
+                # Still in use
+                continue
+            del _attached_segments[other_name]
+    if name not in _attached_segments:
+        _attached_segments[name] = _attach_segment(name)
+    segment = _attached_segments[name]
+    n_rows = metadata['n_rows']
+    columns_by_position = dict(metadata['other_columns'])
+    for dtype_str, offset, positions in metadata['layout']:
+        block = np.ndarray((len(positions), n_rows), dtype=dtype_str, buffer=segment.buf, offset=offset)
+        block.flags.writeable = False
+        for j, i in enumerate(positions):
+            columns_by_position[i] = block[j]
+    return _dataframe_from_columns(columns_by_position, metadata['index'], metadata['columns'])
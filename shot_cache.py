@@ -0,0 +1,264 @@
+#####################################################################
+#                                                                   #
+# /shot_cache.py                                                    #
+#                                                                   #
+# Copyright 2020, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import pickle
+import sqlite3
+import logging
+import multiprocessing
+
+from labscript_utils.labconfig import LabConfig, config_prefix
+
+from lyse.dataframe_utilities import get_flat_dict_from_shot
+
+logger = logging.getLogger('lyse.shot_cache')
+
+
+class ShotCache(object):
+    """A persistent cache, in an SQLite database, of the flattened data read from
+    shot files, as returned by dataframe_utilities.get_flat_dict_from_shot(). Entries
+    are keyed by filepath, and are only valid whilst the file's modification time and
+    size are unchanged, so a shot that has been modified since (for example by an
+    analysis routine saving results to it) is read again. Invalid entries are
+    removed when they are looked up, and once there are more than max_entries, the
+    least recently stored entries are removed. max_entries may be None for no
+    limit.
+
+    The underlying sqlite3 connection may only be used from the thread that created
+    the ShotCache."""
+
+    DEFAULT_MAX_ENTRIES = 100000
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Generous timeout in case another lyse instance is writing to the same file:
+        self.connection = sqlite3.connect(path, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS shots (
+                    filepath TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    row BLOB NOT NULL
+                )"""
+            )
+
+    @staticmethod
+    def stat(filepath):
+        """Return the (mtime, size) of a file, which must match those stored with
+        its cache entry for the entry to be valid. Raises OSError if the file
+        does not exist."""
+        st = os.stat(filepath)
+        return st.st_mtime, st.st_size
+
+    def get(self, filepath, mtime, size):
+        """Return the cached row for the file if there is one matching the given
+        mtime and size, otherwise None. An entry that does not match is removed."""
+        result = self.connection.execute(
+            "SELECT mtime, size, row FROM shots WHERE filepath = ?", (filepath,)
+        ).fetchone()
+        if result is None:
+            return None
+        if tuple(result[:2]) == (mtime, size):
+            try:
+                return pickle.loads(bytes(result[2]))
+            except Exception:
+                # Written by an incompatible version of Python or pandas. Treat as
+                # a cache miss:
+                pass
+        self.discard([filepath])
+        return None
+
+    def discard(self, filepaths):
+        """Remove any entries for the given files"""
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM shots WHERE filepath = ?", [(filepath,) for filepath in filepaths]
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM shots").fetchone()[0]
+
+    def put_many(self, entries):
+        """Store rows in the cache. entries should be an iterable of (filepath,
+        mtime, size, row) tuples, and any existing entries for those filepaths are
+        replaced."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO shots (filepath, mtime, size, row) VALUES (?, ?, ?, ?)",
+                [
+                    (filepath, mtime, size, sqlite3.Binary(pickle.dumps(row, protocol=2)))
+                    for filepath, mtime, size, row in entries
+                ],
+            )
+            if self.max_entries is not None:
+                # Replaced entries get new rowids, so the lowest are the least
+                # recently stored:
+                self.connection.execute(
+                    """DELETE FROM shots WHERE rowid IN (
+                        SELECT rowid FROM shots ORDER BY rowid
+                        LIMIT max((SELECT COUNT(*) FROM shots) - ?, 0)
+                    )""",
+                    (self.max_entries,),
+                )
+
+    def close(self):
+        self.connection.close()
+
+
+class ShotReader(object):
+    """Reads shot files with get_flat_dict_from_shot(), using a ShotCache to skip
+    those unchanged on disk since they were last read, and a pool of processes to
+    read the rest concurrently if n_processes is more than one. Set cache_path to
+    None or an empty string to not use a cache, and cache_max_entries to limit its
+    size, as for ShotCache. warn is called with a message for
+    each problem the user should know about, such as a shot that could not be
+    read.
+
+    read() may only be called from one thread, which opens the cache when it first
+    needs it, since the cache may only be used by the thread that created it."""
+
+    def __init__(self, n_processes, cache_path, warn=logger.warning,
+                 cache_max_entries=ShotCache.DEFAULT_MAX_ENTRIES):
+        self.n_processes = n_processes
+        self.cache_path = cache_path
+        self.cache_max_entries = cache_max_entries
+        self.warn = warn
+        # Started lazily when there are first several shots to read:
+        self.pool = None
+        self.cache = None
+
+    @classmethod
+    def from_labconfig(cls, exp_config, warn=logger.warning):
+        """Make a ShotReader configured with the [lyse] shot_reader_processes,
+        shot_cache and shot_cache_max_entries labconfig options"""
+        # How many processes to use for reading shot files. Reading is dominated by
+        # parsing HDF5 attributes, which shares nothing between files, so it scales
+        # with the number of processes. Zero or one means read in the calling thread:
+        try:
+            n_processes = exp_config.getint('lyse', 'shot_reader_processes')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            n_processes = max(multiprocessing.cpu_count() - 1, 1)
+        # The persistent cache of data read from shot files. Set the [lyse]
+        # shot_cache labconfig option to an empty string to disable it:
+        try:
+            cache_path = exp_config.get('lyse', 'shot_cache')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            # Default to lyse's directory of saved configuration files:
+            try:
+                cache_dir = os.path.join(exp_config.get('DEFAULT', 'app_saved_configs'), 'lyse')
+            except LabConfig.NoOptionError:
+                cache_dir = os.path.join(config_prefix, 'lyse')
+            cache_path = os.path.join(cache_dir, 'shot_cache.sqlite')
+        # The most shots to keep in the cache, dropping the least recently read:
+        try:
+            cache_max_entries = exp_config.getint('lyse', 'shot_cache_max_entries')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            cache_max_entries = ShotCache.DEFAULT_MAX_ENTRIES
+        return cls(n_processes, cache_path, warn, cache_max_entries)
+
+    def _open_cache(self):
+        if self.cache is None and self.cache_path:
+            try:
+                self.cache = ShotCache(self.cache_path, self.cache_max_entries)
+            except (sqlite3.Error, OSError) as e:
+                self.warn('Could not open shot cache %s, shots will not be cached: %s'
+                          % (self.cache_path, str(e)))
+                self.cache_path = None
+
+    def _start_pool(self):
+        if self.pool is None:
+            if hasattr(multiprocessing, 'get_context'):
+                # lyse is not fork-safe. Spawn fresh processes on platforms that
+                # would fork:
+                context = multiprocessing.get_context('spawn')
+            else:
+                # Python 2, which has no start methods:
+                context = multiprocessing
+            self.pool = context.Pool(self.n_processes)
+
+    def read(self, filepaths, progress=None):
+        """Return a list of the data read from each shot file, in the same order,
+        with None for any that could not be read. If given, progress is called with
+        the number of files dealt with so far after each one."""
+        self._open_cache()
+        cached_rows = {}
+        file_stats = {}
+        for filepath in filepaths:
+            try:
+                file_stats[filepath] = ShotCache.stat(filepath)
+            except OSError:
+                # Not found, this will be reported when we try to read it:
+                continue
+            if self.cache is not None:
+                try:
+                    row = self.cache.get(filepath, *file_stats[filepath])
+                except sqlite3.Error:
+                    logger.exception('Failed to read from shot cache')
+                    row = None
+                if row is not None:
+                    cached_rows[filepath] = row
+        missing = [filepath for filepath in filepaths if filepath not in file_stats]
+        if self.cache is not None and missing:
+            try:
+                self.cache.discard(missing)
+            except sqlite3.Error:
+                logger.exception('Failed to remove from shot cache')
+        filepaths_to_read = [filepath for filepath in filepaths if filepath not in cached_rows]
+        # If we have a pool of reader processes, the files are read concurrently,
+        # with results still coming back in the order the files were submitted:
+        if self.n_processes > 1 and len(filepaths_to_read) > 1:
+            self._start_pool()
+            results = self.pool.imap(get_flat_dict_from_shot, filepaths_to_read)
+            read_shot = lambda filepath: next(results)
+        else:
+            read_shot = get_flat_dict_from_shot
+        rows = []
+        rows_to_cache = []
+        for i, filepath in enumerate(filepaths):
+            if filepath in cached_rows:
+                rows.append(cached_rows[filepath])
+            else:
+                try:
+                    row = read_shot(filepath)
+                except IOError:
+                    self.warn('Ignoring shot file not found or not readable %s' % filepath)
+                    row = None
+                else:
+                    if filepath in file_stats:
+                        rows_to_cache.append((filepath,) + file_stats[filepath] + (row,))
+                rows.append(row)
+            if progress is not None:
+                progress(i + 1)
+        if self.cache is not None and rows_to_cache:
+            try:
+                self.cache.put_many(rows_to_cache)
+            except sqlite3.Error:
+                logger.exception('Failed to write to shot cache')
+        return rows
+
+    def close(self):
+        """Terminate the reader processes, if any. May be called from any thread.
+        The cache is left for its own thread to close, or to be closed on exit."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,150 @@
+"""Lets the tests run without the rest of the labscript suite installed.
+
+If labscript_utils cannot be imported, minimal stand-ins for the parts of it lyse
+uses are installed in sys.modules, sufficient for lyse's modules to be imported
+and for shot files to be read and written with plain h5py. Likewise for tzlocal.
+If lyse itself cannot be imported, as in a checkout not installed as a package,
+this directory's parent is imported as lyse."""
+
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import os
+import sys
+import types
+import tempfile
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def _stub_labscript_utils():
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    import h5py
+    import numpy as np
+
+    _module(
+        'labscript_utils',
+        PY2=sys.version_info[0] == 2,
+        check_version=lambda *args, **kwargs: None,
+        dedent=lambda s: s,
+        labscript_suite_install_dir=None,
+    )
+
+    _File = h5py.File
+
+    class File(_File):
+        """As labscript_utils.h5_lock, opening files for writing by default"""
+
+        def __init__(self, name, mode=None, *args, **kwargs):
+            if mode is None and isinstance(name, (str, bytes)):
+                mode = 'a'
+            _File.__init__(self, name, mode, *args, **kwargs)
+
+    h5py.File = File
+    _module('labscript_utils.h5_lock')
+
+    class LabConfig(configparser.ConfigParser):
+        NoOptionError = configparser.NoOptionError
+        NoSectionError = configparser.NoSectionError
+
+        def __init__(self, config_path=None, required_params=None, defaults=None):
+            configparser.ConfigParser.__init__(self, defaults)
+            if config_path is not None:
+                self.read(config_path)
+
+    _module('labscript_utils.labconfig', LabConfig=LabConfig,
+            config_prefix=os.path.join(tempfile.gettempdir(), 'labconfig'))
+
+    def zmq_get(port, host='localhost', data=None, timeout=5):
+        raise RuntimeError('no lyse server in tests')
+
+    class ZMQServer(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def shutdown(self):
+            pass
+
+    class ProcessTree(object):
+        @classmethod
+        def instance(cls):
+            return cls()
+
+        def subprocess(self, *args, **kwargs):
+            raise RuntimeError('no subprocesses in tests')
+
+    _module('labscript_utils.ls_zprocess', zmq_get=zmq_get, ZMQServer=ZMQServer,
+            ProcessTree=ProcessTree)
+
+    def _decode(value):
+        if isinstance(value, bytes):
+            return value.decode('utf8')
+        if isinstance(value, np.bytes_):
+            return value.decode('utf8')
+        if isinstance(value, np.str_):
+            return str(value)
+        return value
+
+    def get_attributes(group):
+        return {name: _decode(value) for name, value in group.attrs.items()}
+
+    def get_attribute(group, name):
+        return _decode(group.attrs[name])
+
+    def set_attributes(group, attributes):
+        for name, value in attributes.items():
+            group.attrs[name] = value
+
+    _module('labscript_utils.properties', get_attributes=get_attributes,
+            get_attribute=get_attribute, set_attributes=set_attributes)
+    _module('labscript_utils.shared_drive', path_to_local=lambda path: path,
+            path_to_agnostic=lambda path: path)
+
+    def dict_diff(dict1, dict2):
+        return {key: [dict1.get(key), dict2.get(key)] for key in set(dict1) | set(dict2)
+                if dict1.get(key) != dict2.get(key)}
+
+    _module('labscript_utils.dict_diff', dict_diff=dict_diff)
+    _module('labscript_utils.connections', _ensure_str=_decode)
+    _module('labscript_utils.setup_logging', setup_logging=lambda name: None)
+
+
+def _stub_tzlocal():
+    class LocalZone(object):
+        zone = 'UTC'
+
+    _module('tzlocal', get_localzone=LocalZone)
+
+
+try:
+    import labscript_utils
+except ImportError:
+    _stub_labscript_utils()
+
+try:
+    import tzlocal
+except ImportError:
+    _stub_tzlocal()
+
+try:
+    import lyse
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+        'lyse', os.path.join(ROOT, '__init__.py'), submodule_search_locations=[ROOT]
+    )
+    lyse = importlib.util.module_from_spec(spec)
+    sys.modules['lyse'] = lyse
+    spec.loader.exec_module(lyse)
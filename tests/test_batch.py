@@ -0,0 +1,87 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import sys
+import types
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from lyse import batch
+from lyse.dataframe_utilities import ColumnStore, set_dataframe_index
+
+ROUTINE = """
+import lyse
+run = lyse.Run(lyse.path)
+x = lyse.data(lyse.path)['x']
+if x < 0:
+    raise ValueError('negative x')
+run.save_result('y', 2 * x)
+"""
+
+
+def make_shot(filepath, x, i=0):
+    with h5py.File(str(filepath), 'w') as h5_file:
+        h5_file.attrs['sequence_id'] = '20200101T000000_seq'
+        h5_file.attrs['sequence_index'] = 0
+        h5_file.attrs['run time'] = '20200101T0000%02d' % i
+        h5_file.attrs['run number'] = i
+        h5_file.create_group('globals').attrs['x'] = x
+    return str(filepath)
+
+
+@pytest.fixture
+def routine(tmp_path, monkeypatch):
+    try:
+        import matplotlib
+    except ImportError:
+        # Only used by workers to select the Agg backend:
+        matplotlib = types.ModuleType(str('matplotlib'))
+        matplotlib.use = lambda backend: None
+        monkeypatch.setitem(sys.modules, 'matplotlib', matplotlib)
+    # So that sys.path is restored afterwards, undoing _init_worker() adding the
+    # routine's directory to it:
+    monkeypatch.syspath_prepend(str(tmp_path))
+    routine_path = tmp_path / 'double_x.py'
+    routine_path.write_text(ROUTINE)
+    batch._init_worker([str(routine_path)])
+    yield str(routine_path)
+    batch._routines = None
+
+
+def test_find_shots(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    shots = [make_shot(tmp_path / 'a' / 'b' / ('shot_%d.h5' % i), i, i) for i in range(2)]
+    (tmp_path / 'a' / 'notes.txt').write_text('not a shot')
+    assert batch.find_shots([str(tmp_path / '**' / '*.h5')]) == shots
+    assert batch.find_shots([str(tmp_path / 'a')]) == shots
+
+
+def test_process_shots_and_resume(tmp_path, routine):
+    shots = [make_shot(tmp_path / ('shot_%d.h5' % i), x, i) for i, x in enumerate([3, 1, -1])]
+    progress = batch.BatchProgress(str(tmp_path / 'progress.sqlite'), [routine])
+    for shot in shots:
+        shot_path, error, row = batch._process_shot(shot)
+        progress.record(shot_path, error, row)
+    progress.commit()
+    assert progress.done_shots() == set(shots)
+    # The failed shot is analysed again if retrying failed shots:
+    assert progress.done_shots(include_failed=False) == set(shots[:2])
+    progress.close()
+
+    # Resuming with the same routines keeps progress:
+    progress = batch.BatchProgress(str(tmp_path / 'progress.sqlite'), [routine])
+    assert progress.done_shots() == set(shots)
+    store = ColumnStore()
+    store.append_rows(progress.rows())
+    progress.close()
+
+    # Indexed as lyse.data() does, by run time:
+    df = set_dataframe_index(store.dataframe())
+    assert list(df.index.names) == ['sequence', 'run time']
+    assert list(df['x']) == [3, 1, -1]
+    assert list(df['double_x', 'y'].fillna(0)) == [6, 2, 0]
+
+    # With different routines, progress may not be resumed from:
+    with pytest.raises(ValueError):
+        batch.BatchProgress(str(tmp_path / 'progress.sqlite'), [routine, routine])
@@ -0,0 +1,79 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import numpy as np
+
+from lyse.dataframe_utilities import ColumnStore
+
+
+def test_rows_and_columns():
+    store = ColumnStore()
+    store.append_rows([{'filepath': 'a.h5', ('fit', 'x'): 1.0}, {'filepath': 'b.h5'}])
+    assert len(store) == 2
+    assert store.get_value(1, 'filepath') == 'b.h5'
+    # Padded or not:
+    assert store.get_value(0, ('filepath',)) == store.get_value(0, ('filepath', '')) == 'a.h5'
+    assert store.get_value(0, ('fit', 'x')) == 1.0
+    assert np.isnan(store.get_value(1, ('fit', 'x')))
+    assert store.get_flat_dict(1) == {('filepath',): 'b.h5'}
+    df = store.dataframe()
+    assert list(df.columns) == [('filepath', ''), ('fit', 'x')]
+    assert df[('fit', 'x')].dtype == float
+
+
+def test_versions():
+    store = ColumnStore()
+    assert store.version == 0
+    store.append_rows([{'x': i} for i in range(4)])
+    version = store.version
+    assert list(store.changed_rows(version)) == []
+    assert list(store.changed_rows(0)) == [0, 1, 2, 3]
+
+    store.set_value(2, 'x', 20)
+    store.replace_row(0, {'x': 0, 'y': 1})
+    assert store.version > version
+    assert list(store.changed_rows(version)) == [0, 2]
+    # A version from the future is not one we know how to describe:
+    assert store.changed_rows(store.version + 1) is None
+
+
+def test_structure_changes():
+    store = ColumnStore()
+    store.append_rows([{'x': i} for i in range(4)])
+    version = store.version
+    store.remove_rows([1])
+    assert store.structure_version == store.version
+    # Rows have been renumbered, so changes cannot be given row by row:
+    assert store.changed_rows(version) is None
+    assert [store.get_value(i, 'x') for i in range(len(store))] == [0, 2, 3]
+    assert list(store.changed_rows(store.version)) == []
+
+    # Deeper column names rename every column:
+    version = store.version
+    store.set_value(0, ('a', 'b', 'c'), 1)
+    assert store.nlevels == 3
+    assert store.changed_rows(version) is None
+    assert ('x', '', '') in store.columns
+
+
+def test_dataframe_cached_until_modified():
+    store = ColumnStore()
+    store.append_rows([{'x': 1}])
+    df = store.dataframe()
+    assert store.dataframe() is df
+    store.set_value(0, 'x', 2)
+    assert store.dataframe() is not df
+    assert store.dataframe()[('x', '')].iloc[0] == 2
+
+
+def test_id_unique():
+    assert ColumnStore().id != ColumnStore().id
+
+
+def test_capacity_grows():
+    store = ColumnStore()
+    n_rows = ColumnStore.INITIAL_CAPACITY * 2 + 1
+    store.append_rows([{'x': i} for i in range(n_rows)])
+    store.append_rows([{'y': -1}])
+    assert len(store) == n_rows + 1
+    assert store.get_value(n_rows - 1, 'x') == n_rows - 1
+    assert list(store.changed_rows(0)) == list(range(n_rows + 1))
@@ -0,0 +1,45 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+import lyse
+from lyse.dataframe_utilities import flat_dict_to_flat_series
+
+
+@pytest.fixture
+def lyse_series(monkeypatch):
+    """lyse answering 'get series' requests for a shot, recording the timeouts
+    requests are made with"""
+    requests = []
+    series = flat_dict_to_flat_series({
+        ('filepath',): 'shot.h5',
+        ('x',): 1.0,
+        ('routine', 'y'): 2.0,
+    })
+
+    def zmq_get(port, host, data, timeout):
+        requests.append((data, timeout))
+        return series.copy()
+
+    monkeypatch.setattr(lyse, 'zmq_get', zmq_get)
+    monkeypatch.setattr(lyse, 'spinning_top', True)
+    monkeypatch.setattr(lyse, '_updated_data', {})
+    return requests
+
+
+def test_series_from_lyse(lyse_series):
+    series = lyse.data('shot.h5')
+    assert series['x'] == 1
+    assert series['routine', 'y'] == 2
+    # Not waiting long for a stalled lyse:
+    (request, timeout), = lyse_series
+    assert request == {'request': 'get series', 'path': 'shot.h5'}
+    assert timeout <= lyse._SERIES_TIMEOUT
+
+
+def test_series_includes_results_saved_this_run(lyse_series):
+    lyse._updated_data['shot.h5'] = {('routine', 'y'): 3.0, ('routine', 'z'): 4.0}
+    series = lyse.data('shot.h5')
+    assert series['x'] == 1
+    assert series['routine', 'y'] == 3
+    assert series['routine', 'z'] == 4
@@ -0,0 +1,111 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pickle
+
+import pytest
+
+pandas = pytest.importorskip('pandas')
+
+import lyse
+from lyse.dataframe_utilities import ColumnStore
+from lyse.server import WebServer
+from lyse.shared_dataframe import SharedDataFramePublisher, shared_memory_available
+
+
+class FakeConfig(object):
+    """Enables shared memory dataframes, with default values for other options"""
+
+    def getboolean(self, section, option):
+        if (section, option) == ('lyse', 'shared_memory_dataframes'):
+            return True
+        raise lyse.LabConfig.NoOptionError(option, section)
+
+
+class FakeApp(object):
+    """The parts of the lyse GUI that the WebServer needs to serve dataframes"""
+
+    def __init__(self):
+        self.column_store = ColumnStore()
+
+    def add_shot(self, i):
+        self.column_store.append_rows([{
+            ('sequence',): pandas.Timestamp('2020-01-01'),
+            ('run time',): pandas.Timestamp('2020-01-01') + pandas.Timedelta(seconds=i),
+            ('x',): float(i),
+        }])
+
+    def get_dataframe(self):
+        return self.column_store.dataframe()
+
+    def get_dataframe_update(self, since):
+        return self.column_store.get_update(since)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    if not shared_memory_available():
+        pytest.skip('shared memory not available')
+    app = FakeApp()
+    # Not started, only its handler is used:
+    server = WebServer.__new__(WebServer)
+    server.app = app
+    server.shared_dataframes = SharedDataFramePublisher()
+    # The formats in which each dataframe and rows of an update were sent:
+    server.formats = []
+
+    def zmq_get(port, host, data, timeout):
+        # Round trip through pickle as zmq would:
+        response = pickle.loads(pickle.dumps(server.handler(data)))
+        server.formats.append(tuple(
+            response[key] and response[key][0] for key in ['dataframe', 'rows']
+        ))
+        return response
+
+    monkeypatch.setattr(lyse, 'zmq_get', zmq_get)
+    monkeypatch.setattr(lyse, 'spinning_top', True)
+    monkeypatch.setattr(lyse, '_labconfig', FakeConfig(), raising=False)
+    monkeypatch.setattr(lyse, '_data_versions', {})
+    monkeypatch.setattr(lyse, '_last_run_data_versions', {})
+    yield server
+    server.shared_dataframes.close()
+
+
+def run_succeeded():
+    # As the analysis subprocess does after a routine runs successfully:
+    lyse._last_run_data_versions.update(lyse._data_versions)
+
+
+def test_since_last_run_with_shared_memory(server):
+    app = server.app
+    app.add_shot(0)
+    app.add_shot(1)
+
+    # Never run before, so all rows, in shared memory:
+    df = lyse.data(since_last_run=True)
+    assert lyse.data_reset
+    assert list(df['x']) == [0, 1]
+    assert server.formats[-1] == ('shm', None)
+    run_succeeded()
+
+    # Only the rows added or changed since, pickled:
+    app.add_shot(2)
+    app.column_store.set_value(0, 'x', 10.0)
+    df = lyse.data(since_last_run=True)
+    assert not lyse.data_reset
+    assert sorted(df['x']) == [2, 10]
+    assert server.formats[-1] == (None, 'pickle')
+
+    # A run that fails does not move the last run's version on:
+    df = lyse.data(since_last_run=True)
+    assert not lyse.data_reset
+    assert sorted(df['x']) == [2, 10]
+    run_succeeded()
+
+    df = lyse.data(since_last_run=True)
+    assert not lyse.data_reset
+    assert len(df) == 0
+
+    # The whole dataframe is still available in shared memory:
+    df = lyse.data()
+    assert list(df['x']) == [10, 1, 2]
+    assert server.formats[-1] == ('shm', None)
@@ -0,0 +1,68 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import numpy as np
+import pandas
+import pytest
+
+from lyse.dataframe_transport import encode_dataframe, decode_dataframe, arrow_available
+
+
+@pytest.fixture
+def df():
+    columns = pandas.MultiIndex.from_tuples(
+        [('filepath', ''), ('fit', 'x'), ('fit', 'n'), ('fit', 'image'), ('labels', '')]
+    )
+    return pandas.DataFrame(
+        [
+            ['a.h5', 1.5, 1, np.zeros(3), 'first'],
+            ['b.h5', np.nan, 2, np.ones(3), np.nan],
+        ],
+        columns=columns,
+    )
+
+
+def assert_round_trips(df, format, compression=None):
+    encoded = encode_dataframe(df, format, compression)
+    decoded = decode_dataframe(encoded)
+    assert list(decoded.columns) == list(df.columns)
+    assert decoded.index.equals(df.index)
+    for name in df.columns:
+        for expected, actual in zip(df[name], decoded[name]):
+            if isinstance(expected, np.ndarray):
+                assert np.array_equal(expected, actual)
+            elif isinstance(expected, float) and np.isnan(expected):
+                assert np.isnan(actual)
+            else:
+                assert expected == actual
+    return encoded
+
+
+def test_pickle(df):
+    encoded = assert_round_trips(df, 'pickle')
+    assert encoded[0] == 'pickle'
+    # Index not a RangeIndex, as after lyse.data() has set it:
+    assert_round_trips(df.set_index(('filepath', '')), 'pickle')
+
+
+def test_arrow_falls_back_to_pickle(df, monkeypatch):
+    monkeypatch.setattr('lyse.dataframe_transport.pyarrow', None)
+    assert encode_dataframe(df, 'arrow')[0] == 'pickle'
+    with pytest.raises(RuntimeError):
+        decode_dataframe(('arrow', b''))
+
+
+@pytest.mark.skipif(not arrow_available(), reason='pyarrow not installed')
+@pytest.mark.parametrize('compression', [None, 'lz4', 'zstd'])
+def test_arrow(df, compression):
+    encoded = assert_round_trips(df, 'arrow', compression)
+    assert encoded[0] == 'arrow'
+    assert_round_trips(df.iloc[[1]], 'arrow', compression)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        encode_dataframe(pandas.DataFrame(), 'csv')
+    with pytest.raises(ValueError):
+        encode_dataframe(pandas.DataFrame(), 'pickle', 'gzip')
+    with pytest.raises(ValueError):
+        decode_dataframe(('csv', b''))
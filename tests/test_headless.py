@@ -0,0 +1,48 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+from lyse import headless
+from lyse.multishot_scheduler import MultishotScheduler
+
+
+def write_config(path, singleshot, multishot_policy=None):
+    lines = ['[lyse_state]', 'SingleShot = %r' % (singleshot,), 'MultiShot = []']
+    if multishot_policy is not None:
+        lines.append('multishot_policy = %r' % (multishot_policy,))
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # Not started, only its configuration is loaded:
+    app = headless.HeadlessLyse.__new__(headless.HeadlessLyse)
+    app.singleshot_routines = []
+    app.multishot_routines = []
+    app.multishot_scheduler = MultishotScheduler()
+    started = []
+    monkeypatch.setattr(headless, 'HeadlessRoutine', started.append)
+    app.started = started
+    return app
+
+
+def test_load_configuration(app, tmp_path):
+    config = write_config(
+        tmp_path / 'lyse.ini',
+        [('/a.py', 2), ('/b.py', 0, 4), ('/c.py', 2, 1)],
+        ('every n shots', 5),
+    )
+    app.load_configuration(config)
+    # Unchecked routines are not started, even with more worker processes:
+    assert app.started == ['/a.py', '/c.py']
+    assert (app.multishot_scheduler.policy, app.multishot_scheduler.n) == ('every n shots', 5)
+
+
+def test_refuse_replicas(app, tmp_path):
+    config = write_config(tmp_path / 'lyse.ini', [('/a.py', 2), ('/b.py', 2, 3)])
+    with pytest.raises(ValueError) as excinfo:
+        app.load_configuration(config)
+    assert '/b.py' in str(excinfo.value)
+    # Refused before any workers were started:
+    assert app.started == []
@@ -0,0 +1,82 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+import numpy as np
+
+from lyse import memoization
+
+
+@pytest.fixture
+def shot(tmp_path):
+    filepath = str(tmp_path / 'shot.h5')
+    with h5py.File(filepath, 'w') as h5_file:
+        h5_file.create_group('globals').attrs['detuning'] = 1.0
+        results = h5_file.create_group('results')
+        results.create_group('fit').attrs['x'] = 2.0
+        results['fit'].create_dataset('residuals', data=np.arange(10.0))
+        results.create_group('other').attrs['y'] = 3.0
+        results.create_group('mine')
+    return filepath
+
+
+def get_fingerprint(filepath, routine_hash='routine', module_hashes=(), groups=('fit',)):
+    with h5py.File(filepath, 'r') as h5_file:
+        return memoization.fingerprint(h5_file, routine_hash, list(module_hashes), list(groups))
+
+
+def test_fingerprint_inputs(shot):
+    fingerprint = get_fingerprint(shot)
+    assert get_fingerprint(shot) == fingerprint
+    assert get_fingerprint(shot, routine_hash='edited') != fingerprint
+    assert get_fingerprint(shot, module_hashes=[('module.py', 'abc')]) != fingerprint
+    assert get_fingerprint(shot, groups=['fit', 'other']) != fingerprint
+
+    # Results of other routines not read do not matter:
+    with h5py.File(shot, 'a') as h5_file:
+        h5_file['results/other'].attrs['y'] = 4.0
+    assert get_fingerprint(shot) == fingerprint
+
+    with h5py.File(shot, 'a') as h5_file:
+        h5_file['globals'].attrs['detuning'] = 1.5
+    changed_globals = get_fingerprint(shot)
+    assert changed_globals != fingerprint
+
+    # Including arrays, compared by content:
+    with h5py.File(shot, 'a') as h5_file:
+        h5_file['results/fit/residuals'][5] = -1
+    assert get_fingerprint(shot) != changed_globals
+
+
+def test_results_groups_read(shot):
+    with h5py.File(shot, 'r') as h5_file:
+        assert memoization.results_groups_read(h5_file, ['fit', 'missing'], 'mine') == ['fit']
+        assert memoization.results_groups_read(
+            h5_file, [memoization.ALL_RESULTS], 'mine'
+        ) == ['fit', 'other']
+
+
+def test_store_and_clear(shot):
+    inputs = {'results_groups': ['fit'], 'modules': ['module.py']}
+    with h5py.File(shot, 'a') as h5_file:
+        assert memoization.get_stored(h5_file, 'mine') == (None, None)
+        memoization.store(h5_file, 'mine', 'abc123', inputs)
+    with h5py.File(shot, 'r') as h5_file:
+        assert memoization.get_stored(h5_file, 'mine') == ('abc123', inputs)
+    memoization.clear(shot)
+    with h5py.File(shot, 'r') as h5_file:
+        assert memoization.get_stored(h5_file, 'mine') == (None, None)
+
+
+def test_module_hasher(tmp_path):
+    hasher = memoization.ModuleHasher()
+    module = tmp_path / 'module.py'
+    module.write_text('x = 1\n')
+    assert hasher.is_user_module(str(module))
+    assert not hasher.is_user_module(np.__file__)
+    [(_, first)] = hasher.file_hashes([str(module)])
+    module.write_text('x = 22\n')
+    [(_, second)] = hasher.file_hashes([str(module)])
+    assert first != second
+    assert hasher.file_hashes([str(tmp_path / 'deleted.py')]) == [(str(tmp_path / 'deleted.py'), None)]
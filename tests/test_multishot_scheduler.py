@@ -0,0 +1,56 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+from lyse.dataframe_utilities import ColumnStore
+from lyse.multishot_scheduler import MultishotScheduler
+
+
+def test_end_of_sequence():
+    scheduler = MultishotScheduler('end of sequence')
+    assert not scheduler.sequence_starting('20200101T000000_seq_0')
+    scheduler.shot_done()
+    assert not scheduler.sequence_starting('20200101T000000_seq_0')
+    scheduler.shot_done()
+    assert scheduler.sequence_starting('20200101T000100_seq_1')
+    scheduler.ran()
+    assert not scheduler.sequence_starting('20200101T000100_seq_1')
+
+
+def test_shots_without_sequence_attributes():
+    # Shots without sequence attributes have NaN in the sequence column:
+    column_store = ColumnStore()
+    column_store.append_rows([
+        {('sequence',): '20200101T000000_seq_0', ('filepath',): 'a.h5'},
+        {('filepath',): 'b.h5'},
+        {('filepath',): 'c.h5'},
+    ])
+    sequences = [column_store.get_value(row, 'sequence') for row in range(3)]
+
+    scheduler = MultishotScheduler('end of sequence')
+    assert not scheduler.sequence_starting(sequences[0])
+    scheduler.shot_done()
+    # A shot without a sequence is a different sequence to one with a sequence:
+    assert scheduler.sequence_starting(sequences[1])
+    scheduler.ran()
+    assert not scheduler.sequence_starting(sequences[1])
+    scheduler.shot_done()
+    # But NaN is not different to NaN, nor to None:
+    assert not scheduler.sequence_starting(sequences[2])
+    scheduler.shot_done()
+    assert not scheduler.sequence_starting(float('nan'))
+    scheduler.shot_done()
+    assert not scheduler.sequence_starting(None)
+    assert scheduler.pending == 3
+
+
+@pytest.mark.parametrize('policy', ['interval', 'idle'])
+def test_no_timeout_while_paused(policy):
+    scheduler = MultishotScheduler(policy, n=0)
+    scheduler.shot_done()
+    assert scheduler.timeout() == 0
+    # Analysis loop should wait for analysis to be resumed, not spin:
+    scheduler.paused = True
+    assert scheduler.timeout() is None
+    scheduler.paused = False
+    assert scheduler.timeout() == 0
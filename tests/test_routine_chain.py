@@ -0,0 +1,171 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import time
+import threading
+
+from lyse.routine_chain import get_dependencies, run_routines, ReplicaPool
+
+
+class Routine(object):
+    def __init__(self, name, depends_on=None, success=True):
+        self.results_group = name
+        self.worker_info = {'depends_on': depends_on}
+        self.success = success
+        # Set to let the routine finish running:
+        self.finish = threading.Event()
+        self.finish.set()
+
+    def __repr__(self):
+        return self.results_group
+
+
+def test_get_dependencies():
+    a = Routine('a')
+    b = Routine('b', depends_on=[])
+    c = Routine('c', depends_on=['a', 'd'])
+    d = Routine('d')
+    dependencies = get_dependencies([a, b, c, d])
+    assert dependencies[a] == set()
+    assert dependencies[b] == set()
+    # Only routines above it in the list:
+    assert dependencies[c] == {a}
+    # Depends on all above it unless it called depends_on():
+    assert dependencies[d] == {a, b, c}
+
+
+def run(routines):
+    started = []
+    results = []
+
+    def run_routine(routine):
+        started.append(routine)
+        routine.finish.wait()
+        return routine.success, {'shot.h5': {(routine.results_group, 'x'): 1}}
+
+    def on_result(routine, success, updated_data, n_done):
+        results.append((routine, success, n_done))
+
+    return run_routines(routines, run_routine, on_result), started, results
+
+
+def test_run_in_dependency_order():
+    a = Routine('a')
+    b = Routine('b', depends_on=[])
+    c = Routine('c', depends_on=['a'])
+    # b runs at the same time as a, and c does not wait for it:
+    b.finish.clear()
+    timer = threading.Timer(0.2, b.finish.set)
+    timer.start()
+    success, started, results = run([a, b, c])
+    assert success
+    assert set(started[:2]) == {a, b}
+    assert [routine for routine, _, _ in results] == [a, c, b]
+    assert [n_done for _, _, n_done in results] == [1, 2, 3]
+
+
+def test_stop_after_failure():
+    a = Routine('a', success=False)
+    b = Routine('b', depends_on=[])
+    c = Routine('c', depends_on=[])
+    # Routines already running finish, but no more start:
+    success, started, results = run([a, Routine('after_a'), b, c])
+    assert not success
+    assert set(started) == {a, b, c}
+    assert sorted((repr(r), s) for r, s, _ in results) == [('a', False), ('b', True), ('c', True)]
+
+
+def test_exception_counts_as_failure():
+    a = Routine('a')
+
+    def run_routine(routine):
+        raise RuntimeError('worker gone')
+
+    assert not run_routines([a], run_routine)
+
+
+def test_no_routines():
+    assert run_routines([], None)
+
+
+class Worker(object):
+    """Runs batches in a ReplicaPool, each waiting until allowed to finish"""
+
+    def __init__(self, n_replicas, max_batch_size=1):
+        self.pool = ReplicaPool(self.run_batch, lambda: max_batch_size)
+        self.pool.set_n_replicas(n_replicas, range(n_replicas))
+        self.batches = []
+        self.finish = threading.Event()
+
+    def run_batch(self, replica, filepaths):
+        self.batches.append((replica, filepaths))
+        self.finish.wait()
+        self.pool.release(replica)
+        return [(True, {filepath: {('x',): replica}}) for filepath in filepaths]
+
+    def start(self, filepath, shot_number):
+        results = {}
+        thread = threading.Thread(
+            target=lambda: results.update(result=self.pool.run(filepath, shot_number))
+        )
+        thread.start()
+        return thread, results
+
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_replicas_take_shots_in_order():
+    worker = Worker(n_replicas=2)
+    # Shot 0 and shot 1 run at once in different replicas, shots 2 and 3 wait, and
+    # are taken in order of shot number regardless of the order they arrived:
+    threads = [worker.start('0.h5', 0), worker.start('1.h5', 1)]
+    wait_until(lambda: len(worker.batches) == 2)
+    threads += [worker.start('3.h5', 3), worker.start('2.h5', 2)]
+    wait_until(lambda: len(worker.pool.waiting_shots) == 2)
+    assert sorted(worker.batches) == [(0, ['0.h5']), (1, ['1.h5'])]
+    worker.finish.set()
+    for thread, _ in threads:
+        thread.join(5)
+    assert [filepaths for _, filepaths in worker.batches[2:]] == [['2.h5'], ['3.h5']]
+    for thread, results in threads:
+        success, updated_data = results['result']
+        assert success and len(updated_data) == 1
+
+
+def test_replicas_batches():
+    worker = Worker(n_replicas=1, max_batch_size=3)
+    first = worker.start('0.h5', 0)
+    wait_until(lambda: worker.batches)
+    threads = [worker.start('%d.h5' % i, i) for i in range(1, 5)]
+    wait_until(lambda: len(worker.pool.waiting_shots) == 4)
+    worker.finish.set()
+    for thread, _ in [first] + threads:
+        thread.join(5)
+    assert [filepaths for _, filepaths in worker.batches] == [
+        ['0.h5'], ['1.h5', '2.h5', '3.h5'], ['4.h5']
+    ]
+    # Each shot gets the results saved to its own file:
+    for i, (_, results) in enumerate([first] + threads):
+        assert list(results['result'][1]) == ['%d.h5' % i]
+
+
+def test_surplus_replicas():
+    pool = ReplicaPool(None)
+    assert pool.set_n_replicas(3, [0, 1, 2]) == []
+    pool.free_replicas.remove(2)
+    # Free surplus replicas are returned to be stopped, busy ones once released:
+    assert pool.set_n_replicas(1) == [1]
+    assert not pool.release(2)
+    assert pool.free_replicas == [0]
+
+
+def test_replicas_ended():
+    pool = ReplicaPool(None)
+    pool.end()
+    assert pool.run('0.h5') == (False, {})
+    assert pool.waiting_shots == {}
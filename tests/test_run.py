@@ -0,0 +1,104 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+import numpy as np
+
+import lyse
+from lyse import Run
+
+
+@pytest.fixture
+def filepath(tmp_path):
+    filepath = str(tmp_path / 'shot.h5')
+    with h5py.File(filepath, 'w') as h5_file:
+        traces = h5_file.create_group('data/traces')
+        trace = np.zeros(5, dtype=[('t', float), ('values', float)])
+        trace['t'] = np.arange(5)
+        trace['values'] = np.arange(5) ** 2
+        traces.create_dataset('probe', data=trace)
+    return filepath
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """The modes of the shot files opened, in order"""
+    opened = []
+    File = h5py.File
+
+    def open_file(name, mode=None, *args, **kwargs):
+        opened.append(mode)
+        return File(name, mode, *args, **kwargs)
+
+    monkeypatch.setattr(h5py, 'File', open_file)
+    return opened
+
+
+def test_group_from_script_name(filepath):
+    run = Run(filepath)
+    # Named after the file of the code creating the Run:
+    assert run.group == 'test_run'
+    with h5py.File(filepath, 'r') as h5_file:
+        assert 'results/test_run' in h5_file
+
+
+def test_context_manager_opens_once(filepath, opened):
+    run = Run(filepath)
+    del opened[:]
+    with run:
+        t, values = run.get_trace('probe')
+        run.save_result('peak', values.max())
+        run.save_results('a', 1, 'b', 2)
+        assert run.get_result('test_run', 'peak') == 16
+    assert opened == ['a']
+    assert run._held_h5_file is None
+    # Closed, and the results flushed:
+    with h5py.File(filepath, 'r') as h5_file:
+        assert dict(h5_file['results/test_run'].attrs) == {'peak': 16, 'a': 1, 'b': 2}
+
+
+def test_open_nested(filepath, opened):
+    run = Run(filepath, no_write=True)
+    run.open()
+    with run:
+        assert run.trace_names() == ['probe']
+    # Still held open by the outer open():
+    assert run._held_h5_file is not None
+    assert run.get_trace('probe')[0][-1] == 4
+    run.close()
+    assert run._held_h5_file is None
+    # Extra calls to close() do nothing:
+    run.close()
+    assert opened == ['r']
+
+
+def test_without_open(filepath, opened):
+    run = Run(filepath, no_write=True)
+    run.trace_names()
+    run.get_trace('probe')
+    # Each call opens the file:
+    assert len(opened) == 2
+
+
+def test_set_group_while_open(filepath, opened):
+    Run(filepath)
+    del opened[:]
+    run = Run(filepath, no_write=True)
+    with run:
+        with pytest.raises(Exception):
+            run.save_result('x', 1)
+        # Made writable, the file is reopened for writing:
+        run.set_group('interactive')
+        run.save_result('x', 1)
+    assert opened == ['r', 'a']
+    with h5py.File(filepath, 'r') as h5_file:
+        assert h5_file['results/interactive'].attrs['x'] == 1
+
+
+def test_save_results_recorded_for_lyse(filepath, monkeypatch):
+    monkeypatch.setattr(lyse, 'spinning_top', True)
+    monkeypatch.setattr(lyse, '_updated_data', {})
+    run = Run(filepath)
+    run.save_results_dict({'x': 1.0, 'y': 2.0})
+    assert lyse._updated_data == {filepath: {('test_run', 'x'): 1.0, ('test_run', 'y'): 2.0}}
@@ -0,0 +1,50 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+import numpy as np
+
+from lyse import Run
+
+
+@pytest.fixture
+def run(tmp_path):
+    filepath = str(tmp_path / 'shot.h5')
+    with h5py.File(filepath, 'w') as h5_file:
+        group = h5_file.create_group('images/side/absorption')
+        for i, name in enumerate(['atoms', 'flat', 'dark']):
+            group.create_dataset(name, data=np.arange(48, dtype=float).reshape(6, 8) + 100 * i)
+    return Run(filepath, no_write=True)
+
+
+def test_roi_and_binning(run):
+    full = run.get_image('side', 'absorption', 'atoms')
+    roi = (slice(1, 5), slice(2, 8, 2))
+    assert np.array_equal(run.get_image('side', 'absorption', 'atoms', roi=roi), full[roi])
+    assert np.array_equal(run.get_image('side', 'absorption', 'atoms', roi=slice(3, None)), full[3:])
+
+    binned = run.get_image('side', 'absorption', 'atoms', binning=(2, 3))
+    assert binned.shape == (3, 2)
+    assert binned[0, 0] == full[:2, :3].sum()
+
+    images = run.get_images('side', 'absorption', 'atoms', 'flat', roi=roi, binning=2)
+    assert images.shape == (2, 2, 1)
+    assert images[1, 0, 0] == (full + 100)[roi][:2, :2].sum()
+
+
+@pytest.mark.parametrize('step', [0, -1])
+def test_roi_step_must_be_positive(run, step):
+    roi = (slice(None), slice(None, None, step))
+    with pytest.raises(ValueError):
+        run.get_image('side', 'absorption', 'atoms', roi=roi)
+    # Even though a memmap could be sliced backwards:
+    with pytest.raises(ValueError):
+        run.get_image('side', 'absorption', 'atoms', roi=roi, mmap=True)
+    with pytest.raises(ValueError):
+        run.get_images('side', 'absorption', 'atoms', 'flat', roi=roi)
+
+
+def test_roi_too_many_axes(run):
+    with pytest.raises(ValueError):
+        run.get_image('side', 'absorption', 'atoms', roi=(slice(None),) * 3)
@@ -0,0 +1,86 @@
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from lyse.shot_cache import ShotCache, ShotReader
+
+
+def make_shot(filepath, x):
+    with h5py.File(filepath, 'w') as h5_file:
+        h5_file.attrs['sequence_id'] = '20200101T000000_seq'
+        h5_file.attrs['sequence_index'] = 0
+        h5_file.create_group('globals').attrs['x'] = x
+    return str(filepath)
+
+
+def test_shot_reader(tmp_path):
+    filepaths = [make_shot(tmp_path / ('shot_%d.h5' % i), i) for i in range(3)]
+    missing = str(tmp_path / 'missing.h5')
+    warnings = []
+    reader = ShotReader(0, str(tmp_path / 'cache.sqlite'), warn=warnings.append)
+    progress = []
+    rows = reader.read(filepaths[:2] + [missing], progress.append)
+    assert [row[('x',)] for row in rows[:2]] == [0, 1]
+    assert rows[2] is None
+    assert progress == [1, 2, 3]
+    assert len(warnings) == 1 and missing in warnings[0]
+
+    # Shots read are cached, keyed by their mtime and size:
+    for filepath in filepaths[:2]:
+        assert reader.cache.get(filepath, *ShotCache.stat(filepath)) is not None
+    assert reader.cache.get(filepaths[2], *ShotCache.stat(filepaths[2])) is None
+
+    rows = reader.read(filepaths)
+    assert [row[('x',)] for row in rows] == [0, 1, 2]
+    reader.close()
+
+
+def test_shot_reader_without_cache(tmp_path):
+    filepath = make_shot(tmp_path / 'shot.h5', 7)
+    reader = ShotReader(0, None)
+    assert reader.read([filepath])[0][('x',)] == 7
+    assert reader.cache is None
+    reader.close()
+
+
+def test_stale_entries_removed(tmp_path):
+    cache = ShotCache(str(tmp_path / 'cache.sqlite'))
+    cache.put_many([('a.h5', 1.0, 10, {'x': 1}), ('b.h5', 1.0, 10, {'x': 2})])
+    assert cache.get('a.h5', 1.0, 10) == {'x': 1}
+    # Modified since cached, so no longer valid:
+    assert cache.get('a.h5', 2.0, 10) is None
+    assert cache.get('a.h5', 1.0, 10) is None
+    assert len(cache) == 1
+    cache.discard(['b.h5'])
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_max_entries(tmp_path):
+    cache = ShotCache(str(tmp_path / 'cache.sqlite'), max_entries=3)
+    cache.put_many([('%d.h5' % i, 1.0, 10, i) for i in range(3)])
+    # Storing 0.h5 again makes 1.h5 the least recently stored:
+    cache.put_many([('0.h5', 1.0, 10, 0), ('3.h5', 1.0, 10, 3)])
+    assert len(cache) == 3
+    assert cache.get('1.h5', 1.0, 10) is None
+    assert [cache.get('%d.h5' % i, 1.0, 10) for i in [0, 2, 3]] == [0, 2, 3]
+    cache.put_many([('%d.h5' % i, 1.0, 10, i) for i in range(4, 10)])
+    assert len(cache) == 3
+    cache.close()
+
+    unlimited = ShotCache(str(tmp_path / 'cache.sqlite'), max_entries=None)
+    unlimited.put_many([('%d.h5' % i, 1.0, 10, i) for i in range(10)])
+    assert len(unlimited) == 10
+    unlimited.close()
+
+
+def test_missing_shots_removed(tmp_path):
+    filepath = make_shot(tmp_path / 'shot.h5', 0)
+    reader = ShotReader(0, str(tmp_path / 'cache.sqlite'), warn=lambda message: None)
+    reader.read([filepath])
+    assert len(reader.cache) == 1
+    (tmp_path / 'shot.h5').unlink()
+    assert reader.read([filepath]) == [None]
+    assert len(reader.cache) == 0